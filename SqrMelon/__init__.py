@@ -1,17 +1,22 @@
 from pycompat import *
 import datetime
+import time
 import sys
 import shutil
 import ctypes
 import functools
 import traceback
 
+from build import generate, keyreduce, quantize
 from camerawidget import Camera
+from capture import FrameCapture, FFmpegSink, ImageSequenceSink
 from fileutil import FileDialog, FilePath
 from overlays import Overlays
 
 from animationgraph.curveview import CurveEditor
+from prefetch import ScenePrefetcher
 from profileui import Profiler
+from projectscript import projectScript
 from scene import Scene
 from scenelist import SceneList
 from sceneview3d import SceneView
@@ -68,6 +73,9 @@ class App(QMainWindowState):
         self.__statusBar = QStatusBar()
         self.setStatusBar(self.__statusBar)
 
+        # kept between exports, so only files that changed are processed again
+        self.__exportCache = None
+
         self._timer = Timer()
         self.__shotsManager = ShotManager()
         self.__shotsManager.viewShotAction.connect(self.__onViewShot)
@@ -77,6 +85,9 @@ class App(QMainWindowState):
         self.__sceneView = SceneView(self.__shotsManager, self._timer, self.__overlays)
         self.__overlays.changed.connect(self.__sceneView.repaint)
         self._timer.timeChanged.connect(self.__setCurrentShot)
+        self.__prefetcher = ScenePrefetcher(self.__shotsManager, self._timer, self.__sceneView)
+        self._timer.timeChanged.connect(self.__prefetcher.onTimeChanged)
+        self.__shotsManager.shotsEnabled.connect(self.__prefetcher.schedule)
         self.__shotsManager.shotPinned.connect(self.__setCurrentShot)
         self.__shotsManager.shotsEnabled.connect(self.__setCurrentShot)
         self.__shotsManager.shotsDisabled.connect(self.__setCurrentShot)
@@ -191,6 +202,9 @@ class App(QMainWindowState):
         sdready.setCheckable(True)
         sdready.setActionGroup(previewRadioGroup)
 
+        warmAll = toolsMenu.addAction('Warm all scenes')
+        warmAll.triggered.connect(functools.partial(self.__prefetcher.warmAll, self))
+
         saveStatic = toolsMenu.addAction('Save static textures')
         saveStatic.triggered.connect(self.__sceneView.saveStaticTextures)
 
@@ -213,6 +227,14 @@ class App(QMainWindowState):
 
         toolsMenu.addAction('Record').triggered.connect(self.__record)
 
+        toolsMenu.addSeparator()
+        toolsMenu.addAction('Export player data').triggered.connect(self.__exportPlayerData)
+        exportOnSave = toolsMenu.addAction('Export player data on save')
+        exportOnSave.setCheckable(True)
+        exportOnSave.setChecked(gSettings.value('ExportOnSave', '0') == '1')
+        exportOnSave.toggled.connect(lambda state: gSettings.setValue('ExportOnSave', '1' if state else '0'))
+        toolsMenu.addAction('Export settings').triggered.connect(self.__exportSettings)
+
         option = viewport
         if gSettings.contains('GLViewScale'):
             option = {1.0: viewport, 0.5: half, 0.25: quart, 0.125: eight}[float(gSettings.value('GLViewScale'))]
@@ -243,74 +265,67 @@ class App(QMainWindowState):
         resolution.addItems(['144', '288', '360', '720', '1080', '2160'])
         resolution.setCurrentIndex(rId)
         layout.addWidget(resolution, 1, 1)
+        toFFmpeg = QCheckBox('Stream to ffmpeg')
+        toFFmpeg.setToolTip('Encode straight to convertcapture/output.mp4 instead of writing numbered images.')
+        toFFmpeg.setChecked(gSettings.value('RecordToFFmpeg', 'false') == 'true')
+        layout.addWidget(toFFmpeg, 2, 0, 1, 2)
         ok = QPushButton('Ok')
         ok.clicked.connect(diag.accept)
         cancel = QPushButton('Cancel')
         cancel.clicked.connect(diag.reject)
-        layout.addWidget(ok, 2, 0)
-        layout.addWidget(cancel, 2, 1)
+        layout.addWidget(ok, 3, 0)
+        layout.addWidget(cancel, 3, 1)
         diag.exec_()
         if diag.result() != QDialog.Accepted:
             return
         gSettings.setValue('RecordFPS', fps.currentIndex())
         gSettings.setValue('RecordResolution', resolution.currentIndex())
+        gSettings.setValue('RecordToFFmpeg', 'true' if toFFmpeg.isChecked() else 'false')
 
         FPS = int(fps.currentText())
         HEIGHT = int(resolution.currentText())
-        WIDTH = (HEIGHT * 16) / 9
+        WIDTH = (HEIGHT * 16) // 9
         FMT = 'jpg'
 
-        data = (ctypes.c_ubyte * (WIDTH * HEIGHT * 3))()  # alloc buffer once
         flooredStart = self._timer.secondsToBeats(int(self._timer.beatsToSeconds(self._timer.start) * FPS) / float(FPS))
         duration = self._timer.beatsToSeconds(self._timer.end - flooredStart)
 
         captureDir = currentProjectDirectory().join('capture')
         captureDir.ensureExists(isFolder=True)
-
-        progress = QProgressDialog(self)
-        progress.setMaximum(int(duration * FPS))
-        prevFrame = 0
-        for frame in range(int(duration * FPS)):
-            deltaTime = (frame - prevFrame) / float(FPS)
-            prevFrame = frame
-            progress.setValue(frame)
-            QApplication.processEvents()
-            if progress.wasCanceled():
-                break
-            beats = flooredStart + self._timer.secondsToBeats(frame / float(FPS))
-
-            shot = self.__shotsManager.shotAtTime(beats)
-            if shot is None:
-                continue
-            sceneFile = currentScenesDirectory().join(shot.sceneName).ensureExt(SCENE_EXT)
-            scene = Scene.getScene(sceneFile)
-            scene.setSize(WIDTH, HEIGHT)
-
-            uniforms = self.__shotsManager.evaluate(beats)
-            textureUniforms = self.__shotsManager.additionalTextures(beats)
-            self.__sceneView._cameraInput.setData(*(uniforms['uOrigin'] + uniforms['uAngles']))  # feed animation into camera so animationprocessor can read it again
-            cameraData = self.__sceneView._cameraInput.data()
-
-            modifier = currentProjectDirectory().join('animationprocessor.py')
-            if modifier.exists():
-                execfile(str(modifier), globals(), locals())
-
-            for name in self.__sceneView._textures:
-                uniforms[name] = self.__sceneView._textures[name]._id
-
-            scene.drawToScreen(self._timer.beatsToSeconds(beats), beats, uniforms, (0, 0, WIDTH, HEIGHT), textureUniforms)
-            scene.colorBuffers[-1][0].use()
-
-            from OpenGL.GL import glGetTexImage, GL_TEXTURE_2D, GL_RGB, GL_UNSIGNED_BYTE
-            glGetTexImage(GL_TEXTURE_2D, 0, GL_RGB, GL_UNSIGNED_BYTE, data)
-
-            captureDir = currentProjectDirectory().join('capture')
-            QImage(data, WIDTH, HEIGHT, QImage.Format_RGB888).mirrored(False, True).save(captureDir.join('dump_%s_%05d.%s' % (FPS, int(self._timer.beatsToSeconds(self._timer.start) * FPS) + frame, FMT)))
-        progress.close()
-
         convertCaptureDir = currentProjectDirectory().join('convertcapture')
         convertCaptureDir.ensureExists(isFolder=True)
 
+        sound = self.timeSlider.soundtrackPath()
+        firstFrame = int(self._timer.beatsToSeconds(self._timer.start) * FPS)
+        self.__sceneView.makeCurrent()
+        useFFmpeg = toFFmpeg.isChecked()
+        sink = None
+        if useFFmpeg:
+            try:
+                sink = FFmpegSink(WIDTH, HEIGHT, FPS, convertCaptureDir.join('output.mp4'), FFMPEG_PATH,
+                                  sound, -self._timer.beatsToSeconds(self._timer.start))
+            except OSError as e:
+                QMessageBox.warning(self, 'Could not start ffmpeg', 'Could not start "%s" (%s), recording numbered images instead.' % (FFMPEG_PATH, e))
+                useFFmpeg = False
+                self.__sceneView.makeCurrent()
+        if sink is None:
+            sink = ImageSequenceSink(WIDTH, HEIGHT, captureDir.join('dump_%s_%%05d.%s' % (FPS, FMT)))
+        capture = FrameCapture(WIDTH, HEIGHT, sink)
+        try:
+            self.__recordFrames(capture, duration, FPS, WIDTH, HEIGHT, flooredStart, firstFrame)
+        except (IOError, OSError) as e:
+            # e.g. ffmpeg quit
+            capture.abort()
+            QMessageBox.critical(self, 'Recording failed', str(e))
+            return
+        except Exception:
+            capture.abort()
+            raise
+
+        if useFFmpeg:
+            # already encoded, no conversion scripts needed
+            return
+
         with convertCaptureDir.join('convert.bat').edit() as fh:
             start = ''
             start2 = ''
@@ -332,7 +347,6 @@ class App(QMainWindowState):
             fh.write('cd "../capture"\n"{}" -framerate {} {}{}-i dump_{}_%%05d.{} -vf "fps={},scale={}:-1:flags=lanczos,palettegen" palette.png\n'.format(FFMPEG_PATH, FPS, start, iln, FPS, FMT, FPS, HEIGHT))
             fh.write('"{}" -framerate {} {}-i dump_{}_%%05d.{} -i "palette.png" -filter_complex "fps=12,scale=360:-1:flags=lanczos[x];[x][1:v]paletteuse" {}-r {} "../convertcapture/output.gif"'.format(FFMPEG_PATH, FPS, start, FPS, FMT, start2, FPS))
 
-        sound = self.timeSlider.soundtrackPath()
         if not sound:
             return
 
@@ -396,8 +410,105 @@ class App(QMainWindowState):
         self.__sceneView.saveCameraData()
         self.__shotsManager.saveAllShots()
         self._timer.saveState()
+        if gSettings.value('ExportOnSave', '0') == '1':
+            self.__exportPlayerData()
         QMessageBox.information(self, 'Save succesful!', 'Animation, shot & timing changes have been saved.')
 
+    def __recordFrames(self, capture, duration, FPS, WIDTH, HEIGHT, flooredStart, firstFrame):
+        """
+        Render and capture every frame of the loop range, stops early when canceled.
+        """
+        progress = QProgressDialog(self)
+        try:
+            progress.setMaximum(int(duration * FPS))
+            prevFrame = 0
+            lastEvents = 0.0
+            for frame in range(int(duration * FPS)):
+                deltaTime = (frame - prevFrame) / float(FPS)
+                prevFrame = frame
+                # keep the UI responsive without paying for an event loop iteration every frame
+                if time.time() - lastEvents > 0.1:
+                    lastEvents = time.time()
+                    progress.setValue(frame)
+                    QApplication.processEvents()
+                    if progress.wasCanceled():
+                        break
+                    self.__sceneView.makeCurrent()
+                beats = flooredStart + self._timer.secondsToBeats(frame / float(FPS))
+
+                shot = self.__shotsManager.shotAtTime(beats)
+                if shot is None:
+                    capture.skip(firstFrame + frame)
+                    continue
+                sceneFile = currentScenesDirectory().join(shot.sceneName).ensureExt(SCENE_EXT)
+                scene = Scene.getScene(sceneFile)
+                scene.setSize(WIDTH, HEIGHT)
+
+                uniforms = self.__shotsManager.evaluate(beats)
+                textureUniforms = self.__shotsManager.additionalTextures(beats)
+                self.__sceneView._cameraInput.setData(*(uniforms['uOrigin'] + uniforms['uAngles']))  # feed animation into camera so animationprocessor can read it again
+                cameraData = self.__sceneView._cameraInput.data()
+
+                projectScript('animationprocessor.py').run(globals(), locals())
+
+                for name in self.__sceneView._textures:
+                    uniforms[name] = self.__sceneView._textures[name]._id
+
+                scene.drawToScreen(self._timer.beatsToSeconds(beats), beats, uniforms, (0, 0, WIDTH, HEIGHT), textureUniforms)
+                capture.capture(scene.colorBuffers[-1][0], firstFrame + frame)
+            capture.finish()
+        finally:
+            progress.close()
+
+    def __exportSettings(self):
+        diag = QDialog()
+        diag.setWindowTitle('Export settings')
+        layout = QGridLayout()
+        diag.setLayout(layout)
+        layout.addWidget(QLabel('Max error, 0 exports channels unchanged'), 0, 0, 1, 3)
+        layout.addWidget(QLabel('Quantize'), 1, 1)
+        layout.addWidget(QLabel('Reduce keys'), 1, 2)
+        inputs = []
+        for row, (label, kind) in enumerate((('Camera', 'camera'), ('Color', 'color'), ('Other', 'other'))):
+            layout.addWidget(QLabel(label), row + 2, 0)
+            for column, settings in enumerate((quantize.SETTINGS, keyreduce.SETTINGS)):
+                tolerance = QDoubleSpinBox()
+                tolerance.setDecimals(6)
+                tolerance.setRange(0.0, 100.0)
+                tolerance.setSingleStep(0.0001)
+                tolerance.setSpecialValueText('Off')
+                tolerance.setValue(float(gSettings.value(settings[kind], 0.0)))
+                layout.addWidget(tolerance, row + 2, column + 1)
+                inputs.append((settings[kind], tolerance))
+        ok = QPushButton('Ok')
+        ok.clicked.connect(diag.accept)
+        cancel = QPushButton('Cancel')
+        cancel.clicked.connect(diag.reject)
+        layout.addWidget(ok, 5, 1)
+        layout.addWidget(cancel, 5, 2)
+        diag.exec_()
+        if diag.result() != QDialog.Accepted:
+            return
+        for key, tolerance in inputs:
+            gSettings.setValue(key, tolerance.value())
+
+    def __exportPlayerData(self):
+        if currentProjectFilePath() is None:
+            return
+        if self.__exportCache is None:
+            self.__exportCache = generate.createCache()
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            changed = generate.export(self.__exportCache)
+        except Exception:
+            # start over with the manifest on disk next time
+            self.__exportCache = None
+            QMessageBox.critical(self, 'Export failed', traceback.format_exc())
+            return
+        finally:
+            QApplication.restoreOverrideCursor()
+        self.__statusBar.showMessage('Exported %s' % generate.generatedPath() if changed else 'Player data is up to date', 5000)
+
     def closeEvent(self, event):
         res = QMessageBox.question(self, 'Save before exit?', 'Do you want to save?', QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel)
         if res == QMessageBox.Cancel:
@@ -420,8 +531,10 @@ class App(QMainWindowState):
 
     def __openProject(self, path):
         setCurrentProjectFilePath(FilePath(path))
+        self.__exportCache = None
         self.__sceneList.projectOpened()
         self.__shotsManager.projectOpened()
+        self.__prefetcher.reset()
         self._timer.projectOpened()
 
     def __initializeProject(self):
@@ -252,3 +252,44 @@ class EditKeyAction(QUndoCommand):
     def undo(self):
         for i, key in enumerate(self.__keys):
             self.__set(key, self.__oldValues[i])
+
+
+def _tangentState(key):
+    return key.tangentMode, key.tangentBroken, Vec2(key.inTangent), Vec2(key.outTangent)
+
+
+def _setTangentState(key, state):
+    key.restoreTangents(*state)
+
+
+class SimplifyAction(QUndoCommand):
+    """
+    Deletes keys that the given curves can do without, see Curve.simplify().
+    """
+
+    def __init__(self, curves, tolerance):
+        super(SimplifyAction, self).__init__('SimplifyCurves')
+        self.__curves = curves
+        self.__tolerance = tolerance
+        self.__before = [[(key, _tangentState(key)) for key in curve] for curve in curves]
+        self.__after = None
+        self.__deleted = []
+
+    def redo(self):
+        if self.__after is None:
+            for curve in self.__curves:
+                self.__deleted += curve.simplify(self.__tolerance)
+            self.__after = [[(key, _tangentState(key)) for key in curve] for curve in self.__curves]
+            return
+        for key in self.__deleted:
+            key.delete()
+        for states in self.__after:
+            for key, state in states:
+                _setTangentState(key, state)
+
+    def undo(self):
+        for key in self.__deleted:
+            key.reInsert()
+        for states in self.__before:
+            for key, state in states:
+                _setTangentState(key, state)
@@ -24,8 +24,8 @@ class Key(object):
 
     def clone(self, parent):
         k = self.__class__(self.time(), self.value(), parent)
-        k.__inTangent = Vec2(self.inTangent)
-        k.__outTangent = Vec2(self.outTangent)
+        k.inTangent = Vec2(self.inTangent)
+        k.outTangent = Vec2(self.outTangent)
         k.__tangentBroken = self.tangentBroken
         k.__tangentMode = self.tangentMode
         return k
@@ -49,6 +49,15 @@ class Key(object):
         self.__tangentMode = tangentMode
         self.updateTangents()
 
+    def restoreTangents(self, tangentMode, tangentBroken, inTangent, outTangent):
+        """
+        Set all tangent state at once, without computing tangents from the mode, e.g. to undo an edit.
+        """
+        self.__tangentMode = tangentMode
+        self.__tangentBroken = tangentBroken
+        self.inTangent = Vec2(inTangent)
+        self.outTangent = Vec2(outTangent)
+
     def updateTangents(self):
         if self.__tangentMode == Key.TANGENT_USER:
             return
@@ -121,7 +130,7 @@ class Curve(object):
     def deleteKey(self, key):
         idx = self.__keys.index(key)
         self.__keys.pop(idx)
-        if idx != 1 and len(self.__keys):
+        if idx != 0 and len(self.__keys):
             self.__keys[idx - 1].updateTangents()
         if idx != len(self.__keys):
             self.__keys[idx].updateTangents()
@@ -290,6 +299,81 @@ class Curve(object):
                 break
         self.__keys = self.__keys[max(startIdx, 0):min(endIdx, len(self.__keys))]
 
+    def __fitSegment(self, idx, original, tolerance, samplesPerSegment):
+        """
+        Tangents for a segment from key idx - 1 to key idx + 1 that follows the original curve,
+        or None if no such segment stays within tolerance.
+        """
+        a = self.__keys[idx - 1]
+        b = self.__keys[idx + 1]
+        dt = b.time() - a.time()
+        # enough samples to see every original key in between
+        numSamples = samplesPerSegment * (1 + sum(1 for key in original if a.time() < key.time() < b.time()))
+        samples = []
+        for i in range(numSamples):
+            t = (i + 0.5) / numSamples
+            samples.append((t, original.evaluate(a.time() + t * dt)))
+
+        y0 = a.value()
+        dy = b.value() - y0
+        if a.outTangent.y == float('inf'):
+            # stepped, keeps the value of a until b
+            if all(abs(value - y0) <= tolerance for t, value in samples):
+                return a.outTangent.y, b.inTangent.y
+            return None
+
+        # the segment is linear in its tangents, least squares fit on the samples
+        saa = sab = sbb = sar = sbr = 0.0
+        for t, value in samples:
+            basisA = t * t * t - 2.0 * t * t + t
+            basisB = t * t * t - t * t
+            residual = value - y0 - dy * (3.0 * t * t - 2.0 * t * t * t)
+            saa += basisA * basisA
+            sab += basisA * basisB
+            sbb += basisB * basisB
+            sar += basisA * residual
+            sbr += basisB * residual
+        det = saa * sbb - sab * sab
+        if abs(det) < 1e-12:
+            p1 = p2 = dy
+        else:
+            p1 = (sar * sbb - sbr * sab) / det
+            p2 = (sbr * saa - sar * sab) / det
+
+        for t, value in samples:
+            fit = y0 + dy * (3.0 * t * t - 2.0 * t * t * t) + p1 * (t * t * t - 2.0 * t * t + t) + p2 * (t * t * t - t * t)
+            if abs(fit - value) > tolerance:
+                return None
+        return p1, p2
+
+    def simplify(self, tolerance, samplesPerSegment=16):
+        """
+        Delete keys for as long as the curve stays within tolerance of the curve as it was.
+        The keys around a deleted key get user tangents, fitted to the original curve.
+        The first and last key are kept.
+        Returns the deleted keys.
+        """
+        original = self.clone()
+        deleted = []
+        idx = 1
+        while idx < len(self.__keys) - 1:
+            tangents = self.__fitSegment(idx, original, tolerance, samplesPerSegment)
+            if tangents is None:
+                idx += 1
+                continue
+            a = self.__keys[idx - 1]
+            b = self.__keys[idx + 1]
+            # user tangents first, so nothing is recomputed when the key goes
+            for key in (a, b):
+                key.tangentMode = Key.TANGENT_USER
+                key.tangentBroken = True
+            deleted.append(self.__keys[idx])
+            self.deleteKey(self.__keys[idx])
+            dt = b.time() - a.time()
+            a.outTangent = Vec2(dt, tangents[0])
+            b.inTangent = Vec2(dt, tangents[1])
+        return deleted
+
     def evaluate(self, time):
         """
         Hermite spline interpolation at the given time.
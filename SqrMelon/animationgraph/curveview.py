@@ -14,7 +14,7 @@ from mathutil import Vec2
 
 from animationgraph.curvedata import Curve
 from animationgraph.curveselection import Selection, MarqueeSelectAction
-from animationgraph.curveactions import InsertKeyAction, SetKeyAction, DeleteAction, DragAction, EditKeyAction
+from animationgraph.curveactions import InsertKeyAction, SetKeyAction, DeleteAction, DragAction, EditKeyAction, SimplifyAction
 from animationgraph.viewactions import CameraFrameAction, CameraPanAction, CameraZoomAction, CameraUndoCommand
 
 
@@ -795,6 +795,9 @@ class CurveEditor(QWidget):
         self.__pasteAction.triggered.connect(self.__pasteChannels)
         self.__pasteOverAction = self.__channelMenu.addAction('Paste into selected channel')
         self.__pasteOverAction.triggered.connect(self.__pasteSelectedChannel)
+        self.__channelMenu.addSeparator()
+        self.__simplifyAction = self.__channelMenu.addAction('Reduce keys in selected channel(s)')
+        self.__simplifyAction.triggered.connect(self.__simplifySelectedChannels)
         self.__clipboard = []
 
     def __copySelectedChannels(self):
@@ -828,8 +831,20 @@ class CurveEditor(QWidget):
         self.__view.undoStacks()[0].clear()
         self.setShot(self.__shot)
 
+    def __simplifySelectedChannels(self):
+        tolerance, ok = QInputDialog.getDouble(self, 'Reduce keys', 'Max difference with the current curve',
+                                               float(gSettings.value('KeyReduceTolerance', 0.001)), 0.0, 1000.0, 4)
+        if not ok:
+            return
+        gSettings.setValue('KeyReduceTolerance', tolerance)
+        curves = [self.__model.itemFromIndex(idx).data() for idx in self.__channels.selectedIndexes()]
+        # deleted keys can not stay selected
+        self.__view.deselectAll()
+        self.undoStacks()[0].push(SimplifyAction(curves, tolerance))
+
     def __channelContextMenu(self, pos):
         self.__copyAction.setEnabled(bool(len(self.__channels.selectedIndexes())))
+        self.__simplifyAction.setEnabled(bool(len(self.__channels.selectedIndexes())))
         self.__pasteAction.setEnabled(bool(self.__clipboard))
         self.__pasteOverAction.setEnabled(len(self.__clipboard) == 1 and len(self.__channels.selectedIndexes()) == 1)
         self.__channelMenu.popup(self.__channels.mapToGlobal(pos))
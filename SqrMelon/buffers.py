@@ -2,8 +2,10 @@
 Utility that wraps OpenGL textures, frame buffers and render buffers.
 """
 from pycompat import *
+import ctypes
 import contextlib
 from OpenGL.GL import *
+from glstate import gGLState
 
 
 class Texture(object):
@@ -16,6 +18,7 @@ class Texture(object):
     """
     R8 = GL_R8, GL_RED, GL_UNSIGNED_BYTE
     R8_SNORM = GL_R8_SNORM, GL_RED, GL_BYTE
+    R16 = GL_R16, GL_RED, GL_UNSIGNED_SHORT
     R16F = GL_R16F, GL_RED, GL_HALF_FLOAT, GL_FLOAT
     R32F = GL_R32F, GL_RED, GL_FLOAT
     R8UI = GL_R8UI, GL_RED_INTEGER, GL_UNSIGNED_BYTE
@@ -102,7 +105,12 @@ class Texture(object):
         return self._id
 
     def use(self):
-        glBindTexture(GL_TEXTURE_2D, self._id)
+        gGLState.bindTexture(GL_TEXTURE_2D, self._id)
+
+    def delete(self):
+        glDeleteTextures([self._id])
+        gGLState.forgetTexture(self._id)
+        self._id = 0
 
     def width(self):
         return self._width
@@ -111,31 +119,61 @@ class Texture(object):
         return self._height
 
     def save(self, filePath, ch=None):
+        _encode(self._readback(filePath, ch), filePath)
+
+    def _readback(self, filePath, ch=None):
+        """
+        Read the pixels back in the layout the file is written in.
+        Returns bytes for .r32 heightfields and a QImage otherwise.
+        """
         self.use()
         if filePath.hasExt('.r32'):
-            import struct
-            # heightfield export
-            pixels = self._width * self._height
-            buffer = (ctypes.c_float * pixels)()
+            # heightfield export, the raw floats are the file
+            buffer = (ctypes.c_float * (self._width * self._height))()
             glGetTexImage(GL_TEXTURE_2D, 0, GL_RED, GL_FLOAT, buffer)
-            with filePath.edit(flag='wb') as fh:
-                fh.write(struct.pack('%sf' % pixels, *buffer))
-            return
-        from qtutil import QImage, qt_wrapper
-        pixels = self._width * self._height
-        buffer = (ctypes.c_ubyte * (pixels * 4))()
-        mirror = (ctypes.c_ubyte * (pixels * 4))()
-        glGetTexImage(GL_TEXTURE_2D, 0, GL_RGBA, GL_UNSIGNED_BYTE, buffer)
-        for y in range(self._height):
-            for x in range(self._width):
-                y2 = self._height -1 - y
-                i = (x + y * self._width) * 4
-                i2 = (x + y2 * self._width) * 4
-                if ch is None:
-                    mirror[i2:i2 + 4] = (buffer[i + 2], buffer[i + 1], buffer[i], buffer[i + 3])
-                else:
-                    mirror[i2:i2 + 4] = (buffer[i + ch], buffer[i + ch], buffer[i + ch], 255)
-        QImage(mirror, self._width, self._height, QImage.Format_ARGB32).save(filePath)
+            return buffer
+        from qtutil import QImage, qRgb
+        glPixelStorei(GL_PACK_ALIGNMENT, 4)
+        if ch is None:
+            # BGRA bytes are exactly what QImage.Format_ARGB32 stores, so GL does the swizzle for us
+            buffer = (ctypes.c_ubyte * (self._width * self._height * 4))()
+            glGetTexImage(GL_TEXTURE_2D, 0, GL_BGRA, GL_UNSIGNED_BYTE, buffer)
+            image = QImage(buffer, self._width, self._height, QImage.Format_ARGB32)
+        else:
+            # single channel, rows are 4 byte aligned both in GL and QImage
+            stride = (self._width + 3) & ~3
+            buffer = (ctypes.c_ubyte * (stride * self._height))()
+            glGetTexImage(GL_TEXTURE_2D, 0, (GL_RED, GL_GREEN, GL_BLUE, GL_ALPHA)[ch], GL_UNSIGNED_BYTE, buffer)
+            image = QImage(buffer, self._width, self._height, stride, QImage.Format_Indexed8)
+            image.setColorTable([qRgb(i, i, i) for i in range(256)])
+            image = image.convertToFormat(QImage.Format_RGB32)
+        # GL rows start at the bottom, mirrored() also copies the pixels so buffer can go
+        return image.mirrored(False, True)
+
+
+def _encode(data, filePath):
+    if filePath.hasExt('.r32'):
+        with filePath.edit(flag='wb') as fh:
+            fh.write(data)
+        return
+    data.save(filePath)
+
+
+def saveTextures(textures, workers=4):
+    """
+    Save multiple textures, reading back on the calling thread, which must own the GL context,
+    and encoding the files in parallel.
+
+    :param list[(Texture, FilePath, int)] textures: Texture, destination and channel (None for all channels), see Texture.save().
+    """
+    from multiprocessing.pool import ThreadPool
+    jobs = [(texture._readback(filePath, ch), filePath) for texture, filePath, ch in textures]
+    pool = ThreadPool(workers)
+    try:
+        pool.map(lambda job: _encode(*job), jobs)
+    finally:
+        pool.close()
+        pool.join()
 
 
 class Texture3D(object):
@@ -157,7 +195,12 @@ class Texture3D(object):
             glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
 
     def use(self):
-        glBindTexture(GL_TEXTURE_3D, self._id)
+        gGLState.bindTexture(GL_TEXTURE_3D, self._id)
+
+    def delete(self):
+        glDeleteTextures([self._id])
+        gGLState.forgetTexture(self._id)
+        self._id = 0
 
     def width(self):
         return self._width
@@ -193,7 +236,7 @@ class Cubemap(object):
         return self.__id
 
     def use(self):
-        glBindTexture(GL_TEXTURE_CUBE_MAP, self.__id)
+        gGLState.bindTexture(GL_TEXTURE_CUBE_MAP, self.__id)
 
     def size(self):
         return self.__size
@@ -273,27 +316,35 @@ class FrameBuffer(object):
         return self.__height
 
     def use(self, soft=False):
-        glBindFramebuffer(GL_FRAMEBUFFER, self.__id)
+        gGLState.bindFramebuffer(self.__id)
         if soft:
             return
-        glDrawBuffers(len(self.__buffers), self.__buffers)
-        glViewport(0, 0, self.__width, self.__height)
+        gGLState.drawBuffers(self.__buffers)
+        gGLState.viewport(0, 0, self.__width, self.__height)
 
     @contextlib.contextmanager
     def useInContext(self, screenSize, soft=False):
         self.use(soft)
         yield
         FrameBuffer.clear()
-        glViewport(0, 0, *screenSize)
+        gGLState.viewport(0, 0, *screenSize)
 
     @staticmethod
     def clear():
         from sceneview3d import SceneView
-        glBindFramebuffer(GL_FRAMEBUFFER, SceneView.screenFBO)
+        gGLState.bindFramebuffer(SceneView.screenFBO)
 
     def id(self):
         return self.__id
 
+    def delete(self):
+        """
+        Deletes the frame buffer object, attachments are owned by the caller.
+        """
+        glDeleteFramebuffers(1, [self.__id])
+        gGLState.forgetFramebuffer(self.__id)
+        self.__id = 0
+
     def addTexture(self, texture):
         # TODO: check if given texture has right channels (depth, rgba, depth-stencil), etc
         assert (texture.width() == self.__width)
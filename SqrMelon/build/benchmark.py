@@ -0,0 +1,127 @@
+"""
+Times the export pools on a synthetic project, run with:
+
+    python build/benchmark.py [numShots]
+
+The synthetic project has numShots shots (50 by default) with camera and material channels,
+some of which are copies of other shots, like in a real demo.
+Sequences are added to a FloatPool and to a ReferenceFloatPool using the original nextSubList & rMatch scans,
+to compare the time spent and the resulting gFloatData size. Last the size of the layout
+found by the compacting export stage is shown.
+"""
+import os
+import sys
+import time
+import random
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pycompat import *
+from build.generate import FloatPool, compactLayout
+
+CHANNELS = ['uOrigin.x', 'uOrigin.y', 'uOrigin.z', 'uAngles.x', 'uAngles.y', 'uAngles.z',
+            'uColor.x', 'uColor.y', 'uColor.z', 'uFade', 'uSpeed', 'uSeed']
+
+
+class ReferenceFloatPool(object):
+    """
+    FloatPool as it used to be, scanning the whole pool for every sequence.
+    """
+
+    def __init__(self):
+        self.data = []
+
+    @staticmethod
+    def nextSubList(mainList, subList, offset=0):
+        n = len(subList)
+        for i in range(offset, len(mainList) - n + 1):
+            if mainList[i:i + n] == subList:
+                return i
+        return -1
+
+    @staticmethod
+    def rMatch(mainList, subList):
+        # returns N where the last N items of mainList match the first N items of subList
+        n = len(subList)
+        n1 = len(mainList)
+        if n1 >= n and mainList[-n:] == subList:
+            return n
+        if n1 < n:
+            if mainList == subList[:n1]:
+                return n1
+            return 0
+        for i in range(n - 1, -1, -1):
+            if mainList[-i:] == subList[:i]:
+                return i
+        return 0
+
+    def addFloats(self, values):
+        idx = ReferenceFloatPool.nextSubList(self.data, values)
+        if idx != -1:
+            return idx
+        idx = ReferenceFloatPool.rMatch(self.data, values)
+        out = len(self.data) - idx
+        if idx != len(values):
+            self.data.extend(values[idx:])
+        return out
+
+
+def syntheticChannel(rand, numKeys):
+    # 4 floats per key like the export: time, in tangent, value, out tangent
+    data = []
+    beat = 0.0
+    value = rand.choice((0.0, 1.0, 0.5))
+    for i in range(numKeys):
+        beat += rand.choice((0.5, 1.0, 2.0, 4.0))
+        value = round(value + rand.uniform(-2.0, 2.0), 2)
+        tangent = rand.choice((0.0, 0.0, round(rand.uniform(-1.0, 1.0), 2)))
+        data += [beat, tangent, value, tangent]
+    return data
+
+
+def syntheticSequences(numShots, seed=0):
+    rand = random.Random(seed)
+    shots = []
+    for i in range(numShots):
+        if shots and rand.random() < 0.2:
+            # duplicated shot
+            shots.append(list(rand.choice(shots)))
+            continue
+        shot = []
+        for channel in CHANNELS:
+            if channel.startswith('uColor') or channel in ('uSpeed', 'uSeed'):
+                # mostly constant
+                shot.append([0.0, 0.0, rand.choice((0.0, 1.0, 0.25)), 0.0])
+            else:
+                shot.append(syntheticChannel(rand, rand.randint(2, 40)))
+        shots.append(shot)
+    return [channel for shot in shots for channel in shot]
+
+
+def measure(pool, sequences):
+    start = time.time()
+    for values in sequences:
+        offset = pool.addFloats(values)
+        assert pool.data[offset:offset + len(values)] == values
+    return time.time() - start
+
+
+def main(numShots=50):
+    sequences = syntheticSequences(numShots)
+    print('%s shots, %s sequences, %s floats requested' % (numShots, len(sequences), sum(len(values) for values in sequences)))
+    for name, pool in (('reference', ReferenceFloatPool()), ('indexed', FloatPool())):
+        seconds = measure(pool, sequences)
+        print('%-10s %8.3fs %8s floats' % (name, seconds, len(pool.data)))
+
+    start = time.time()
+    layout = compactLayout(pool)
+    seconds = time.time() - start
+    compact = FloatPool()
+    compact.seed(layout)
+    measure(compact, sequences)
+    assert len(compact.data) == len(layout)
+    print('%-10s %8.3fs %8s floats' % ('compact', seconds, len(layout)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,171 @@
+"""
+Results of the slow export steps, stored by hash of their input in a JSON manifest next to generated.hpp.
+
+Shader files map to their optimized text, scene and template files map to the data the export reads from them,
+so an export after editing one file only optimizes and parses that file again.
+"""
+import os
+import json
+import hashlib
+import multiprocessing
+from collections import OrderedDict
+from pycompat import *
+from build.codeoptimize import optimizeText
+from fileutil import FilePath
+from util import expandXMLIncludes, parseXMLText
+
+# bump when the records below change
+VERSION = 1
+
+
+def contentHash(text):
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).hexdigest()
+
+
+def templateRecord(xTemplate):
+    """
+    :returns: A list of passes, each pass is [attributes, sections], each section is [tag, path, uniforms]
+    and each uniform is [name, values].
+    """
+    passes = []
+    for xPass in xTemplate:
+        sections = []
+        for xSection in xPass:
+            uniforms = []
+            for xUniform in xSection:
+                uniforms.append([xUniform.attrib['name'], [float(x.strip()) for x in xUniform.attrib['value'].split(',')]])
+            sections.append([xSection.tag, xSection.attrib['path'], uniforms])
+        passes.append([dict(xPass.attrib), sections])
+    return passes
+
+
+def sceneRecord(xScene):
+    """
+    :returns: A dict with the template path and the enabled shots, each shot is [start, end, channels],
+    each channel is [name, keyframes] with the 4 floats per key the player uses.
+    """
+    shots = []
+    for xShot in xScene:
+        if xShot.attrib.get('enabled', 'True') == 'False':
+            continue
+        channels = []
+        for xChannel in xShot:
+            keyframes = []
+            if xChannel.text:
+                for i, v in enumerate(float(v.strip()) for v in xChannel.text.split(',')):
+                    j = i % 8
+                    if j == 0 or j == 4 or j > 5:
+                        continue
+                    if j == 5:  # out tangent y
+                        if v == float('inf'):  # stepped tangents are implemented as out tangentY = positive infinity
+                            v = 'FLT_MAX'
+                    keyframes.append(v)
+                assert len(keyframes) / 4.0 == int(len(keyframes) / 4), len(keyframes)
+            channels.append([xChannel.attrib['name'], keyframes])
+        shots.append([float(xShot.attrib['start']), float(xShot.attrib['end']), channels])
+    return {'template': xScene.attrib['template'], 'shots': shots}
+
+
+class ExportCache(object):
+    """
+    Call save() after an export, entries that were not used by it are dropped.
+    Files are read and hashed once per export, the cache can be kept for the next export
+    to skip reading the manifest again.
+    """
+    SECTIONS = 'optimized', 'templates', 'scenes'
+
+    def __init__(self, manifestPath):
+        assert isinstance(manifestPath, FilePath)
+        self.__path = manifestPath
+        # optimizer changes invalidate all optimized text
+        self.__optimizer = contentHash(FilePath(os.path.abspath(__file__)).parent().join('codeoptimize.py').content())
+        self.__entries = {section: {} for section in ExportCache.SECTIONS}
+        if manifestPath.exists():
+            try:
+                manifest = json.loads(manifestPath.content())
+            except ValueError:
+                manifest = None
+            if manifest and manifest.get('version') == VERSION and manifest.get('optimizer') == self.__optimizer:
+                for section in ExportCache.SECTIONS:
+                    self.__entries[section] = manifest.get(section, {})
+        self.__used = {section: {} for section in ExportCache.SECTIONS}
+        self.__byPath = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __nextExport(self):
+        # files may change before the next export, keep the results by hash only
+        self.__entries = self.__used
+        self.__used = {section: {} for section in ExportCache.SECTIONS}
+        self.__byPath = {}
+
+    def __fetch(self, section, filePath, readInput, compute):
+        key = section, os.path.abspath(filePath).lower()
+        if key in self.__byPath:
+            return self.__byPath[key]
+        data = readInput(filePath)
+        digest = contentHash(data)
+        if digest in self.__entries[section]:
+            self.hits += 1
+            result = self.__entries[section][digest]
+        else:
+            self.misses += 1
+            result = compute(data)
+        self.__used[section][digest] = result
+        self.__byPath[key] = result
+        return result
+
+    def optimizedText(self, filePath):
+        return self.__fetch('optimized', filePath, FilePath.content, optimizeText)
+
+    def optimizeAll(self, filePaths, processes=None):
+        """
+        Optimize all given files that are not cached yet in parallel, optimizedText() then returns the results.
+        :param int processes: Defaults to the number of CPUs.
+        """
+        # digest to text and the files with that text, in the order given
+        todo = OrderedDict()
+        for filePath in filePaths:
+            key = 'optimized', os.path.abspath(filePath).lower()
+            if key in self.__byPath:
+                continue
+            data = filePath.content()
+            digest = contentHash(data)
+            if digest in self.__entries['optimized']:
+                continue
+            todo.setdefault(digest, (data, set()))[1].add(key)
+        if len(todo) < 2:
+            # not worth starting processes, optimizedText() handles it
+            return
+        pool = multiprocessing.Pool(min(processes or multiprocessing.cpu_count(), len(todo)))
+        try:
+            results = pool.map(optimizeText, [data for data, keys in todo.values()])
+        finally:
+            pool.close()
+            pool.join()
+        for (digest, (data, keys)), result in zip(todo.items(), results):
+            self.__used['optimized'][digest] = result
+            for key in keys:
+                self.misses += 1
+                self.__byPath[key] = result
+
+    def templateRecord(self, templatePath):
+        return self.__fetch('templates', templatePath, expandXMLIncludes, lambda text: templateRecord(parseXMLText(text)))
+
+    def sceneRecord(self, scenePath):
+        return self.__fetch('scenes', scenePath, expandXMLIncludes, lambda text: sceneRecord(parseXMLText(text)))
+
+    def save(self):
+        """
+        Write the manifest if anything changed, the cache is then ready for the next export.
+        """
+        manifest = {'version': VERSION, 'optimizer': self.__optimizer}
+        manifest.update(self.__used)
+        text = json.dumps(manifest, sort_keys=True)
+        self.__nextExport()
+        if self.__path.exists() and self.__path.content() == text:
+            return
+        with self.__path.edit() as fh:
+            fh.write(text)
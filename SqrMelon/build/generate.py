@@ -1,58 +1,184 @@
 import os
 import sys
-import struct
+from bisect import bisect_left
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from pycompat import *
 from build.codeoptimize import optimizeText
 from fileutil import FilePath
-from util import parseXMLWithIncludes, SCENE_EXT, currentScenesDirectory
+from build import sizereport
+from build.exportcache import ExportCache
+from build.keyreduce import KeyReducer
+from build.quantize import Quantizer, tolerancesForAll
+from util import SCENE_EXT, currentScenesDirectory
 
-gAnimEntriesMax = 0.0
 
+class SequenceIndex(object):
+    """
+    A list that only grows at the end, with the positions of every value,
+    so sub lists can be found without comparing at every offset.
+    """
 
-def nextSubList(mainList, subList, offset=0):
-    n = len(subList)
-    for i in range(offset, len(mainList) - n + 1):
-        if mainList[i:i + n] == subList:
-            return i
-    return -1
+    def __init__(self):
+        self.data = []
+        self.positions = {}
 
+    def extend(self, values):
+        for value in values:
+            self.positions.setdefault(value, []).append(len(self.data))
+            self.data.append(value)
 
-def rMatch(mainList, subList):
-    # returns N where the last N items of mainList match the first N items of subList
-    n = len(subList)
-    n1 = len(mainList)
-    if n1 >= n and mainList[-n:] == subList:
-        return n
-    if n1 < n:
-        if mainList == subList[:n1]:
-            return n1
+    def find(self, subList, offset=0):
+        """
+        First index at or after offset where subList is found in data, or -1.
+        """
+        n = len(subList)
+        end = len(self.data) - n
+        if n == 0:
+            return offset if offset <= end else -1
+        # only offsets where the least common value of subList lines up can match
+        anchor = None
+        anchorPositions = None
+        for i, value in enumerate(subList):
+            positions = self.positions.get(value)
+            if positions is None:
+                return -1
+            if anchorPositions is None or len(positions) < len(anchorPositions):
+                anchor = i
+                anchorPositions = positions
+        for j in range(bisect_left(anchorPositions, offset + anchor), len(anchorPositions)):
+            i = anchorPositions[j] - anchor
+            if i > end:
+                break
+            if self.data[i:i + n] == subList:
+                return i
+        return -1
+
+    def tailOverlap(self, subList):
+        """
+        Returns N where the last N items of data match the first N items of subList, the largest N possible.
+        This also finds partial overlaps when data is shorter than subList.
+        """
+        if not subList:
+            return 0
+        n1 = len(self.data)
+        positions = self.positions.get(subList[0], ())
+        # first candidate gives the longest overlap
+        for j in range(bisect_left(positions, n1 - min(len(subList), n1)), len(positions)):
+            p = positions[j]
+            if self.data[p:] == subList[:n1 - p]:
+                return n1 - p
         return 0
-    for i in range(n - 1, -1, -1):
-        if mainList[-i:] == subList[:i]:
-            return i
-    return 0
+
+
+def shortestCommonSuperstring(sequences):
+    """
+    Greedy shortest common superstring: a list that contains every given sequence.
+    Sequences contained in others are dropped, then the pair with the largest overlap is joined
+    until no overlaps are left. Overlaps are found by comparing rolling hashes of prefixes and suffixes.
+    The result only depends on the order of the input.
+    """
+    unique = []
+    seen = set()
+    for sequence in sequences:
+        key = tuple(sequence)
+        if key and key not in seen:
+            seen.add(key)
+            unique.append(key)
+
+    # drop sequences contained in longer ones, sentinels keep matches from spanning two sequences
+    order = sorted(range(len(unique)), key=lambda i: -len(unique[i]))
+    containers = SequenceIndex()
+    kept = []
+    for i in order:
+        if containers.find(list(unique[i])) == -1:
+            containers.extend(unique[i] + (object(),))
+            kept.append(i)
+    kept.sort()
+    pieces = [unique[i] for i in kept]
+
+    # polynomial hashes of every prefix
+    MOD = (1 << 61) - 1
+    BASE = 1000003
+    valueIds = {}
+    prefixHashes = []
+    maxLength = max(len(piece) for piece in pieces) if pieces else 0
+    powers = [1]
+    for i in range(maxLength):
+        powers.append(powers[-1] * BASE % MOD)
+    for piece in pieces:
+        hashes = [0]
+        for value in piece:
+            hashes.append((hashes[-1] * BASE + valueIds.setdefault(value, len(valueIds) + 1)) % MOD)
+        prefixHashes.append(hashes)
+
+    # pieces by prefix, contained pieces are gone so overlaps are shorter than both pieces
+    byPrefix = {}
+    for index, piece in enumerate(pieces):
+        for length in range(1, len(piece)):
+            byPrefix.setdefault((length, prefixHashes[index][length]), []).append(index)
+
+    successor = [None] * len(pieces)
+    overlap = [0] * len(pieces)
+    hasPredecessor = [False] * len(pieces)
+    # first piece of the chain each piece ends, to avoid closing a cycle
+    chainHead = list(range(len(pieces)))
+    chainTail = list(range(len(pieces)))
+    for length in range(maxLength - 1, 0, -1):
+        for a, piece in enumerate(pieces):
+            if successor[a] is not None or len(piece) <= length:
+                continue
+            hashes = prefixHashes[a]
+            suffixHash = (hashes[-1] - hashes[len(piece) - length] * powers[length]) % MOD
+            candidates = byPrefix.get((length, suffixHash))
+            if not candidates:
+                continue
+            for b in candidates:
+                if hasPredecessor[b] or b == chainHead[a] or piece[len(piece) - length:] != pieces[b][:length]:
+                    continue
+                successor[a] = b
+                overlap[b] = length
+                hasPredecessor[b] = True
+                head, tail = chainHead[a], chainTail[b]
+                chainTail[head] = tail
+                chainHead[tail] = head
+                break
+
+    result = []
+    for index in range(len(pieces)):
+        if hasPredecessor[index]:
+            continue
+        while index is not None:
+            result.extend(pieces[index][overlap[index]:])
+            index = successor[index]
+    return result
 
 
 class TextPool(object):
-    def __init__(self):
+    def __init__(self, cache=None):
         self.data = []
         self.keys = []
+        self.__ids = {}
+        # optimizes every file only once, may be shared between pools
+        self.__cache = cache
 
     def addFile(self, filePath):
         assert isinstance(filePath, FilePath)
-        text = optimizeText(filePath.content())
+        if self.__cache is None:
+            text = optimizeText(filePath.content())
+        else:
+            text = self.__cache.optimizedText(filePath)
         return self.addString(text.replace('\n', '\\n\\\n') + '\\n\\0')
 
     def addString(self, value):
         key = value.lower()
         try:
-            return self.keys.index(key)
-        except ValueError:
+            return self.__ids[key]
+        except KeyError:
             self.data.append(value)
             self.keys.append(key)
+            self.__ids[key] = len(self.data) - 1
             return len(self.data) - 1
 
     def serialize(self):
@@ -63,36 +189,48 @@ class TextPool(object):
 
 class ShaderPool(object):
     def __init__(self):
-        self.data = []
+        self._index = SequenceIndex()
+        self.data = self._index.data
         self.offsets = []
+        self.__offsetIds = {}
+        # every sequence asked for by FloatPool and IntPool, to compute a better layout for the next export
+        self.requests = []
+
+    def seed(self, layout):
+        """
+        Start from the given data, requests contained in it are not appended.
+        """
+        assert not self.data
+        self._index.extend(layout)
 
     def _findOrAddStitches(self, stitches):
         # pattern of stitches already exist ?
-        idx = nextSubList(self.data, stitches)
+        idx = self._index.find(stitches)
         if idx != -1:
             return idx
         # match part of stitches at tail ?
-        idx = rMatch(self.data, stitches)
+        idx = self._index.tailOverlap(stitches)
         out = len(self.data) - idx
         if idx != len(stitches):
-            self.data.extend(stitches[idx:])
+            self._index.extend(stitches[idx:])
         return out
 
     def fromStitches(self, stitches):
         assert isinstance(stitches, list)
         idx = self._findOrAddStitches(stitches)
         key = (idx, len(stitches))
-        if key in self.offsets:
-            return self.offsets.index(key)
+        if key in self.__offsetIds:
+            return self.__offsetIds[key]
         self.offsets.append(key)
+        self.__offsetIds[key] = len(self.offsets) - 1
         return len(self.offsets) - 1
 
-    def serialize(self):
+    def serialize(self, session):
         yield 'GLuint gPrograms[%s];\n' % len(self.offsets)
         flat = []
         for offset in self.offsets:
             flat += [offset[1], offset[0]]
-        cursor = ints.addInts(flat)
+        cursor = session.ints.addInts(flat)
         yield '__forceinline void TickLoader(int, int);\n'
         yield '__forceinline void initPrograms(int width, int height)\n{\n'
         yield '\tint i = 0;\n'
@@ -112,29 +250,32 @@ class FrameBufferPool(object):
     def __init__(self):
         self.data = []
         self.keys = []
+        self.__ids = {}
+        # index of the first texture of every frame buffer
+        self.__firstTexture = []
+        self.__numTextures = 0
 
     def hasData(self):
         return self.data
 
     def add(self, index, numOutputs, width, height, factor, static, is3d):
-        if index in self.keys:
-            idx = self.keys.index(index)
+        if index in self.__ids:
+            idx = self.__ids[index]
             assert self.data[idx] == (numOutputs, width, height, factor, static, is3d), '%s != %s' % (self.data[idx], (numOutputs, width, height, factor, static, is3d))
             return idx
         else:
             self.data.append((numOutputs, width, height, factor, static, is3d))
             self.keys.append(index)
+            self.__ids[index] = len(self.keys) - 1
+            self.__firstTexture.append(self.__numTextures)
+            self.__numTextures += numOutputs
         return len(self.keys) - 1
 
     def textureId(self, frameBuffer, localOutput):
-        frameBuffer = self.keys.index(frameBuffer)
-        cursor = 0
-        for i, data in enumerate(self.data):
-            if i == frameBuffer:
-                return cursor + localOutput, self.data[frameBuffer][-1]
-            cursor += data[0]
+        frameBuffer = self.__ids[frameBuffer]
+        return self.__firstTexture[frameBuffer] + localOutput, self.data[frameBuffer][-1]
 
-    def serialize(self):
+    def serialize(self, session):
         allData = []
         totalTextures = 0
         for data in self.data:
@@ -147,11 +288,11 @@ class FrameBufferPool(object):
             totalTextures += int(data[0])
 
         if allData:
-            global gFrameBufferData
-            gFrameBufferData = ints.addInts(allData)
+            session.frameBufferData = session.ints.addInts(allData)
             yield 'GLuint gTextures[%s];\n' % totalTextures
             yield 'GLuint gFrameBuffers[%s];\n' % (len(self.data) + 1)
             yield 'GLuint* gFrameBufferColorBuffers[%s];\n' % (len(self.data) + 1)
+        gFrameBufferData = session.frameBufferData
         yield '\n\n__forceinline void widthHeight(int i, int width, int height, int& w, int& h)\n{\n'
         if allData:
             yield '\tw = gIntData[i * %s + %s];\n' % (FrameBufferPool.BLOCK_SIZE, gFrameBufferData + 1)
@@ -195,18 +336,22 @@ class PassPool(object):
     def __init__(self):
         self.data = []
         self.data2 = []
+        self.__ids = {}
 
     def add(self, programId, buffer, inputs, uniforms):
         v = (programId, buffer + 1, inputs, uniforms)
+        # inputs and uniforms are not hashable, uniforms compare regardless of order
+        key = (programId, buffer + 1, tuple(inputs), tuple(sorted(uniforms.items())))
         try:
-            idx = self.data.index(v)
-            return idx
-        except ValueError:
+            return self.__ids[key]
+        except KeyError:
             n = len(self.data)
             self.data.append(v)
+            self.__ids[key] = n
             return n
 
-    def serialize(self):
+    def serialize(self, session):
+        framebuffers = session.framebuffers
         yield '\n\n__forceinline void applyUniform(int dataSize, GLint uniformLocation, const float* dataHandle)\n{\n'
         yield '\tswitch(dataSize)\n\t{\n'
         yield '\tcase 1:\n'
@@ -229,8 +374,7 @@ class PassPool(object):
         flat = []
         for x in self.data:
             flat += [x[0], x[1]]
-        global gPassProgramsAndTargets
-        gPassProgramsAndTargets = ints.addInts(flat)
+        gPassProgramsAndTargets = session.passProgramsAndTargets = session.ints.addInts(flat)
         maxConstUniforms = max(len(x[3]) for x in self.data)
         maxInputs = max(len(x[2]) for x in self.data)
         constUniformData = []
@@ -248,12 +392,11 @@ class PassPool(object):
                 inputData.extend(framebuffers.textureId(*tex))
             inputData += [0] * ((maxInputs - len(entry[2])) * 2)
         if constUniformData:
-            global gPassConstUniforms
-            gPassConstUniforms = ints.addInts(constUniformData)
-        global gPassInputs
-        gPassInputs = ints.addInts(inputData)
+            session.passConstUniforms = session.ints.addInts(constUniformData)
+        gPassConstUniforms = session.passConstUniforms
+        gPassInputs = session.passInputs = session.ints.addInts(inputData)
         yield '__forceinline bool bindPass(int passIndex, float seconds, float beats, int width, int height, bool isPrecalcStep)\n{\n'
-        global gFrameBufferData
+        gFrameBufferData = session.frameBufferData
         if framebuffers.hasData():
             yield '\tint frameBufferId = gIntData[passIndex * 2 + %s] - 1;\n' % (gPassProgramsAndTargets + 1)
             yield '\tif(frameBufferId < 0)\n\t{\n'
@@ -301,26 +444,23 @@ class PassPool(object):
         yield '}\n'
 
 
-def roundb(value, bits):
-    # Truncation utility from: http://www.ctrl-alt-test.fr/?p=535
-    if value == 'FLT_MAX':
-        # cheat to work around constant used by stepped tangents
-        return value
-    if bits >= 32:
-        return value
-    bits = 32 - bits
-    num = struct.unpack('i', struct.pack('f', value))[0]
-    num = (num + (1 << (bits - 1))) & (-1 << bits)
-    return struct.unpack('f', struct.pack('i', num))[0]
+class FloatOffset(int):
+    """
+    Offset into gFloatData that remembers its values, so int requests holding it can be moved to another float layout.
+    """
+
+    def __new__(cls, offset, values):
+        self = int.__new__(cls, offset)
+        self.values = values
+        return self
 
 
 class FloatPool(ShaderPool):
-    def addFloats(self, values, name=None):  # name may be used to selectively use roundb()
-        # truncate floats
-        values = [roundb(v, 32) for v in values]
+    def addFloats(self, values):
+        self.requests.append(values)
         offset = self._findOrAddStitches(values)
         assert self.data[offset:offset + len(values)] == values
-        return offset
+        return FloatOffset(offset, values)
 
     def serialize(self):
         data = [(str(x) + 'f' if x != 'FLT_MAX' else x) for x in self.data]
@@ -329,6 +469,7 @@ class FloatPool(ShaderPool):
 
 class IntPool(ShaderPool):
     def addInts(self, values):
+        self.requests.append(values)
         offset = self._findOrAddStitches(values)
         assert self.data[offset:offset + len(values)] == values
         return offset
@@ -337,190 +478,242 @@ class IntPool(ShaderPool):
         yield 'const int gIntData[] = {%s};\n' % ', '.join(str(int(x)) for x in self.data)
 
 
-text = TextPool()
-shaders = ShaderPool()
-framebuffers = FrameBufferPool()
-passes = PassPool()
-floats = FloatPool()
-ints = IntPool()
+def compactLayout(pool):
+    """
+    Layout for the next export that holds every sequence requested from the pool,
+    the superstring of all requests unless the pool as it was filled is smaller.
+    """
+    layout = shortestCommonSuperstring(pool.requests)
+    if len(layout) < len(pool.data):
+        return layout
+    return list(pool.data)
 
-_templates = {}
 
+def movedIntRequests(requests, floatLayout):
+    """
+    Int requests with their float offsets pointing into floatLayout instead.
+    """
+    floats = FloatPool()
+    floats.seed(floatLayout)
+    return [[floats.addFloats(x.values) if isinstance(x, FloatOffset) else x for x in request] for request in requests]
 
-def Template(templatePath):
-    assert isinstance(templatePath, FilePath)
-    global _templates
-    key = os.path.abspath(templatePath).lower()
-    try:
-        return _templates[key]
-    except:
-        xTemplate = parseXMLWithIncludes(templatePath)
-        if _templates:
-            raise RuntimeError('Found multiple templates in project, this is currently not supported by the player code.')
-        _templates[key] = xTemplate
-        return xTemplate
 
+def _shaderFile(tag, path, sceneDir, templateDir):
+    baseDir = sceneDir
+    if tag in ('global', 'shared'):
+        baseDir = templateDir
+    return baseDir.join(path).abs()
 
-def run():
-    shots = []
-    scenes = []
-    scenesDir = currentScenesDirectory()
 
+def _shaderFiles(cache):
+    """
+    Every shader file used by the project, in the order the export adds them.
+    """
+    scenesDir = currentScenesDirectory()
     for scenePath in scenesDir.iter(join=True):
         if not scenePath.hasExt(SCENE_EXT):
             continue
         sceneDir = FilePath(scenePath.strip()).stripExt()
-        xScene = parseXMLWithIncludes(scenePath)
-
-        templatePath = scenesDir.join(scenesDir, xScene.attrib['template'])
-        templateDir = templatePath.stripExt()
-        xTemplate = Template(templatePath)
-
-        scene = []
-
-        for xPass in xTemplate:
-            stitchIds = []
-            uniforms = {}
-            for xSection in xPass:
-                baseDir = sceneDir
-                if xSection.tag in ('global', 'shared'):
-                    baseDir = templateDir
-                shaderFile = baseDir.join(xSection.attrib['path']).abs()
-                stitchIds.append(text.addFile(shaderFile))
-                for xUniform in xSection:
-                    name = xUniform.attrib['name']
-                    values = [float(x.strip()) for x in xUniform.attrib['value'].split(',')]
-                    uniforms[text.addString(name)] = len(values), floats.addFloats(values, name)
-
-            programId = shaders.fromStitches(stitchIds)
-
-            buffer = int(xPass.attrib.get('buffer', -1))
-            outputs = int(xPass.attrib.get('outputs', 1))
-            size = int(xPass.attrib.get('size', 0))
-            width = int(xPass.attrib.get('width', size))
-            height = int(xPass.attrib.get('height', size))
-            factor = int(xPass.attrib.get('factor', 1))
-            static = int(xPass.attrib.get('static', 0))
-            is3d = int(xPass.attrib.get('is3d', 0))
-            if buffer != -1:
-                buffer = framebuffers.add(buffer, outputs, width, height, factor, static, is3d)
-
-            i = 0
-            key = 'input%s' % i
-            inputs = []
-            while key in xPass.attrib:
-                v = xPass.attrib[key]
-                if '.' in v:
-                    a, b = v.split('.')
-                else:
-                    a, b = v, 0
-                inputs.append((int(a), int(b)))
-                i += 1
-                key = 'input%s' % i
-
-            scene.append(passes.add(programId, buffer, inputs, uniforms))
-
-        sceneIndex = len(scenes)
-        scenes.append(len(scene))
-        scenes += scene
-
-        for xShot in xScene:
-            if xShot.attrib.get('enabled', 'True') == 'False':
+        templatePath = scenesDir.join(cache.sceneRecord(scenePath)['template'])
+        for passAttrib, sections in cache.templateRecord(templatePath):
+            for tag, path, sectionUniforms in sections:
+                yield _shaderFile(tag, path, sceneDir, templatePath.stripExt())
+
+
+class ExportSession(object):
+    """
+    Owns the pools and offsets that make up generated.hpp, use a new session for every export.
+    Sessions can share a cache, so repeated exports only process the files that changed.
+    """
+
+    def __init__(self, cache, floatLayout=(), intLayout=(), quantizer=None, keyReducer=None):
+        self.cache = cache
+        self.quantizer = quantizer
+        self.keyReducer = keyReducer
+        self.text = TextPool(cache)
+        self.shaders = ShaderPool()
+        self.framebuffers = FrameBufferPool()
+        self.passes = PassPool()
+        self.floats = FloatPool()
+        self.floats.seed(floatLayout)
+        self.ints = IntPool()
+        self.ints.seed(intLayout)
+        self.__templates = {}
+        # what the pools were filled with, for the size report
+        self.shaderFiles = {}
+        self.sceneNames = {}
+        self.scenes = []
+        self.shots = []
+        # offsets into gIntData, known once generate() serialized the pools
+        self.animEntriesMax = 0.0
+        self.shotAnimationDataIds = 0
+        self.shotScene = 0
+        # offset into gFloatData
+        self.shotTimes = 0
+        self.scenePassIds = 0
+        self.passProgramsAndTargets = 0
+        self.passConstUniforms = 0
+        self.passInputs = 0
+        self.shotUniformData = 0
+        self.frameBufferData = 0
+
+    def template(self, templatePath):
+        assert isinstance(templatePath, FilePath)
+        key = os.path.abspath(templatePath).lower()
+        try:
+            return self.__templates[key]
+        except KeyError:
+            record = self.cache.templateRecord(templatePath)
+            if self.__templates:
+                raise RuntimeError('Found multiple templates in project, this is currently not supported by the player code.')
+            self.__templates[key] = record
+            return record
+
+    def generate(self):
+        """
+        Fill the pools from the current project.
+        :returns: The content of generated.hpp.
+        """
+        shots = self.shots
+        scenes = self.scenes
+        scenesDir = currentScenesDirectory()
+
+        for scenePath in scenesDir.iter(join=True):
+            if not scenePath.hasExt(SCENE_EXT):
                 continue
-            animations = {}
-            for xChannel in xShot:
-                uname = xChannel.attrib['name']
-                n = uname
-                x = 0
-                if '.' in uname:
-                    n, x = uname.rsplit('.', 1)
-                    x = 'xyzw'.index(x)
-                n = text.addString(n)
-                if n not in animations:
-                    animations[n] = []
-                if not xChannel.text:
-                    keyframes = []
-                else:
-                    keyframes = []
-                    for i, v in enumerate(float(v.strip()) for v in xChannel.text.split(',')):
-                        j = i % 8
-                        if j == 0 or j == 4 or j > 5:
-                            continue
-                        if j == 5:  # out tangent y
-                            if v == float('inf'):  # stepped tangents are implemented as out tangentY = positive infinity
-                                v = 'FLT_MAX'
-                        keyframes.append(v)
-                    assert len(keyframes) / 4.0 == int(len(keyframes) / 4), len(keyframes)
-                while len(animations[n]) <= x:
-                    animations[n].append(None)
-                assert animations[n][x] is None
-                animations[n][x] = floats.addFloats(keyframes), len(keyframes)
-
-            for channelStack in animations.values():
-                # TODO we can not / do not check if the channelStack length matches the uniform dimensions inside the shader (e.g. are we sure we're not gonna call glUniform2f for a vec3?)
-                assert None not in channelStack, 'Animation provided for multiple channels but there is one missing (Y if a vec3 or also Z if a vec4).'
-
-            shots.append((float(xShot.attrib['start']), float(xShot.attrib['end']), sceneIndex, animations))
-
-    # sort shots by start time
-    def _serializeShots(shots):
-        shots.sort(key=lambda x: x[0])
-        shotTimesStart = floats.addFloats([x for shot in shots for x in (shot[0], shot[1])])
-        yield '\n\n__forceinline int shotAtBeats(float beats, float& localBeats)\n{\n'
-        if len(shots) == 1:
-            yield '\tlocalBeats = beats - gFloatData[%s];\n' % shotTimesStart
-            yield '\tif(beats < gFloatData[%s])\n\t\treturn 0;' % (shotTimesStart + 1)
-            yield '\treturn -1;\n'
-        else:
-            yield '\tint shotTimeCursor = 0;\n'
-            yield '\tdo\n\t{\n'
-            yield '\t\tif(beats < gFloatData[shotTimeCursor * 2 + %s])\n\t\t{\n' % (shotTimesStart + 1)
-            yield '\t\t\tlocalBeats = beats - gFloatData[shotTimeCursor * 2 + %s];\n' % shotTimesStart
-            yield '\t\t\treturn shotTimeCursor;\n'
-            yield '\t\t}\n'
-            yield '\t}\n\twhile(++shotTimeCursor < %s);\n' % len(shots)
-            yield '\treturn -1;\n'
-        yield '}\n'
-
-        global gShotScene
-        gShotScene = ints.addInts([shot[2] for shot in shots])
-        flatAnimationData = []
-        animationDataPtrs = []
-        for shot in shots:
-            animationDataPtrs += [len(flatAnimationData), len(shot[3].keys())]
-            global gAnimEntriesMax
-            gAnimEntriesMax = max(gAnimEntriesMax, len(shot[3].keys()))
-            for uniformStringId in shot[3]:
-                animationData = shot[3][uniformStringId]
-                flatAnimationData += [uniformStringId, len(animationData)]
-                for pair in animationData:
-                    flatAnimationData += pair
-                flatAnimationData += [0] * (2 * (4 - len(animationData)))
-
-        global gShotAnimationDataIds
-        gShotAnimationDataIds = ints.addInts(animationDataPtrs)
-        global gShotUniformData
-        gShotUniformData = ints.addInts(flatAnimationData)
-
-    def _serializeAll(scenes, shots):
-        buffer = list(_serializeShots(shots))
-        for serializable in (text, floats):
-            for ln in serializable.serialize():
+            sceneDir = FilePath(scenePath.strip()).stripExt()
+            sceneRecord = self.cache.sceneRecord(scenePath)
+
+            templatePath = scenesDir.join(sceneRecord['template'])
+            templateDir = templatePath.stripExt()
+            templateRecord = self.template(templatePath)
+
+            scene = []
+
+            for passAttrib, sections in templateRecord:
+                stitchIds = []
+                uniforms = {}
+                for tag, path, sectionUniforms in sections:
+                    shaderPath = _shaderFile(tag, path, sceneDir, templateDir)
+                    stitchIds.append(self.text.addFile(shaderPath))
+                    self.shaderFiles[stitchIds[-1]] = shaderPath
+                    for name, values in sectionUniforms:
+                        uniforms[self.text.addString(name)] = len(values), self.floats.addFloats(values)
+
+                programId = self.shaders.fromStitches(stitchIds)
+
+                buffer = int(passAttrib.get('buffer', -1))
+                outputs = int(passAttrib.get('outputs', 1))
+                size = int(passAttrib.get('size', 0))
+                width = int(passAttrib.get('width', size))
+                height = int(passAttrib.get('height', size))
+                factor = int(passAttrib.get('factor', 1))
+                static = int(passAttrib.get('static', 0))
+                is3d = int(passAttrib.get('is3d', 0))
+                if buffer != -1:
+                    buffer = self.framebuffers.add(buffer, outputs, width, height, factor, static, is3d)
+
+                i = 0
+                key = 'input%s' % i
+                inputs = []
+                while key in passAttrib:
+                    v = passAttrib[key]
+                    if '.' in v:
+                        a, b = v.split('.')
+                    else:
+                        a, b = v, 0
+                    inputs.append((int(a), int(b)))
+                    i += 1
+                    key = 'input%s' % i
+
+                scene.append(self.passes.add(programId, buffer, inputs, uniforms))
+
+            sceneIndex = len(scenes)
+            self.sceneNames[sceneIndex] = scenePath.name()
+            scenes.append(len(scene))
+            scenes += scene
+
+            for start, end, channels in sceneRecord['shots']:
+                animations = {}
+                for uname, keyframes in channels:
+                    n = uname
+                    x = 0
+                    if '.' in uname:
+                        n, x = uname.rsplit('.', 1)
+                        x = 'xyzw'.index(x)
+                    n = self.text.addString(n)
+                    if n not in animations:
+                        animations[n] = []
+                    while len(animations[n]) <= x:
+                        animations[n].append(None)
+                    assert animations[n][x] is None
+                    if self.keyReducer is not None:
+                        keyframes = self.keyReducer.reduce(uname, keyframes)
+                    if self.quantizer is not None:
+                        keyframes = self.quantizer.quantize(uname, keyframes)
+                    animations[n][x] = self.floats.addFloats(keyframes), len(keyframes)
+
+                for channelStack in animations.values():
+                    # TODO we can not / do not check if the channelStack length matches the uniform dimensions inside the shader (e.g. are we sure we're not gonna call glUniform2f for a vec3?)
+                    assert None not in channelStack, 'Animation provided for multiple channels but there is one missing (Y if a vec3 or also Z if a vec4).'
+
+                shots.append((start, end, sceneIndex, animations))
+
+        # sort shots by start time
+        def _serializeShots(shots):
+            shots.sort(key=lambda x: x[0])
+            shotTimesStart = self.floats.addFloats([x for shot in shots for x in (shot[0], shot[1])])
+            self.shotTimes = shotTimesStart
+            yield '\n\n__forceinline int shotAtBeats(float beats, float& localBeats)\n{\n'
+            if len(shots) == 1:
+                yield '\tlocalBeats = beats - gFloatData[%s];\n' % shotTimesStart
+                yield '\tif(beats < gFloatData[%s])\n\t\treturn 0;' % (shotTimesStart + 1)
+                yield '\treturn -1;\n'
+            else:
+                yield '\tint shotTimeCursor = 0;\n'
+                yield '\tdo\n\t{\n'
+                yield '\t\tif(beats < gFloatData[shotTimeCursor * 2 + %s])\n\t\t{\n' % (shotTimesStart + 1)
+                yield '\t\t\tlocalBeats = beats - gFloatData[shotTimeCursor * 2 + %s];\n' % shotTimesStart
+                yield '\t\t\treturn shotTimeCursor;\n'
+                yield '\t\t}\n'
+                yield '\t}\n\twhile(++shotTimeCursor < %s);\n' % len(shots)
+                yield '\treturn -1;\n'
+            yield '}\n'
+
+            self.shotScene = self.ints.addInts([shot[2] for shot in shots])
+            flatAnimationData = []
+            animationDataPtrs = []
+            for shot in shots:
+                animationDataPtrs += [len(flatAnimationData), len(shot[3].keys())]
+                self.animEntriesMax = max(self.animEntriesMax, len(shot[3].keys()))
+                for uniformStringId in shot[3]:
+                    animationData = shot[3][uniformStringId]
+                    flatAnimationData += [uniformStringId, len(animationData)]
+                    for pair in animationData:
+                        flatAnimationData += pair
+                    flatAnimationData += [0] * (2 * (4 - len(animationData)))
+
+            self.shotAnimationDataIds = self.ints.addInts(animationDataPtrs)
+            self.shotUniformData = self.ints.addInts(flatAnimationData)
+
+        def _serializeAll(scenes, shots):
+            buffer = list(_serializeShots(shots))
+            for serializable in (self.text, self.floats):
+                for ln in serializable.serialize():
+                    yield ln
+            buffer2 = []
+            for serializable in (self.shaders, self.framebuffers, self.passes):
+                buffer2 += list(serializable.serialize(self))
+            self.scenePassIds = self.ints.addInts(scenes)
+            for ln in self.ints.serialize():
+                yield ln
+            for ln in buffer2:
+                yield ln
+            for ln in buffer:
                 yield ln
-        buffer2 = []
-        for serializable in (shaders, framebuffers, passes):
-            buffer2 += list(serializable.serialize())
-        global gScenePassIds
-        gScenePassIds = ints.addInts(scenes)
-        for ln in ints.serialize():
-            yield ln
-        for ln in buffer2:
-            yield ln
-        for ln in buffer:
-            yield ln
-
-    data = [''.join(_serializeAll(scenes, shots))]
-    data.append("""\n\n__forceinline float evalCurve(const float* data, int numFloats, float beats)
+
+        data = [''.join(_serializeAll(scenes, shots))]
+        data.append("""\n\n__forceinline float evalCurve(const float* data, int numFloats, float beats)
 {
 \tif(numFloats == 4 || beats <= data[1]) // 1 key or evaluating before first frame
 \t\treturn data[2];
@@ -565,12 +758,91 @@ def run():
 #define gFrameBufferData %s
 #define gFrameBufferBlockSize %s
 #define gProgramCount %s
-""" % (gAnimEntriesMax, gShotAnimationDataIds, gShotScene, gScenePassIds, gPassProgramsAndTargets, gShotUniformData, gFrameBufferData, FrameBufferPool.BLOCK_SIZE, len(shaders.offsets)))
-
-    dst = FilePath(__file__).abs().parent().parent().join('Player', 'generated.hpp')
+""" % (self.animEntriesMax, self.shotAnimationDataIds, self.shotScene, self.scenePassIds, self.passProgramsAndTargets, self.shotUniformData, self.frameBufferData, FrameBufferPool.BLOCK_SIZE, len(self.shaders.offsets)))
+
+        return ''.join(data)
+
+
+def generatedPath():
+    return FilePath(__file__).abs().parent().parent().join('Player', 'generated.hpp')
+
+
+def createCache():
+    return ExportCache(generatedPath().ensureExt('manifest.json'))
+
+
+def exportSession(cache, quantizer=None, keyReducer=None):
+    """
+    Run all export passes, without writing anything.
+    :returns: The final session and the content of generated.hpp.
+    :rtype: (ExportSession, str)
+    """
+    # float requests don't depend on any offsets, int requests contain float offsets,
+    # so find the float layout, move the int requests onto it to find the int layout, then export with both
+    session = ExportSession(cache, quantizer=quantizer, keyReducer=keyReducer)
+    session.generate()
+    floatsBefore = len(session.floats.data)
+    floatLayout = compactLayout(session.floats)
+    ints = IntPool()
+    for request in movedIntRequests(session.ints.requests, floatLayout):
+        ints.addInts(request)
+    intsBefore = len(ints.data)
+    intLayout = compactLayout(ints)
+    session = ExportSession(cache, floatLayout, intLayout, quantizer, keyReducer)
+    data = session.generate()
+    print('gFloatData: %s -> %s values' % (floatsBefore, len(session.floats.data)))
+    print('gIntData: %s -> %s values' % (intsBefore, len(session.ints.data)))
+    return session, data
+
+
+def export(cache=None, quantizer=None, keyReducer=None):
+    """
+    Write Player/generated.hpp for the current project.
+    Pass the same cache to repeated exports, so only files that changed since the last export are processed.
+    :param Quantizer quantizer: Defaults to the tolerances in the settings.
+    :param KeyReducer keyReducer: Defaults to the tolerances in the settings.
+    :returns: True if generated.hpp changed.
+    """
+    dst = generatedPath()
+    if cache is None:
+        cache = createCache()
+    if quantizer is None:
+        quantizer = Quantizer.fromSettings()
+    if keyReducer is None:
+        keyReducer = KeyReducer.fromSettings()
+    hits, misses = cache.hits, cache.misses
+
+    cache.optimizeAll(list(_shaderFiles(cache)))
+
+    session, data = exportSession(cache, quantizer, keyReducer)
+    if keyReducer.keysBefore:
+        print('Reduced %s keys to %s' % (keyReducer.keysBefore, keyReducer.keysAfter))
+    numChannels, averageBits = quantizer.summary()
+    if numChannels:
+        print('Quantized %s channels to %.1f bits on average' % (numChannels, averageBits))
+    hits, misses = cache.hits - hits, cache.misses - misses
+    print('Reused %s of %s cached files' % (hits, hits + misses))
+    sizereport.report(session, data, dst.ensureExt('report.json'))
+
+    cache.save()
+    # leave the file alone when nothing changed, so the player is not rebuilt needlessly
+    if dst.exists() and dst.content() == data:
+        return False
     with dst.edit() as fh:
-        fh.write(''.join(data))
+        fh.write(data)
+    return True
+
+
+def run(tolerance=None, keyTolerance=None):
+    """
+    :param float tolerance: Quantize all channels within this tolerance instead of the tolerances in the settings.
+    :param float keyTolerance: Reduce keys of all channels within this tolerance instead of the tolerances in the settings.
+    """
+    quantizer = None if tolerance is None else Quantizer(tolerancesForAll(tolerance))
+    keyReducer = None if keyTolerance is None else KeyReducer(tolerancesForAll(keyTolerance))
+    export(quantizer=quantizer, keyReducer=keyReducer)
 
 
 if __name__ == '__main__':
-    run()
+    # python build/generate.py [tolerance [keyTolerance]]
+    run(*[float(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,52 @@
+"""
+Deletes keys from exported animation channels that the curve can do without, see Curve.simplify().
+
+Tolerances are set per kind of channel like for quantization, with the settings
+ExportKeyToleranceCamera, ExportKeyToleranceColor and ExportKeyTolerance. A tolerance of 0 (the default)
+exports that kind of channel unchanged, see quantize.py for how to set them. Quantization happens after, on the reduced keys,
+so the errors of both add up.
+"""
+from pycompat import *
+from build.quantize import channelKind, curveFromKeyframes, tolerancesFromSettings
+
+SETTINGS = {'camera': 'ExportKeyToleranceCamera', 'color': 'ExportKeyToleranceColor', 'other': 'ExportKeyTolerance'}
+
+
+def keyframesFromCurve(curve):
+    keyframes = []
+    for key in curve:
+        outTangentY = key.outTangent.y
+        keyframes += [key.inTangent.y, key.time(), key.value(), 'FLT_MAX' if outTangentY == float('inf') else outTangentY]
+    return keyframes
+
+
+class KeyReducer(object):
+    """
+    Results are kept by channel name and keys, keep the reducer around for repeated exports.
+    """
+
+    def __init__(self, tolerances):
+        """
+        :param dict tolerances: Max error by channel kind, see channelKind().
+        """
+        self.__tolerances = tolerances
+        self.__results = {}
+        self.keysBefore = 0
+        self.keysAfter = 0
+
+    @staticmethod
+    def fromSettings():
+        return KeyReducer(tolerancesFromSettings(SETTINGS))
+
+    def reduce(self, name, keyframes):
+        tolerance = self.__tolerances.get(channelKind(name), 0.0)
+        if tolerance <= 0.0 or len(keyframes) <= 8:
+            return keyframes
+        key = name, tuple(keyframes)
+        if key not in self.__results:
+            curve = curveFromKeyframes(keyframes)
+            curve.simplify(tolerance)
+            self.__results[key] = keyframesFromCurve(curve)
+            self.keysBefore += len(keyframes) // 4
+            self.keysAfter += len(self.__results[key]) // 4
+        return self.__results[key]
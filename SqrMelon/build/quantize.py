@@ -0,0 +1,156 @@
+"""
+Drops low mantissa bits from exported keyframes, zeroed bits make the float data compress better.
+
+Every animation channel gets the fewest bits for which the exported curve, evaluated like the player does,
+stays within a tolerance of Curve.evaluate on the original keys. Tolerances are set per kind of channel
+with these settings, a tolerance of 0 (the default) exports that kind of channel unchanged:
+ExportToleranceCamera for uOrigin and uAngles, ExportToleranceColor for channels with color in the name
+and ExportTolerance for all other channels. They can be edited with Tools > Export settings in the editor,
+or overridden for all channels when running build/generate.py.
+"""
+import struct
+from pycompat import *
+from animationgraph.curvedata import Curve, Key
+from mathutil import Vec2
+from util import gSettings
+
+CAMERA_UNIFORMS = 'uOrigin', 'uAngles'
+SETTINGS = {'camera': 'ExportToleranceCamera', 'color': 'ExportToleranceColor', 'other': 'ExportTolerance'}
+
+
+def roundb(value, bits):
+    # Truncation utility from: http://www.ctrl-alt-test.fr/?p=535
+    if value == 'FLT_MAX':
+        # cheat to work around constant used by stepped tangents
+        return value
+    if bits >= 32:
+        return value
+    bits = 32 - bits
+    num = struct.unpack('i', struct.pack('f', value))[0]
+    num = (num + (1 << (bits - 1))) & (-1 << bits)
+    return struct.unpack('f', struct.pack('i', num))[0]
+
+
+def evalCurve(data, beats):
+    """
+    evalCurve from generated.hpp, data has 4 floats per key: in tangent, time, value, out tangent.
+    """
+    if len(data) == 4 or beats <= data[1]:
+        return data[2]
+    rightKeyIndex = 4
+    while rightKeyIndex < len(data) - 4 and data[rightKeyIndex + 1] < beats:
+        rightKeyIndex += 4
+    sampleTime = min(beats, data[rightKeyIndex + 1])
+    y0 = data[rightKeyIndex - 2]
+    y1 = data[rightKeyIndex - 1]
+    if y1 == 'FLT_MAX':
+        return y0
+    y2 = data[rightKeyIndex]
+    y3 = data[rightKeyIndex + 2]
+    dy = y3 - y0
+    c0 = y1 + y2 - dy - dy
+    c1 = dy + dy + dy - y1 - y1 - y2
+    t = (sampleTime - data[rightKeyIndex - 3]) / (data[rightKeyIndex + 1] - data[rightKeyIndex - 3])
+    return t * (t * (t * c0 + c1) + y1) + y0
+
+
+def curveFromKeyframes(keyframes):
+    """
+    Curve with the exact tangents of exported keyframes.
+    """
+    curve = Curve()
+    for i in range(0, len(keyframes), 4):
+        inTangentY, time, value, outTangentY = keyframes[i:i + 4]
+        key = curve.addKeyWithTangents(0.0, 0.0, time, value, 0.0, 0.0, False, Key.TANGENT_USER)
+        # set after the mode, other modes compute tangents when the key is added
+        key.inTangent = Vec2(0.0, inTangentY)
+        key.outTangent = Vec2(0.0, float('inf') if outTangentY == 'FLT_MAX' else outTangentY)
+    return curve
+
+
+def sampleTimes(keyframes, samplesPerSegment):
+    """
+    Times inside every segment, at key times stepped curves jump and the player takes the value before the jump.
+    """
+    times = keyframes[1::4]
+    yield times[0]
+    for i in range(len(times) - 1):
+        for j in range(samplesPerSegment):
+            yield times[i] + (times[i + 1] - times[i]) * (j + 0.5) / samplesPerSegment
+
+
+def channelKind(name):
+    if name.split('.')[0] in CAMERA_UNIFORMS:
+        return 'camera'
+    if 'color' in name.lower() or 'colour' in name.lower():
+        return 'color'
+    return 'other'
+
+
+def tolerancesFromSettings(settings):
+    """
+    :param dict settings: Settings key by channel kind.
+    """
+    return {kind: float(gSettings.value(key, 0.0)) for kind, key in settings.items()}
+
+
+def tolerancesForAll(tolerance):
+    return {kind: tolerance for kind in SETTINGS}
+
+
+class Quantizer(object):
+    """
+    Results are kept by channel name and keys, keep the quantizer around for repeated exports.
+    """
+    SAMPLES_PER_SEGMENT = 16
+    # sign and exponent are always kept
+    MIN_BITS = 9
+
+    def __init__(self, tolerances):
+        """
+        :param dict tolerances: Max error by channel kind, see channelKind().
+        """
+        self.__tolerances = tolerances
+        self.__results = {}
+
+    @staticmethod
+    def fromSettings():
+        return Quantizer(tolerancesFromSettings(SETTINGS))
+
+    def bits(self, name, keyframes):
+        """
+        :returns: The fewest bits to keep of every float in this channel.
+        """
+        tolerance = self.__tolerances.get(channelKind(name), 0.0)
+        if tolerance <= 0.0 or not keyframes:
+            return 32
+        key = name, tuple(keyframes)
+        if key in self.__results:
+            return self.__results[key]
+        curve = curveFromKeyframes(keyframes)
+        samples = [(beats, curve.evaluate(beats)) for beats in sampleTimes(keyframes, Quantizer.SAMPLES_PER_SEGMENT)]
+        for bits in range(Quantizer.MIN_BITS, 32):
+            data = [roundb(v, bits) for v in keyframes]
+            times = data[1::4]
+            if any(a >= b for a, b in zip(times, times[1:])):
+                # keys collapsed or swapped
+                continue
+            if all(abs(evalCurve(data, beats) - value) <= tolerance for beats, value in samples):
+                break
+        else:
+            bits = 32
+        self.__results[key] = bits
+        return bits
+
+    def quantize(self, name, keyframes):
+        bits = self.bits(name, keyframes)
+        return [roundb(v, bits) for v in keyframes]
+
+    def summary(self):
+        """
+        :returns: Number of channels quantized and the average number of bits kept for them.
+        """
+        bits = [x for x in self.__results.values() if x < 32]
+        if not bits:
+            return 0, 32
+        return len(bits), sum(bits) / float(len(bits))
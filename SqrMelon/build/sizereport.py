@@ -0,0 +1,175 @@
+"""
+Where the bytes of generated.hpp come from.
+
+Every row of the report is a part of the header with its size as text and its size compressed with zlib and lzma,
+as a rough idea of what the executable packer makes of it. Compressing rows separately misses what they share,
+so only the total is a fair estimate of the packed size. Rows are compared to the report of the previous export.
+"""
+import os
+import json
+import zlib
+import struct
+from collections import OrderedDict
+from pycompat import *
+from util import currentProjectDirectory
+
+try:
+    import lzma
+except ImportError:
+    # not available in python 2
+    lzma = None
+
+# the size the executable has to fit in
+LIMIT = 64 * 1024
+
+
+def compressedSizes(data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return len(zlib.compress(data, 9)), (len(lzma.compress(data, preset=9)) if lzma is not None else None)
+
+
+def _row(data):
+    zlibSize, lzmaSize = compressedSizes(data)
+    return {'bytes': len(data), 'zlib': zlibSize, 'lzma': lzmaSize}
+
+
+def _floatsBinary(values):
+    # as the compiler stores them, which is what the packer sees
+    return struct.pack('%sf' % len(values), *[(3.4028234663852886e+38 if x == 'FLT_MAX' else x) for x in values])
+
+
+def _floatsText(values):
+    return ', '.join((str(x) + 'f' if x != 'FLT_MAX' else x) for x in values)
+
+
+def _intsText(values):
+    return ', '.join(str(int(x)) for x in values)
+
+
+def _declaration(data, prefix):
+    """
+    :returns: Start and end of the declaration in data, the text pool spans many lines and long literals can wrap.
+    """
+    start = data.find(prefix)
+    if start == -1:
+        return 0, 0
+    # shader text escapes its newlines, so the first '};' at the end of a line closes the declaration
+    return start, data.index('};\n', start) + 3
+
+
+def _passText(session, passId):
+    """
+    gIntData entries and uniform values of a single pass.
+    """
+    passes = session.passes.data
+    constStride = 3 * max(len(x[3]) for x in passes) + 1
+    inputStride = max(len(x[2]) for x in passes) * 2 + 1
+    ints = session.ints.data
+    values = ints[session.passProgramsAndTargets + passId * 2:session.passProgramsAndTargets + passId * 2 + 2]
+    if constStride > 1:
+        values += ints[session.passConstUniforms + passId * constStride:session.passConstUniforms + (passId + 1) * constStride]
+    values += ints[session.passInputs + passId * inputStride:session.passInputs + (passId + 1) * inputStride]
+    floats = []
+    for uniformSize, floatOffset in passes[passId][3].values():
+        floats += session.floats.data[floatOffset:floatOffset + uniformSize]
+    if floats:
+        return _intsText(values) + ', ' + _floatsText(floats)
+    return _intsText(values)
+
+
+def build(session, data):
+    """
+    :param ExportSession session: The session that generated data.
+    :param str data: Content of generated.hpp.
+    :returns: Rows by name, in the order to show them.
+    :rtype: OrderedDict
+    """
+    rows = OrderedDict()
+    rows['total'] = _row(data)
+    sections = OrderedDict()
+    for name, prefix in (('text pool', 'const char* gTextPool[]'), ('float data', 'const float gFloatData[]'), ('int data', 'const int gIntData[]')):
+        sections[name] = _declaration(data, prefix)
+    code = []
+    cursor = 0
+    for start, end in sorted(sections.values()):
+        code.append(data[cursor:start])
+        cursor = end
+    code = ''.join(code) + data[cursor:]
+    assert sum(end - start for start, end in sections.values()) + len(code) == len(data), 'Sections do not add up to generated.hpp'
+    rows['text pool'] = _row(data[slice(*sections['text pool'])])
+    rows['float data'] = _row(data[slice(*sections['float data'])])
+    rows['float data binary'] = _row(_floatsBinary(session.floats.data))
+    rows['int data'] = _row(data[slice(*sections['int data'])])
+    rows['code'] = _row(code)
+
+    projectDir = currentProjectDirectory()
+    for textId, shaderPath in sorted(session.shaderFiles.items(), key=lambda item: item[1]):
+        rows['shader %s' % shaderPath.relativeTo(projectDir).replace(os.sep, '/')] = _row(session.text.data[textId])
+
+    for start, end, sceneIndex, animations in session.shots:
+        values = []
+        for channelStack in animations.values():
+            for offset, count in channelStack:
+                values += session.floats.data[offset:offset + count]
+        rows['shot %s %s-%s' % (session.sceneNames[sceneIndex], start, end)] = _row(_floatsText(values))
+
+    for sceneIndex, name in sorted(session.sceneNames.items()):
+        numPasses = int(session.scenes[sceneIndex])
+        # pass id list, followed by the data of every pass, passes shared by scenes are counted for each of them
+        passIds = session.scenes[sceneIndex:sceneIndex + 1 + numPasses]
+        rows['scene %s passes' % name] = _row(', '.join([_intsText(passIds)] + [_passText(session, passId) for passId in passIds[1:]]))
+    return rows
+
+
+def applyDeltas(rows, previousPath):
+    """
+    Add a 'delta' in bytes to every row that was in the report at previousPath, rows that are new get None.
+    """
+    previous = {}
+    if previousPath.exists():
+        try:
+            previous = json.loads(previousPath.content()).get('rows', {})
+        except ValueError:
+            pass
+    for name, row in rows.items():
+        row['delta'] = row['bytes'] - previous[name]['bytes'] if name in previous else None
+    return [name for name in previous if name not in rows]
+
+
+def save(rows, reportPath):
+    text = json.dumps({'limit': LIMIT, 'rows': rows}, indent=1)
+    if reportPath.exists() and reportPath.content() == text:
+        return
+    with reportPath.edit() as fh:
+        fh.write(text)
+
+
+def table(rows, removed=()):
+    """
+    :returns: The rows as text, one per line.
+    """
+    width = max(len(name) for name in rows)
+    lines = ['%-*s %8s %8s %8s %8s' % (width, 'section', 'bytes', 'zlib', 'lzma', 'delta')]
+    for name, row in rows.items():
+        delta = row.get('delta')
+        delta = 'new' if delta is None else '%+d' % delta
+        lines.append('%-*s %8s %8s %8s %8s' % (width, name, row['bytes'], row['zlib'], row['lzma'] if row['lzma'] is not None else '-', delta))
+    for name in removed:
+        lines.append('%-*s %8s %8s %8s %8s' % (width, name, '-', '-', '-', 'removed'))
+    total = rows['total']
+    estimate = total['lzma'] if total['lzma'] is not None else total['zlib']
+    if estimate > LIMIT:
+        lines.append('Compressed estimate is %s bytes over the %s byte limit' % (estimate - LIMIT, LIMIT))
+    return '\n'.join(lines)
+
+
+def report(session, data, reportPath):
+    """
+    Print the size report for this export and store it at reportPath for the next one.
+    """
+    rows = build(session, data)
+    removed = applyDeltas(rows, reportPath)
+    print(table(rows, removed))
+    save(rows, reportPath)
+    return rows
@@ -0,0 +1,42 @@
+"""
+Exports the default project and checks the animation the player would see against the editor, run pytest from
+the SqrMelon folder or any folder below it.
+"""
+import pytest
+from build import generate, verify
+from build.keyreduce import KeyReducer
+from build.quantize import Quantizer
+from fileutil import FilePath
+from projutil import overrideCurrentProjectFilePath
+from qtutil import QApplication
+from shots import iterAllShots
+
+DEFAULT_PROJECT = FilePath(__file__).abs().parent().parent().join('defaultproject', 'New.p64')
+TOLERANCE = 0.001
+# the player evaluates in float32
+EPSILON = 1e-5
+
+
+def _tolerances(value):
+    return {'camera': value, 'color': value, 'other': value}
+
+
+@pytest.fixture
+def defaultProject():
+    # shots create icons, which needs an application
+    application = QApplication.instance() or QApplication([])
+    overrideCurrentProjectFilePath(DEFAULT_PROJECT)
+    yield
+    overrideCurrentProjectFilePath(None)
+
+
+@pytest.mark.parametrize('quantize, reduce', [(False, False), (True, False), (False, True), (True, True)])
+def test_exportWithinTolerance(defaultProject, quantize, reduce):
+    quantizer = Quantizer(_tolerances(TOLERANCE if quantize else 0.0))
+    keyReducer = KeyReducer(_tolerances(TOLERANCE if reduce else 0.0))
+    session, data = generate.exportSession(generate.createCache(), quantizer, keyReducer)
+    rows = verify.verify(session, iterAllShots())
+    assert rows
+    # keys are reduced first and the result is quantized, so both errors can add up
+    tolerance = TOLERANCE * (quantize + reduce) + EPSILON
+    assert not verify.failures(rows, tolerance), verify.table(verify.failures(rows, tolerance))
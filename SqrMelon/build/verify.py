@@ -0,0 +1,166 @@
+"""
+Reads the animation back out of an export the way the player does and compares it to the editor, run with:
+
+    python build/verify.py [tolerance [samplesPerBeat]]
+
+Exits with 1 when a channel is off by more than tolerance, so it can fail a build.
+
+Shots and channels are found through gIntData and gFloatData of the export session, so packing mistakes show up too.
+Every exported channel is sampled densely and compared to Curve.evaluate of the shot in the editor,
+the max and mean error per channel are reported. Differences come from quantization and key reduction,
+or from shots that were not baked, the player ignores shot speed and preroll.
+
+Evaluation is vectorized with numpy when available and in float32 like the player.
+"""
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pycompat import *
+from build.quantize import evalCurve
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# value of FLT_MAX in generated.hpp
+FLT_MAX = 3.4028234663852886e+38
+# ints per uniform in the shot animation data: name, number of components and (offset, count) of 4 components
+UNIFORM_STRIDE = 10
+
+
+def evalCurves(data, beats):
+    """
+    evalCurve from generated.hpp at many times at once.
+    :param list data: 4 floats per key: in tangent, time, value, out tangent.
+    :param beats: Sequence of local beats.
+    :returns: Value at each of the beats.
+    """
+    if numpy is None:
+        return [evalCurve(data, b) for b in beats]
+    beats = numpy.asarray(beats, dtype=numpy.float32)
+    keys = numpy.array([(FLT_MAX if x == 'FLT_MAX' else x) for x in data], dtype=numpy.float32).reshape(-1, 4)
+    inTangents, times, values, outTangents = keys.T
+    if len(keys) == 1:
+        return numpy.full(beats.shape, values[0], dtype=numpy.float32)
+    # the player walks to the first key at or after beats, but never past the last key
+    right = numpy.clip(numpy.searchsorted(times, beats, side='left'), 1, len(keys) - 1)
+    left = right - 1
+    sampleTime = numpy.minimum(beats, times[right])
+    y0 = values[left]
+    y1 = outTangents[left]
+    y2 = inTangents[right]
+    y3 = values[right]
+    dy = y3 - y0
+    # stepped tangents overflow, their result is replaced below
+    with numpy.errstate(over='ignore', invalid='ignore'):
+        c0 = y1 + y2 - dy - dy
+        c1 = dy + dy + dy - y1 - y1 - y2
+        t = (sampleTime - times[left]) / (times[right] - times[left])
+        result = t * (t * (t * c0 + c1) + y1) + y0
+    result = numpy.where(y1 == numpy.float32(FLT_MAX), y0, result)
+    return numpy.where(beats <= times[0], values[0], result)
+
+
+def exportedShots(session):
+    """
+    Shots as the player finds them in the session's pools.
+    :returns: Per shot the start and end beats, scene name and a list of channels,
+    each channel is (uniform name, component index, number of components, keyframes).
+    """
+    ints = session.ints.data
+    floats = session.floats.data
+    for i in range(len(session.shots)):
+        start, end = floats[session.shotTimes + i * 2:session.shotTimes + i * 2 + 2]
+        sceneName = session.sceneNames[ints[session.shotScene + i]]
+        ptr, numUniforms = ints[session.shotAnimationDataIds + i * 2:session.shotAnimationDataIds + i * 2 + 2]
+        channels = []
+        for j in range(numUniforms):
+            cursor = session.shotUniformData + ptr + j * UNIFORM_STRIDE
+            nameId, numComponents = ints[cursor:cursor + 2]
+            for component in range(numComponents):
+                offset, count = ints[cursor + 2 + component * 2:cursor + 4 + component * 2]
+                channels.append((session.text.data[nameId], component, numComponents, floats[offset:offset + count]))
+        yield start, end, sceneName, channels
+
+
+def _curveName(curves, name, component, numComponents):
+    qualified = '%s.%s' % (name, 'xyzw'[component])
+    if qualified in curves:
+        return qualified
+    if numComponents == 1 and name in curves:
+        return name
+    return None
+
+
+def verify(session, shots, samplesPerBeat=64):
+    """
+    :param ExportSession session: The session that made the export.
+    :param shots: Shots of the editor, like shots.iterAllShots().
+    :returns: Rows of (scene, start, end, channel, max error, mean error), channels missing in the editor get None errors.
+    """
+    editorShots = {}
+    for shot in shots:
+        if shot.enabled:
+            editorShots[(shot.sceneName, shot.start, shot.end)] = shot
+    rows = []
+    for start, end, sceneName, channels in exportedShots(session):
+        shot = editorShots.get((sceneName, start, end))
+        numSamples = max(1, int((end - start) * samplesPerBeat))
+        # between samples, at key times stepped curves jump and the player takes the value before the jump
+        localBeats = [(i + 0.5) * (end - start) / numSamples for i in range(numSamples)]
+        for name, component, numComponents, keyframes in channels:
+            curveName = _curveName(shot.curves, name, component, numComponents) if shot is not None else None
+            if curveName is None:
+                rows.append((sceneName, start, end, '%s.%s' % (name, 'xyzw'[component]), None, None))
+                continue
+            curve = shot.curves[curveName]
+            expected = [curve.evaluate(b * shot.speed - shot.preroll) for b in localBeats]
+            errors = [abs(float(a) - b) for a, b in zip(evalCurves(keyframes, localBeats), expected)]
+            rows.append((sceneName, start, end, curveName, max(errors), sum(errors) / len(errors)))
+    return rows
+
+
+def failures(rows, tolerance):
+    """
+    Rows with an error above tolerance or with no curve in the editor.
+    """
+    return [row for row in rows if row[4] is None or row[4] > tolerance]
+
+
+def table(rows):
+    lines = ['%-16s %-12s %-16s %12s %12s' % ('scene', 'shot', 'channel', 'max error', 'mean error')]
+    for sceneName, start, end, channel, maxError, meanError in rows:
+        if maxError is None:
+            lines.append('%-16s %-12s %-16s %12s %12s' % (sceneName, '%s-%s' % (start, end), channel, 'missing', '-'))
+        else:
+            lines.append('%-16s %-12s %-16s %12.6g %12.6g' % (sceneName, '%s-%s' % (start, end), channel, maxError, meanError))
+    return '\n'.join(lines)
+
+
+def main(tolerance=None, samplesPerBeat=64):
+    """
+    Prints the table and returns 1 when a channel is off by more than tolerance, or missing.
+    """
+    from build.generate import createCache, exportSession
+    from build.keyreduce import KeyReducer
+    from build.quantize import Quantizer
+    from shots import iterAllShots
+    session, data = exportSession(createCache(), Quantizer.fromSettings(), KeyReducer.fromSettings())
+    rows = verify(session, iterAllShots(), samplesPerBeat)
+    print(table(rows))
+    if tolerance is None:
+        return 0
+    bad = failures(rows, tolerance)
+    if bad:
+        print('\n%s channels exceed the tolerance of %s:' % (len(bad), tolerance))
+        print(table(bad))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    tolerance = float(sys.argv[1]) if len(sys.argv) > 1 else None
+    sys.exit(main(tolerance, *[int(arg) for arg in sys.argv[2:]]))
@@ -0,0 +1,178 @@
+"""
+Frame capture pipeline used to record the demo to disk.
+
+Frames are read back asynchronously through a ring of pixel buffer objects, so the GPU can keep
+rendering the next frames while earlier ones are transferred. Finished frames are handed to a sink
+that encodes them on worker threads: numbered images, or raw RGB piped into ffmpeg.
+"""
+from pycompat import *
+import ctypes
+import subprocess
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from OpenGL.GL import *
+from qtutil import QImage
+
+
+class _AsyncSink(object):
+    """
+    Runs write jobs on a thread pool, with a limited number of frames in flight to bound memory use.
+    """
+
+    def __init__(self, workers):
+        self.__pool = ThreadPool(workers)
+        self.__jobs = deque()
+        self.__maxJobs = workers * 2
+
+    def _submit(self, fn, *args):
+        while len(self.__jobs) >= self.__maxJobs:
+            # re-raises errors from the worker
+            self.__jobs.popleft().get()
+        self.__jobs.append(self.__pool.apply_async(fn, args))
+
+    def close(self):
+        while self.__jobs:
+            self.__jobs.popleft().get()
+        self.__pool.close()
+        self.__pool.join()
+
+
+class ImageSequenceSink(_AsyncSink):
+    """
+    Saves every frame as an image, file names are made by formatting pattern with the frame index.
+    """
+
+    def __init__(self, width, height, pattern, workers=4):
+        super(ImageSequenceSink, self).__init__(workers)
+        self.__width = width
+        self.__height = height
+        self.__pattern = pattern
+
+    def __save(self, frameIndex, data):
+        QImage(data, self.__width, self.__height, self.__width * 3, QImage.Format_RGB888).mirrored(False, True).save(self.__pattern % frameIndex)
+
+    def write(self, frameIndex, data):
+        if data is None:
+            # nothing to show for this frame
+            return
+        self._submit(self.__save, frameIndex, data)
+
+
+class FFmpegSink(_AsyncSink):
+    """
+    Streams raw frames into an ffmpeg process that encodes them to a video file.
+    A single worker keeps the frames in order while the GL thread continues rendering.
+    """
+
+    def __init__(self, width, height, fps, outputPath, ffmpegPath='ffmpeg', audioPath=None, audioOffset=0.0):
+        """
+        Raises OSError if ffmpeg can not be started, e.g. because it is not installed.
+        """
+        super(FFmpegSink, self).__init__(1)
+        self.__frameBytes = width * height * 3
+        args = [ffmpegPath, '-y',
+                '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '%sx%s' % (width, height), '-r', str(fps), '-i', '-']
+        if audioPath:
+            args += ['-itsoffset', str(audioOffset), '-i', audioPath, '-shortest']
+        # GL rows start at the bottom
+        args += ['-vf', 'vflip', '-c:v', 'libx264', '-pix_fmt', 'yuv420p', outputPath]
+        try:
+            self.__process = subprocess.Popen(args, stdin=subprocess.PIPE)
+        except OSError:
+            super(FFmpegSink, self).close()
+            raise
+
+    def write(self, frameIndex, data):
+        if data is None:
+            # the video needs a frame for every index
+            data = b'\0' * self.__frameBytes
+        self._submit(self.__process.stdin.write, data)
+
+    def close(self):
+        super(FFmpegSink, self).close()
+        self.__process.stdin.close()
+        self.__process.wait()
+
+
+class FrameCapture(object):
+    """
+    Reads RGB frames back from textures through a ring of pixel buffer objects.
+    A frame is mapped and passed to the sink only once RING_SIZE newer frames were requested,
+    by then the GPU is long done with it, so we never wait on the transfer.
+    """
+    RING_SIZE = 3
+
+    def __init__(self, width, height, sink):
+        self.__width = width
+        self.__height = height
+        self.__frameBytes = width * height * 3
+        self.__sink = sink
+        self.__pixelBuffers = [int(buffer) for buffer in glGenBuffers(FrameCapture.RING_SIZE)]
+        for pixelBuffer in self.__pixelBuffers:
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, pixelBuffer)
+            glBufferData(GL_PIXEL_PACK_BUFFER, self.__frameBytes, None, GL_STREAM_READ)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.__next = 0
+        self.__pending = deque()
+
+    def __retire(self):
+        pixelBuffer, frameIndex = self.__pending.popleft()
+        if pixelBuffer is None:
+            self.__sink.write(frameIndex, None)
+            return
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pixelBuffer)
+        ptr = glMapBuffer(GL_PIXEL_PACK_BUFFER, GL_READ_ONLY)
+        # copy out so the pixel buffer can be reused while the sink encodes
+        data = ctypes.string_at(ptr, self.__frameBytes)
+        glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.__sink.write(frameIndex, data)
+
+    def capture(self, texture, frameIndex):
+        """
+        Start reading back the given texture, which must match the capture size.
+        """
+        assert texture.width() == self.__width and texture.height() == self.__height
+        if sum(1 for pixelBuffer, _ in self.__pending if pixelBuffer is not None) == FrameCapture.RING_SIZE:
+            while self.__pending[0][0] is None:
+                self.__retire()
+            self.__retire()
+        pixelBuffer = self.__pixelBuffers[self.__next]
+        self.__next = (self.__next + 1) % FrameCapture.RING_SIZE
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pixelBuffer)
+        texture.use()
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        glGetTexImage(GL_TEXTURE_2D, 0, GL_RGB, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.__pending.append((pixelBuffer, frameIndex))
+
+    def skip(self, frameIndex):
+        """
+        Nothing was rendered for this frame.
+        """
+        self.__pending.append((None, frameIndex))
+
+    def finish(self):
+        """
+        Flush all frames in flight and close the sink.
+        """
+        while self.__pending:
+            self.__retire()
+        self.__sink.close()
+        self.__release()
+
+    def abort(self):
+        """
+        Drop all frames in flight and free the pixel buffers, e.g. after the sink failed.
+        """
+        self.__pending.clear()
+        self.__release()
+        try:
+            self.__sink.close()
+        except (IOError, OSError):
+            # the error that made us abort
+            pass
+
+    def __release(self):
+        glDeleteBuffers(len(self.__pixelBuffers), self.__pixelBuffers)
+        self.__pixelBuffers = []
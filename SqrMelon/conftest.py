@@ -0,0 +1,7 @@
+"""
+Test setup shared by all tests.
+"""
+import os
+
+# tests create a QApplication, which must not need a display
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
@@ -189,3 +189,6 @@ class FileSystemWatcher(QObject):
 
     def removePaths(self, paths):
         self.__internal.removePaths(paths)
+
+    def files(self):
+        return [FilePath(path) for path in self.__internal.files()]
@@ -0,0 +1,116 @@
+"""
+Shadow copy of the GL state the renderer changes most, so redundant calls can be skipped.
+
+Code that binds frame buffers, programs or textures while drawing should go through gGLState.
+Call invalidate() whenever GL state may have been changed behind our back, e.g. by Qt in between frames.
+"""
+from pycompat import *
+from collections import OrderedDict
+from OpenGL.GL import *
+
+
+class GLState(object):
+    CALLS = 'glBindFramebuffer', 'glDrawBuffers', 'glViewport', 'glUseProgram', 'glActiveTexture', 'glBindTexture'
+
+    def __init__(self):
+        self.__issued = OrderedDict((name, 0) for name in GLState.CALLS)
+        self.__skipped = OrderedDict((name, 0) for name in GLState.CALLS)
+        # draw buffers are part of the frame buffer object, not of the context, so they survive invalidate()
+        self.__drawBuffers = {}
+        self.invalidate()
+
+    def invalidate(self):
+        self.__framebuffer = None
+        self.__viewport = None
+        self.__program = None
+        self.__activeTexture = None
+        self.__textures = {}
+
+    def beginFrame(self):
+        """
+        Invalidate and reset the counters.
+        """
+        self.invalidate()
+        for name in GLState.CALLS:
+            self.__issued[name] = 0
+            self.__skipped[name] = 0
+
+    def counters(self):
+        """
+        :returns: Call name to (issued, skipped) since beginFrame().
+        :rtype: OrderedDict[str, (int, int)]
+        """
+        return OrderedDict((name, (self.__issued[name], self.__skipped[name])) for name in GLState.CALLS)
+
+    def __changed(self, name, changed):
+        if changed:
+            self.__issued[name] += 1
+        else:
+            self.__skipped[name] += 1
+        return changed
+
+    def bindFramebuffer(self, framebuffer):
+        framebuffer = int(framebuffer)
+        if self.__changed('glBindFramebuffer', framebuffer != self.__framebuffer):
+            glBindFramebuffer(GL_FRAMEBUFFER, framebuffer)
+            self.__framebuffer = framebuffer
+
+    def drawBuffers(self, buffers):
+        """
+        Set the draw buffers of the currently bound frame buffer.
+        """
+        buffers = tuple(buffers)
+        if self.__changed('glDrawBuffers', self.__framebuffer is None or self.__drawBuffers.get(self.__framebuffer) != buffers):
+            glDrawBuffers(len(buffers), buffers)
+            if self.__framebuffer is not None:
+                self.__drawBuffers[self.__framebuffer] = buffers
+
+    def viewport(self, x, y, width, height):
+        viewport = int(x), int(y), int(width), int(height)
+        if self.__changed('glViewport', viewport != self.__viewport):
+            glViewport(*viewport)
+            self.__viewport = viewport
+
+    def useProgram(self, program):
+        program = int(program)
+        if self.__changed('glUseProgram', program != self.__program):
+            glUseProgram(program)
+            self.__program = program
+
+    def activeTexture(self, unit):
+        """
+        :param int unit: GL_TEXTURE0 + index
+        """
+        if self.__changed('glActiveTexture', unit != self.__activeTexture):
+            glActiveTexture(unit)
+            self.__activeTexture = unit
+
+    def bindTexture(self, target, texture):
+        # bindings are per unit & target, when we don't know the active unit we can't skip anything
+        texture = int(texture)
+        key = self.__activeTexture, target
+        if self.__changed('glBindTexture', self.__activeTexture is None or self.__textures.get(key) != texture):
+            glBindTexture(target, texture)
+            if self.__activeTexture is not None:
+                self.__textures[key] = texture
+
+    def forgetTexture(self, texture):
+        """
+        Deleting a texture unbinds it everywhere, call this after glDeleteTextures.
+        """
+        texture = int(texture)
+        for key, value in self.__textures.items():
+            if value == texture:
+                self.__textures[key] = 0
+
+    def forgetFramebuffer(self, framebuffer):
+        """
+        Deleting a bound frame buffer binds the default frame buffer, call this after glDeleteFramebuffers.
+        """
+        framebuffer = int(framebuffer)
+        self.__drawBuffers.pop(framebuffer, None)
+        if self.__framebuffer == framebuffer:
+            self.__framebuffer = 0
+
+
+gGLState = GLState()
@@ -0,0 +1,138 @@
+"""
+Utility to time GPU work per render pass without stalling the pipeline.
+"""
+from pycompat import *
+import sys
+import time
+from collections import deque
+from contextlib import contextmanager
+from OpenGL.GL import *
+
+if sys.version_info.major == 3:
+    time.clock = time.time
+
+
+class GPUTimer(object):
+    """
+    Wraps sections of GL work in GL_TIME_ELAPSED queries.
+
+    Queries are issued every frame and kept in a ring of FRAMES_IN_FLIGHT frames,
+    a frame is only read back once the GPU reports its last query as available.
+    If the GPU falls too far behind the oldest frame is dropped instead of waited for.
+
+    Usage per frame:
+        beginFrame()
+        with section('pass name'): ...draw calls...
+        endFrame()
+    Then results() returns the most recently resolved frame and resultsSince() every frame resolved since an earlier one.
+    """
+    FRAMES_IN_FLIGHT = 4
+    # resolved frames kept for resultsSince()
+    HISTORY = 64
+
+    def __init__(self):
+        self.__pending = deque()
+        self.__freeQueries = []
+        self.__frame = None
+        self.__current = None
+        self.__results = []
+        self.__history = deque(maxlen=GPUTimer.HISTORY)
+        self.__resolvedFrames = 0
+
+    def __acquireQuery(self):
+        if self.__freeQueries:
+            return self.__freeQueries.pop()
+        return int(glGenQueries(1))
+
+    def __recycle(self, frame):
+        for entry in frame:
+            self.__freeQueries.append(entry[1])
+
+    def __poll(self):
+        # resolve frames in order, stop at the first one the GPU is still working on
+        while self.__pending:
+            frame = self.__pending[0]
+            if not frame:
+                # nothing was drawn, keep showing the previous results
+                self.__pending.popleft()
+                continue
+            if not glGetQueryObjectuiv(frame[-1][1], GL_QUERY_RESULT_AVAILABLE):
+                break
+            self.__pending.popleft()
+            self.__results = [(label, cpuSeconds, glGetQueryObjectui64v(query, GL_QUERY_RESULT) * 1e-9) for label, query, cpuSeconds in frame]
+            self.__history.append(self.__results)
+            self.__resolvedFrames += 1
+            self.__recycle(frame)
+
+        # never wait on the GPU, drop data we can not get in time
+        while len(self.__pending) >= GPUTimer.FRAMES_IN_FLIGHT:
+            self.__recycle(self.__pending.popleft())
+
+    def beginFrame(self):
+        if self.__current is not None:
+            # an error interrupted the previous frame, its results are dropped
+            glEndQuery(GL_TIME_ELAPSED)
+            self.__freeQueries.append(self.__current[1])
+            self.__current = None
+        if self.__frame is not None:
+            self.__recycle(self.__frame)
+        self.__poll()
+        self.__frame = []
+
+    def begin(self, label):
+        assert self.__current is None, 'GPU timer sections can not be nested.'
+        query = self.__acquireQuery()
+        glBeginQuery(GL_TIME_ELAPSED, query)
+        self.__current = label, query, time.clock()
+
+    def end(self):
+        label, query, startT = self.__current
+        glEndQuery(GL_TIME_ELAPSED)
+        self.__frame.append((label, query, time.clock() - startT))
+        self.__current = None
+
+    @contextmanager
+    def section(self, label):
+        """
+        Time the GL work in the with block, the query is ended even if the block raises.
+        """
+        self.begin(label)
+        try:
+            yield
+        finally:
+            self.end()
+
+    def endFrame(self):
+        self.__pending.append(self.__frame)
+        self.__frame = None
+
+    def results(self):
+        """
+        :returns: List of (label, cpu submit seconds, gpu seconds) of the last resolved frame.
+        :rtype: list[(str, float, float)]
+        """
+        return self.__results
+
+    def resultsSince(self, resolvedFrames):
+        """
+        :param int resolvedFrames: Value of resolvedFrames() at an earlier time, or None for just the last resolved frame.
+        :returns: results() of every frame resolved since then, oldest first, as far as they are kept.
+        """
+        if resolvedFrames is None:
+            resolvedFrames = self.__resolvedFrames - 1
+        count = min(max(0, self.__resolvedFrames - resolvedFrames), len(self.__history))
+        return list(self.__history)[len(self.__history) - count:]
+
+    def resolvedFrames(self):
+        """
+        Number of frames resolved so far, can be used to tell if results() changed.
+        """
+        return self.__resolvedFrames
+
+
+@contextmanager
+def noSection():
+    """
+    Stands in for GPUTimer.section() when not profiling.
+    """
+    yield
@@ -1,27 +1,102 @@
 """
-Utility to load ".r32" files which are just raw binary float32 dumps of a single channel square texture with no extra data in the file.
-"""
+Utility to load ".r32" and ".r16" files which are raw binary dumps of a single channel texture.
 
-import stat
-import mmap
+Without any extra data the file is a square float32 (.r32) or unsigned 16 bit (.r16) texture,
+so the resolution is the square root of the number of pixels.
+An optional sidecar file next to it, named like the file with ".xml" appended, can describe other layouts:
+    <Heightfield width="4096" height="2048" format="float16"/>
+Supported formats are float32, float16 and uint16 (normalized to 0-1 in the shader).
+
+Files are mapped read-only and uploaded straight from the mapping, large files are uploaded
+in bands of rows so we never need to hold more than a band in memory.
+"""
+from pycompat import *
 import os
+import mmap
 from math import sqrt
-import ctypes
+from OpenGL.GL import *
 from buffers import Texture
 from fileutil import FilePath
+from xmlutil import parseXMLWithIncludes
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# format name: texture channels, bytes per pixel, numpy dtype
+FORMATS = {
+    'float32': (Texture.R32F, 4, 'float32'),
+    'float16': (Texture.R16F, 2, 'float16'),
+    'uint16': (Texture.R16, 2, 'uint16'),
+}
+DEFAULT_FORMATS = {'.r32': 'float32', '.r16': 'uint16'}
+EXTENSIONS = tuple(DEFAULT_FORMATS.keys())
+# upload at most this many bytes at once
+BAND_BYTES = 32 * 1024 * 1024
+
+
+def sidecarPath(filePath):
+    return FilePath(filePath + '.xml')
+
+
+def heightfieldLayout(filePath):
+    """
+    :returns: width, height and format name of the given heightfield file.
+    :rtype: (int, int, str)
+    """
+    assert isinstance(filePath, FilePath)
+    fmt = DEFAULT_FORMATS.get(filePath.ext().lower(), 'float32')
+    sidecar = sidecarPath(filePath)
+    if sidecar.exists():
+        xRoot = parseXMLWithIncludes(sidecar)
+        fmt = xRoot.attrib.get('format', fmt)
+        if fmt not in FORMATS:
+            raise ValueError('Unknown heightfield format "%s" in %s' % (fmt, sidecar))
+        if 'width' in xRoot.attrib and 'height' in xRoot.attrib:
+            return int(xRoot.attrib['width']), int(xRoot.attrib['height']), fmt
+    bytesPerPixel = FORMATS[fmt][1]
+    resolution = int(sqrt(os.path.getsize(filePath) // bytesPerPixel))
+    return resolution, resolution, fmt
 
 
 def loadHeightfield(filePath):
     assert isinstance(filePath, FilePath)
-    # data is a single float32 color channel
-    # so resolution is sqrt(number of floats)
-    resolution = int(sqrt(os.path.getsize(filePath) / 4))
-    # mmap can't return a pointer, so we have to use from_buffer, which in turn requires file to be writable
-    os.chmod(filePath, stat.S_IREAD | stat.S_IWRITE | stat.S_IRGRP | stat.S_IROTH)
-    fd = os.open(filePath, os.O_RDWR | os.O_BINARY)
-    try:
-        ptr = (ctypes.c_float * (resolution * resolution)).from_buffer(mmap.mmap(fd, 0))
-        tex = Texture(Texture.R32F, resolution, resolution, tile=True, data=ptr)
-    finally:
-        os.close(fd)
-    return tex
+    width, height, fmt = heightfieldLayout(filePath)
+    channels, bytesPerPixel, dtype = FORMATS[fmt]
+    rowBytes = width * bytesPerPixel
+    if os.path.getsize(filePath) < rowBytes * height:
+        raise ValueError('Heightfield %s is smaller than %sx%s %s pixels.' % (filePath, width, height, fmt))
+
+    # rows are tightly packed
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+    rowsPerBand = max(1, BAND_BYTES // rowBytes)
+
+    with open(filePath, 'rb') as fh:
+        if numpy is not None:
+            # read-only mapping, the driver reads straight from the page cache
+            mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            pixels = band = None
+            try:
+                pixels = numpy.frombuffer(mapped, dtype=dtype, count=width * height).reshape(height, width)
+                if rowsPerBand >= height:
+                    tex = Texture(channels, width, height, tile=True, data=pixels)
+                else:
+                    tex = Texture(channels, width, height, tile=True)
+                    for y in range(0, height, rowsPerBand):
+                        band = pixels[y:y + rowsPerBand]
+                        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, y, width, band.shape[0], channels[1], channels[2], band)
+            finally:
+                # arrays into the mapping keep it open, which locks the file on Windows and breaks reloading it
+                del band, pixels
+                mapped.close()
+            return tex
+
+        # without numpy read bands of rows, so large files don't need to fit in memory at once
+        if rowsPerBand >= height:
+            return Texture(channels, width, height, tile=True, data=fh.read(rowBytes * height))
+        tex = Texture(channels, width, height, tile=True)
+        for y in range(0, height, rowsPerBand):
+            rows = min(rowsPerBand, height - y)
+            glTexSubImage2D(GL_TEXTURE_2D, 0, 0, y, width, rows, channels[1], channels[2], fh.read(rowBytes * rows))
+        return tex
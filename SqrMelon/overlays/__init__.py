@@ -12,8 +12,6 @@ import sys
 
 def loadImage(filePath, tile=True):
     assert isinstance(filePath, FilePath)
-    texId = glGenTextures(1)
-    glBindTexture(GL_TEXTURE_2D, texId)
     glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
     tex = QGLWidget.convertToGLFormat(QImage(filePath))
     if sys.version_info.major == 3:
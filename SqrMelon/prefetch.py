@@ -0,0 +1,181 @@
+"""
+Loads, compiles and pre-renders the scenes of upcoming shots before playback reaches them.
+"""
+from pycompat import *
+from qtutil import *
+from scene import Scene
+from util import SCENE_EXT, currentScenesDirectory
+
+
+class ScenePrefetcher(object):
+    """
+    Looks ahead along the enabled shots from the current time and prepares their scenes
+    in idle slices of the event loop. Preparing a scene is split in stages:
+        load: parse the scene & compile its programs
+        allocate: create the frame buffers at the current view size
+        warm: render all passes once, baking static passes and finishing driver side compilation
+    Only one stage runs per slice, so the UI stays responsive in between.
+    During playback the work is only scheduled when the current shot changes.
+    Scenes are only allocated while they fit in Scene.budgetBytes() together with the scenes
+    on screen and coming up before them, less important scenes are released to make room.
+    """
+    LOOK_AHEAD_SECONDS = 10.0
+    STAGES = 'load', 'allocate', 'warm'
+
+    def __init__(self, shotManager, timer, sceneView):
+        """
+        :type shotManager: shots.ShotManager
+        :type timer: timeslider.Timer
+        :type sceneView: sceneview3d.SceneView
+        """
+        self.__shotManager = shotManager
+        self.__timer = timer
+        self.__sceneView = sceneView
+        self.__queue = []
+        self.__warmed = set()
+        self.__currentShot = None
+        self.__upcoming = []
+        self.__idle = QTimer()
+        self.__idle.setInterval(0)
+        self.__idle.timeout.connect(self.__step)
+
+    def reset(self):
+        """
+        Forget what was prepared, e.g. when a project was opened.
+        """
+        self.__warmed.clear()
+        self.__currentShot = None
+        self.__upcoming = []
+        self.__queue = []
+        self.__idle.stop()
+
+    def isPrepared(self, sceneFile, stage):
+        if stage == 'load':
+            return sceneFile in Scene.cache
+        # scenes may have been released to stay within the memory budget
+        if sceneFile not in Scene.resident:
+            self.__warmed.discard(sceneFile)
+            return False
+        if stage == 'allocate':
+            return True
+        return sceneFile in self.__warmed
+
+    def upcomingShots(self, time):
+        """
+        Enabled shots that start within LOOK_AHEAD_SECONDS from time, in order of appearance.
+        Wraps around to the start of the loop range when the look ahead passes its end.
+        """
+        end = time + self.__timer.secondsToBeats(ScenePrefetcher.LOOK_AHEAD_SECONDS)
+        ranges = [(time, min(end, self.__timer.end))]
+        if end > self.__timer.end:
+            ranges.append((self.__timer.start, self.__timer.start + end - self.__timer.end))
+        shots = [shot for shot in self.__shotManager.shots() if shot.enabled]
+        result = []
+        for start, end in ranges:
+            for shot in sorted(shots, key=lambda shot: shot.start):
+                if shot.end > start and shot.start < end and shot not in result:
+                    result.append(shot)
+        return result
+
+    def onTimeChanged(self, *args):
+        """
+        Schedule when playback reaches another shot, rather than on every frame.
+        """
+        if self.__shotManager.shotAtTime(self.__timer.time) is not self.__currentShot:
+            self.schedule()
+
+    def schedule(self, *args):
+        current = self.__shotManager.shotAtTime(self.__timer.time)
+        self.__currentShot = current
+        self.__upcoming = self.upcomingShots(self.__timer.time)
+        queue = []
+        for shot in self.__upcoming:
+            if current is not None and shot.sceneName == current.sceneName:
+                continue
+            sceneFile = currentScenesDirectory().join(shot.sceneName + SCENE_EXT)
+            for stage in ScenePrefetcher.STAGES:
+                if not self.isPrepared(sceneFile, stage):
+                    queue.append((shot, stage))
+        self.__queue = queue
+        if queue and not self.__idle.isActive():
+            self.__idle.start()
+
+    def __step(self):
+        if not self.__queue:
+            self.__idle.stop()
+            return
+        shot, stage = self.__queue.pop(0)
+        # the scene on screen and those of shots that come up earlier are more important than this one
+        keep = self.__sceneFiles([self.__currentShot] + self.__upcoming[:self.__upcoming.index(shot)])
+        if not self.prepare(shot, stage, keep):
+            # budget is full, later shots would not fit either
+            self.__queue = []
+
+    def __sceneFiles(self, shots):
+        return {currentScenesDirectory().join(shot.sceneName + SCENE_EXT) for shot in shots if shot is not None}
+
+    def __makeRoom(self, scene, keep):
+        """
+        Release least recently used scenes until the resident scenes fit the budget.
+        :param set keep: Scene files that are never released.
+        :returns: False if scene does not fit, it is released again in that case.
+        """
+        for sceneFile, other in list(Scene.resident.items()):
+            if Scene.residentBytes() <= Scene.budgetBytes():
+                return True
+            if other is not scene and sceneFile not in keep:
+                other.releaseGLResources()
+        if Scene.residentBytes() <= Scene.budgetBytes():
+            return True
+        scene.releaseGLResources()
+        return False
+
+    def prepare(self, shot, stage, keep=()):
+        """
+        :param set keep: Scene files that must stay resident, e.g. the one on screen.
+        :returns: False if the scene of shot does not fit in the budget.
+        """
+        sceneFile = currentScenesDirectory().join(shot.sceneName + SCENE_EXT)
+        if not sceneFile.exists() or self.isPrepared(sceneFile, stage):
+            return True
+        scene = Scene.getScene(sceneFile)
+        if stage == 'load':
+            return True
+        self.__sceneView.allocateScene(scene)
+        if not self.__makeRoom(scene, keep):
+            return False
+        if stage == 'warm':
+            self.__sceneView.warmScene(scene, shot)
+            self.__warmed.add(sceneFile)
+        return True
+
+    def warmAll(self, parent=None):
+        """
+        Prepare the scenes of all enabled shots, showing a progress dialog.
+        """
+        shots = []
+        sceneNames = set()
+        for shot in self.__shotManager.shots():
+            if shot.enabled and shot.sceneName not in sceneNames:
+                sceneNames.add(shot.sceneName)
+                shots.append(shot)
+
+        stages = ScenePrefetcher.STAGES
+        progress = QProgressDialog('Warming up scenes...', 'Cancel', 0, len(shots) * len(stages), parent)
+        progress.setWindowModality(Qt.WindowModal)
+        # scenes warmed earlier are not released to make room for later ones
+        keep = self.__sceneFiles([self.__shotManager.shotAtTime(self.__timer.time)])
+        for i, shot in enumerate(shots):
+            progress.setLabelText('Warming up %s' % shot.sceneName)
+            for j, stage in enumerate(stages):
+                progress.setValue(i * len(stages) + j)
+                QApplication.processEvents()
+                if progress.wasCanceled():
+                    return
+                if not self.prepare(shot, stage, keep):
+                    progress.close()
+                    QMessageBox.information(parent, 'Warm all scenes', 'Warmed %s of %s scenes, the others do not fit in the scene cache budget '
+                                                                       '(SceneCacheBudgetMB).' % (i, len(shots)))
+                    return
+            keep.update(self.__sceneFiles([shot]))
+        progress.setValue(len(shots) * len(stages))
@@ -0,0 +1,122 @@
+"""
+Rolling history of per-pass profile results with statistics and export.
+"""
+from pycompat import *
+import csv
+import json
+import time
+from collections import deque, OrderedDict
+
+
+def percentile(sortedValues, fraction):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sortedValues:
+        return 0.0
+    index = min(len(sortedValues) - 1, max(0, int(round(fraction * (len(sortedValues) - 1)))))
+    return sortedValues[index]
+
+
+class PassStats(object):
+    def __init__(self, samples, spikeFactor):
+        """
+        :param list[float] samples: GPU seconds, oldest first.
+        """
+        ordered = sorted(samples)
+        self.count = len(samples)
+        self.min = ordered[0] if ordered else 0.0
+        self.max = ordered[-1] if ordered else 0.0
+        self.mean = sum(ordered) / len(ordered) if ordered else 0.0
+        self.median = percentile(ordered, 0.5)
+        self.p95 = percentile(ordered, 0.95)
+        self.p99 = percentile(ordered, 0.99)
+        # a spike is a frame that takes a lot longer than a typical frame
+        self.spikeThreshold = self.median * spikeFactor
+        self.spikes = [i for i, value in enumerate(samples) if self.median and value > self.spikeThreshold]
+
+
+class ProfileHistory(object):
+    """
+    Keeps the last HISTORY_SIZE resolved frames for every pass.
+    Each sample is (frame index, wall clock seconds at which it was recorded, cpu seconds, gpu seconds).
+    """
+    HISTORY_SIZE = 4096
+    SPIKE_FACTOR = 2.0
+    STATS_INTERVAL = 0.5  # seconds between statistics updates, sorting thousands of samples every frame is not free
+
+    def __init__(self):
+        self.__passes = OrderedDict()
+        self.__frameIndex = 0
+        self.__stats = {}
+        self.__statsTime = 0.0
+
+    def clear(self):
+        self.__passes.clear()
+        self.__stats = {}
+        self.__frameIndex = 0
+
+    def addFrame(self, profileLog):
+        """
+        :param list[(str, float, float)] profileLog: (label, cpu seconds, gpu seconds) per pass.
+        """
+        now = time.time()
+        for label, cpuSeconds, gpuSeconds in profileLog:
+            if label not in self.__passes:
+                self.__passes[label] = deque(maxlen=ProfileHistory.HISTORY_SIZE)
+            self.__passes[label].append((self.__frameIndex, now, cpuSeconds, gpuSeconds))
+        self.__frameIndex += 1
+
+    def labels(self):
+        return list(self.__passes.keys())
+
+    def gpuSamples(self, label):
+        return [sample[3] for sample in self.__passes.get(label, ())]
+
+    def stats(self, force=False):
+        """
+        :rtype: dict[str, PassStats]
+        """
+        now = time.time()
+        if force or now - self.__statsTime > ProfileHistory.STATS_INTERVAL:
+            self.__statsTime = now
+            self.__stats = dict((label, PassStats(self.gpuSamples(label), ProfileHistory.SPIKE_FACTOR)) for label in self.__passes)
+        return self.__stats
+
+    def exportCsv(self, filePath):
+        with filePath.edit('w') as fh:
+            writer = csv.writer(fh, lineterminator='\n')
+            writer.writerow(('frame', 'time', 'pass', 'cpu_ms', 'gpu_ms'))
+            rows = []
+            for label in self.__passes:
+                for frameIndex, wallTime, cpuSeconds, gpuSeconds in self.__passes[label]:
+                    rows.append((frameIndex, wallTime, label, cpuSeconds * 1000.0, gpuSeconds * 1000.0))
+            rows.sort(key=lambda row: row[0])
+            for row in rows:
+                writer.writerow(row)
+
+    def exportChromeTrace(self, filePath):
+        """
+        Writes a JSON file that can be opened in chrome://tracing or Perfetto.
+        Passes of a frame are laid out back to back from the moment the frame was recorded,
+        GPU and CPU timings are shown on separate tracks.
+        """
+        frames = {}
+        for label in self.__passes:
+            for frameIndex, wallTime, cpuSeconds, gpuSeconds in self.__passes[label]:
+                frames.setdefault(frameIndex, (wallTime, []))[1].append((label, cpuSeconds, gpuSeconds))
+
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': 0, 'args': {'name': 'GPU'}},
+                  {'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': 1, 'args': {'name': 'CPU submit'}}]
+        for frameIndex in sorted(frames):
+            wallTime, entries = frames[frameIndex]
+            # the order of the labels in the history is the order in which passes were first seen
+            gpuCursor = cpuCursor = wallTime * 1e6
+            for label, cpuSeconds, gpuSeconds in entries:
+                events.append({'name': label, 'cat': 'gpu', 'ph': 'X', 'pid': 0, 'tid': 0, 'ts': gpuCursor, 'dur': gpuSeconds * 1e6, 'args': {'frame': frameIndex}})
+                events.append({'name': label, 'cat': 'cpu', 'ph': 'X', 'pid': 0, 'tid': 1, 'ts': cpuCursor, 'dur': cpuSeconds * 1e6, 'args': {'frame': frameIndex}})
+                gpuCursor += gpuSeconds * 1e6
+                cpuCursor += cpuSeconds * 1e6
+
+        with filePath.edit('w') as fh:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fh)
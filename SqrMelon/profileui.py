@@ -1,13 +1,21 @@
 import functools
 
 from qtutil import *
+from fileutil import FileDialog
+from profilehistory import ProfileHistory
+from texturepool import TexturePool
 from util import randomColor, gSettings
 
 
 class _ProfileRenderer(QWidget):
-    def __init__(self):
+    TIMELINE_HEIGHT = 24
+    ROW_HEIGHT = 20
+    LABEL_WIDTH = 320
+
+    def __init__(self, history):
         super(_ProfileRenderer, self).__init__()
         self.scene = None
+        self.history = history
         self.tooltipinfo = {}
         self.setMouseTracking(True)
 
@@ -27,9 +35,10 @@ class _ProfileRenderer(QWidget):
         cursor = 0.0
         self.tooltipinfo.clear()
         for i, entry in enumerate(self.scene.profileLog):
-            label, seconds = entry
-            text = '%s %ims' % (label, round(seconds * 1000.0))
-            rect = QRectF(cursor * scale, 0, seconds * scale, self.height())
+            # bars show GPU time, CPU time is what it cost to submit the pass
+            label, cpuSeconds, seconds = entry
+            text = '%s %.2fms GPU / %.2fms CPU' % (label, seconds * 1000.0, cpuSeconds * 1000.0)
+            rect = QRectF(cursor * scale, 0, seconds * scale, _ProfileRenderer.TIMELINE_HEIGHT)
             self.tooltipinfo[text] = rect
             painter.setPen(Qt.NoPen)
             painter.setBrush(QColor.fromRgb(*randomColor(i * 0.1357111317)))
@@ -39,6 +48,42 @@ class _ProfileRenderer(QWidget):
             painter.drawText(rect, 0, text)
             cursor += seconds
 
+        self._drawHistory(painter)
+
+    def _drawHistory(self, painter):
+        stats = self.history.stats()
+        y = _ProfileRenderer.TIMELINE_HEIGHT + 4
+        sparkWidth = self.width() - _ProfileRenderer.LABEL_WIDTH
+        for i, label in enumerate(self.history.labels()):
+            if label not in stats:
+                continue
+            passStats = stats[label]
+            rowRect = QRectF(0, y, _ProfileRenderer.LABEL_WIDTH, _ProfileRenderer.ROW_HEIGHT)
+            painter.setPen(self.palette().color(QPalette.WindowText))
+            painter.drawText(rowRect, Qt.AlignVCenter, '%s  %.2f / %.2f / %.2f / %.2f ms  %i spikes' % (
+                label, passStats.min * 1000.0, passStats.mean * 1000.0, passStats.p95 * 1000.0, passStats.p99 * 1000.0, len(passStats.spikes)))
+            self.tooltipinfo['%s\nmin / mean / p95 / p99 over %i frames' % (label, passStats.count)] = rowRect
+
+            # sparkline of the most recent samples that fit, scaled so the p99 sits near the top
+            allSamples = self.history.gpuSamples(label)
+            offset = max(0, len(allSamples) - max(1, int(sparkWidth)))
+            samples = allSamples[offset:]
+            spikes = set(passStats.spikes)
+            top = passStats.p99 * 1.25
+            if samples and top > 0.0 and sparkWidth > 0:
+                points = [QPointF(_ProfileRenderer.LABEL_WIDTH + x, y + _ProfileRenderer.ROW_HEIGHT * (1.0 - min(1.0, value / top)))
+                          for x, value in enumerate(samples)]
+                painter.setPen(QColor.fromRgb(*randomColor(i * 0.1357111317)))
+                for a, b in zip(points, points[1:]):
+                    painter.drawLine(a, b)
+                painter.setPen(Qt.red)
+                for x, value in enumerate(samples):
+                    if x + offset in spikes:
+                        painter.drawLine(points[x], QPointF(points[x].x(), y + _ProfileRenderer.ROW_HEIGHT))
+            y += _ProfileRenderer.ROW_HEIGHT
+            if y > self.height():
+                break
+
 
 class Profiler(QWidget):
     """
@@ -49,7 +94,9 @@ class Profiler(QWidget):
     def __init__(self):
         super(Profiler, self).__init__()
         Profiler.instance = self
-        self._renderer = _ProfileRenderer()
+        self.history = ProfileHistory()
+        self._renderer = _ProfileRenderer(self.history)
+        self._lastFrameId = None
         self.frameTimes = []
         self.setLayout(vlayout())
         h = QHBoxLayout()
@@ -60,6 +107,16 @@ class Profiler(QWidget):
         h.addWidget(self._sub)
         self._enabled = CheckBox('Enabled')
         h.addStretch()
+        self._glCalls = QLabel()
+        h.addWidget(self._glCalls)
+        self._texturePool = QLabel()
+        h.addWidget(self._texturePool)
+        for label, callback in (('Clear history', self.history.clear),
+                                ('Export CSV', self._exportCsv),
+                                ('Export trace', self._exportChromeTrace)):
+            btn = QPushButton(label)
+            btn.clicked.connect(callback)
+            h.addWidget(btn)
         self._enabled.setChecked(gSettings.value('ProfilerEnabled', 'false') == 'true')
         self._enabled.toggled.connect(functools.partial(gSettings.setValue, 'ProfilerEnabled'))
         h.addWidget(self._enabled)
@@ -69,6 +126,16 @@ class Profiler(QWidget):
         self._sub.valueChanged.connect(self._setDebugPass)
         self._passes.currentIndexChanged.connect(self._setDebugPass)
 
+    def _exportCsv(self):
+        filePath = FileDialog.getSaveFileName(self, 'Export profile history', '', 'Comma separated values (*.csv)')
+        if filePath:
+            self.history.exportCsv(filePath.ensureExt('csv'))
+
+    def _exportChromeTrace(self):
+        filePath = FileDialog.getSaveFileName(self, 'Export profile history', '', 'Chrome trace (*.json)')
+        if filePath:
+            self.history.exportChromeTrace(filePath.ensureExt('json'))
+
     def isProfiling(self):
         return self._enabled.isChecked()
 
@@ -93,6 +160,8 @@ class Profiler(QWidget):
             self._renderer.scene.profileInfoChanged.disconnect(self._update)
 
         self._renderer.scene = scene
+        self.history.clear()
+        self._lastFrameId = None
         if self._renderer.scene is not None:
             # enforce no debug state
             self._setDebugPass(-1, 0)
@@ -114,4 +183,21 @@ class Profiler(QWidget):
         if not self.isProfiling():
             return
 
+        scene = self._renderer.scene
+        if scene is not None and scene.profileFrameId != self._lastFrameId:
+            # several frames can resolve at once, add all of them
+            for profileLog in scene.profileResultsSince(self._lastFrameId):
+                self.history.addFrame(profileLog)
+            self._lastFrameId = scene.profileFrameId
+
+        if scene is not None:
+            # redundant GL state changes that were skipped by the shadow state
+            counters = scene.glStateCounters
+            self._glCalls.setText('GL state calls: %i issued / %i skipped' % (sum(c[0] for c in counters.values()), sum(c[1] for c in counters.values())))
+            self._glCalls.setToolTip('\n'.join('%s: %i issued / %i skipped' % (name, issued, skipped) for name, (issued, skipped) in counters.items()))
+
+        numTextures, numBytes, referenced, loading = TexturePool.usage()
+        self._texturePool.setText('Textures: %i (%i in use, %i loading) %.1f / %i MB' % (
+            numTextures, referenced, loading, numBytes / 1048576.0, TexturePool.budgetBytes() // 1048576))
+
         self._renderer.repaint()
@@ -0,0 +1,90 @@
+"""
+Python scripts in the project folder that run every frame, such as animationprocessor.py.
+
+Scripts are compiled once and recompiled when the file watcher reports a change, the file is watched whenever it is compiled.
+Two styles are supported:
+
+Legacy, the whole file runs every frame with the caller's variables in scope:
+    uniforms['uV'] = ...
+
+Module style, the file runs once and its process() function is called every frame,
+so imports and precomputed state are kept across frames:
+    import cgmath
+    def process(uniforms, cameraData, scene, beats):
+        uniforms['uV'] = ...
+"""
+from pycompat import *
+import ast
+from fileutil import FileSystemWatcher
+from util import currentProjectDirectory
+
+HOOK_NAME = 'process'
+
+
+class ProjectScript(object):
+    def __init__(self, fileName):
+        self.__fileName = fileName
+        self.__path = None
+        self.__code = None
+        self.__module = None
+        self.__watcher = None
+
+    def __invalidate(self, *args):
+        self.__code = None
+        self.__module = None
+
+    def __load(self):
+        path = currentProjectDirectory().join(self.__fileName)
+        if path != self.__path:
+            # project changed
+            if self.__watcher is None:
+                self.__watcher = FileSystemWatcher()
+                self.__watcher.fileChanged.connect(self.__invalidate)
+            elif self.__path is not None:
+                self.__watcher.removePath(self.__path)
+            self.__path = path
+            self.__code = None
+            self.__module = None
+
+        if self.__code is not None:
+            return True
+        if not path.exists():
+            return False
+
+        # watch whatever gets compiled, the file may have been created after the project was opened
+        # and editors often replace the file on save, which removes it from the watcher
+        if path not in self.__watcher.files():
+            self.__watcher.addPath(path)
+        source = path.content()
+        self.__code = compile(source, str(path), 'exec')
+        isModule = any(isinstance(node, ast.FunctionDef) and node.name == HOOK_NAME for node in ast.parse(source).body)
+        if isModule:
+            self.__module = {'__name__': path.name(), '__file__': str(path)}
+            exec(self.__code, self.__module)
+        return True
+
+    def run(self, globals_, locals_):
+        """
+        Run the script if it exists in the current project.
+        :param dict globals_: Globals for legacy scripts.
+        :param dict locals_: Must contain uniforms, cameraData, scene & beats.
+        """
+        if not self.__load():
+            return
+        if self.__module is not None:
+            self.__module[HOOK_NAME](locals_['uniforms'], locals_['cameraData'], locals_['scene'], locals_['beats'])
+        else:
+            exec(self.__code, globals_, locals_)
+
+
+_scripts = {}
+
+
+def projectScript(fileName):
+    """
+    Shared instance per script name.
+    :rtype: ProjectScript
+    """
+    if fileName not in _scripts:
+        _scripts[fileName] = ProjectScript(fileName)
+    return _scripts[fileName]
@@ -6,9 +6,21 @@ gSettings = QSettings('PB', 'Py64k')
 PROJ_EXT = '.p64'
 TEMPLATE_EXT = '.xml'
 SCENE_EXT = '.xml'
+# set by tools that work on a given project without changing the editor's current project
+_projectOverride = None
+
+
+def overrideCurrentProjectFilePath(value):
+    """
+    Use the given project for this process only, pass None to go back to the project in the settings.
+    """
+    global _projectOverride
+    _projectOverride = None if value is None else FilePath(value)
 
 
 def currentProjectFilePath():
+    if _projectOverride is not None:
+        return _projectOverride
     if not gSettings.contains('currentproject'):
         return None
     return FilePath(gSettings.value('currentproject'))
@@ -0,0 +1,378 @@
+"""
+Headless offline renderer, renders a range of a project to disk without the editor:
+
+    python render.py path/to/project.p64 --start 0 --end 64 --height 1080 --fps 60 --output capture/frame_%05d.png
+    python render.py path/to/project.p64 --seconds --start 10 --end 20 --output capture/part.mp4 --audio song.wav
+
+Rendering happens on an offscreen OpenGL context, no window is ever shown. On machines without a display
+the Qt "offscreen" platform is used, combined with a software rasterizer such as Mesa's llvmpipe
+(LIBGL_ALWAYS_SOFTWARE=1) this works on build machines too.
+
+Frames are numbered by their index from the start of the demo, at the given frame rate, so
+renders of different ranges can be combined. Output ending in a video extension is streamed into ffmpeg,
+anything else is a file pattern for numbered images.
+
+With --workers the range is split in chunks rendered by that many processes in parallel,
+which scales with the number of cores when rendering with a software rasterizer.
+"""
+from pycompat import *
+import os
+import sys
+import time
+import re
+import argparse
+import threading
+import subprocess
+from multiprocessing.pool import ThreadPool
+from xml.etree import cElementTree
+from OpenGL.GL import *
+from qtutil import *
+from buffers import Texture, FrameBuffer
+from fileutil import FilePath
+from capture import FrameCapture, FFmpegSink, ImageSequenceSink
+from projectscript import projectScript
+from scene import Scene, CameraTransform
+from sceneview3d import SceneView, loadToolTextures
+from shots import iterAllShots, shotAtTime
+from texturepool import TexturePool
+from util import PROJ_EXT, SCENE_EXT, overrideCurrentProjectFilePath, currentProjectFilePath, currentProjectDirectory, currentScenesDirectory
+
+VIDEO_EXTENSIONS = '.mp4', '.mkv', '.mov', '.avi'
+# more chunks than workers, so a chunk that renders slowly does not leave the other workers idle at the end
+CHUNKS_PER_WORKER = 4
+PROGRESS_PATTERN = re.compile(r'^Rendered (\d+)/(\d+) frames')
+
+
+class OffscreenContext(object):
+    """
+    OpenGL context without a window, rendering into a frame buffer object of the given size.
+    The frame buffer replaces the screen, so Scene.drawToScreen presents into it.
+    """
+
+    def __init__(self, width, height):
+        if qt_wrapper in ('PySide', 'PyQt4'):
+            # Qt 4 has no offscreen surfaces, a widget that is never shown still owns a context
+            glFormat = QGLFormat()
+            glFormat.setVersion(4, 1)
+            glFormat.setProfile(QGLFormat.CoreProfile)
+            self.__widget = QGLWidget(glFormat)
+            self.__surface = None
+            self.__context = None
+        else:
+            glFormat = QSurfaceFormat()
+            glFormat.setVersion(4, 1)
+            glFormat.setProfile(QSurfaceFormat.CoreProfile)
+            self.__widget = None
+            self.__surface = QOffscreenSurface()
+            self.__surface.setFormat(glFormat)
+            self.__surface.create()
+            self.__context = QOpenGLContext()
+            self.__context.setFormat(glFormat)
+            if not self.__context.create():
+                raise RuntimeError('Could not create an OpenGL %s.%s context.' % (glFormat.majorVersion(), glFormat.minorVersion()))
+        self.makeCurrent()
+        print(glGetString(GL_VERSION))
+
+        glEnable(GL_DEPTH_TEST)
+        glDepthFunc(GL_LEQUAL)
+
+        self.__texture = Texture(Texture.RGBA8, width, height, tile=False)
+        self.__frameBuffer = FrameBuffer(width, height)
+        self.__frameBuffer.addTexture(self.__texture)
+        SceneView.screenFBO = self.__frameBuffer.id()
+
+    def makeCurrent(self):
+        if self.__widget is not None:
+            self.__widget.makeCurrent()
+        else:
+            self.__context.makeCurrent(self.__surface)
+
+    def texture(self):
+        """
+        Color buffer that holds what was drawn to the screen.
+        """
+        return self.__texture
+
+
+def projectTiming():
+    """
+    :returns: Beats per second, start and end of the timeline in beats, as stored in the current project.
+    :rtype: (float, float, float)
+    """
+    root = None
+    try:
+        root = cElementTree.fromstring(currentProjectFilePath().content())
+    except:
+        pass
+    if root is None:
+        return 2.0, 0.0, 8.0
+    return float(root.attrib.get('TimerBPS', 2.0)), float(root.attrib.get('TimerMinTime', 0.0)), float(root.attrib.get('TimerMaxTime', 8.0))
+
+
+class HeadlessRenderer(object):
+    """
+    Renders frames of the current project like the editor viewport would, without any widgets.
+    """
+
+    def __init__(self, width, height, textureTimeout=60.0):
+        self.__width = width
+        self.__height = height
+        self.__textureTimeout = textureTimeout
+        self.__context = OffscreenContext(width, height)
+        self.__shots = list(iterAllShots())
+        self.__textures = loadToolTextures()
+        self.beatsPerSecond = projectTiming()[0]
+
+    def context(self):
+        return self.__context
+
+    def renderFrame(self, beats):
+        """
+        Render the given time and wait for all file textures, so no placeholders end up in the frame.
+        Gives up after textureTimeout seconds and reports the textures that are still missing.
+        :returns: False if there is no shot at this time.
+        """
+        shot = shotAtTime(self.__shots, beats)
+        if shot is None:
+            return False
+        scene = Scene.getScene(currentScenesDirectory().join(shot.sceneName).ensureExt(SCENE_EXT))
+        scene.setSize(self.__width, self.__height)
+
+        uniforms = shot.evaluate(beats)
+        textureUniforms = shot.textures
+        if 'uOrigin' in uniforms and 'uAngles' in uniforms:
+            cameraData = CameraTransform(*(uniforms['uOrigin'] + uniforms['uAngles']))
+        else:
+            cameraData = CameraTransform()
+
+        projectScript('animationprocessor.py').run(globals(), locals())
+
+        for name in self.__textures:
+            uniforms[name] = self.__textures[name]._id
+
+        seconds = beats / self.beatsPerSecond
+        viewport = 0, 0, self.__width, self.__height
+        scene.drawToScreen(seconds, beats, uniforms, viewport, textureUniforms)
+        deadline = time.time() + self.__textureTimeout
+        pending = TexturePool.pendingFiles()
+        while pending:
+            decoding = TexturePool.waitForPending(max(0.0, deadline - time.time()))
+            if decoding:
+                print('Warning, gave up waiting for textures at beat %s: %s' % (beats, ', '.join(decoding)))
+                break
+            scene.drawToScreen(seconds, beats, uniforms, viewport, textureUniforms)
+            remaining = TexturePool.pendingFiles()
+            if set(remaining) >= set(pending):
+                # decoded but not fetched again, so this frame does not use them
+                break
+            pending = remaining
+        return True
+
+
+def createSink(width, height, fps, output, ffmpegPath='ffmpeg', audioPath=None, audioOffset=0.0, encoders=4):
+    if os.path.splitext(output)[-1].lower() in VIDEO_EXTENSIONS:
+        return FFmpegSink(width, height, fps, output, ffmpegPath, audioPath, audioOffset)
+    return ImageSequenceSink(width, height, output, encoders)
+
+
+def render(renderer, frames, fps, sink, report=None):
+    """
+    Render the given frame indices, where frame index / fps is the time in seconds.
+    :param callable report: Called with the number of frames done so far.
+    """
+    capture = FrameCapture(renderer.context().texture().width(), renderer.context().texture().height(), sink)
+    lastReport = 0.0
+    for done, frame in enumerate(frames):
+        if report is not None and time.time() - lastReport > 0.5:
+            lastReport = time.time()
+            report(done)
+        if renderer.renderFrame(frame * renderer.beatsPerSecond / float(fps)):
+            capture.capture(renderer.context().texture(), frame)
+        else:
+            capture.skip(frame)
+    capture.finish()
+    if report is not None:
+        report(len(frames))
+
+
+def splitFrames(frames, numChunks):
+    """
+    Split a range of frame indices into at most numChunks consecutive (first, last) ranges of about equal length, last is excluded.
+    """
+    if not len(frames):
+        return []
+    numChunks = max(1, min(numChunks, len(frames)))
+    bounds = [frames[0] + (len(frames) * i) // numChunks for i in range(numChunks + 1)]
+    return [(bounds[i], bounds[i + 1]) for i in range(numChunks)]
+
+
+class ParallelRender(object):
+    """
+    Splits the frames in chunks that are rendered by worker processes running this script,
+    each with its own offscreen context and scene cache.
+
+    Images are written by the workers straight into the output pattern, names only depend on the frame index.
+    Video output is rendered to a file per chunk, those are joined in order by ffmpeg when all chunks are done.
+    Chunks that fail are rendered again, up to the given number of retries.
+    """
+
+    def __init__(self, args, width, height, output, frames, workers, retries=2):
+        self.__args = args
+        self.__width = width
+        self.__height = height
+        self.__output = output
+        self.__frames = frames
+        self.__workers = workers
+        self.__retries = retries
+        self.__isVideo = os.path.splitext(output)[-1].lower() in VIDEO_EXTENSIONS
+        self.__chunks = splitFrames(frames, workers * CHUNKS_PER_WORKER)
+        self.__progress = [0] * len(self.__chunks)
+        self.__lock = threading.Lock()
+        self.__lastReport = 0.0
+
+    def __chunkOutput(self, index):
+        if not self.__isVideo:
+            return self.__output
+        base, ext = os.path.splitext(self.__output)
+        return '%s_part%04d%s' % (base, index, ext)
+
+    def __command(self, index):
+        args = self.__args
+        return [sys.executable, os.path.abspath(__file__), os.path.abspath(args.project),
+                '--frames', '%s:%s' % self.__chunks[index],
+                '--width', str(self.__width),
+                '--height', str(self.__height),
+                '--fps', str(args.fps),
+                '--output', str(self.__chunkOutput(index)),
+                '--ffmpeg', args.ffmpeg,
+                '--encoders', str(args.encoders),
+                '--texture-timeout', str(args.texture_timeout)]
+
+    def __setProgress(self, index, done):
+        with self.__lock:
+            self.__progress[index] = done
+            total = sum(self.__progress)
+            if time.time() - self.__lastReport > 0.5 or total == len(self.__frames):
+                self.__lastReport = time.time()
+                print('Rendered %s/%s frames' % (total, len(self.__frames)))
+                sys.stdout.flush()
+
+    def __renderChunk(self, index):
+        first, last = self.__chunks[index]
+        for attempt in range(self.__retries + 1):
+            self.__setProgress(index, 0)
+            process = subprocess.Popen(self.__command(index), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+            log = []
+            for line in iter(process.stdout.readline, ''):
+                match = PROGRESS_PATTERN.match(line)
+                if match:
+                    self.__setProgress(index, int(match.group(1)))
+                else:
+                    log.append(line)
+            if process.wait() == 0:
+                return True
+            with self.__lock:
+                print('Frames %s-%s failed (attempt %s of %s):\n%s' % (first, last - 1, attempt + 1, self.__retries + 1, ''.join(log[-20:])))
+        return False
+
+    def __mux(self):
+        base, ext = os.path.splitext(self.__output)
+        parts = [self.__chunkOutput(index) for index in range(len(self.__chunks))]
+        listFile = base + '_parts.txt'
+        with open(listFile, 'w') as fh:
+            for part in parts:
+                fh.write("file '%s'\n" % os.path.basename(part))
+        args = [self.__args.ffmpeg, '-y', '-f', 'concat', '-safe', '0', '-i', listFile]
+        if self.__args.audio:
+            args += ['-itsoffset', str(-self.__frames[0] / float(self.__args.fps)), '-i', self.__args.audio, '-shortest']
+        args += ['-c:v', 'copy', str(self.__output)]
+        subprocess.check_call(args)
+        for path in parts + [listFile]:
+            os.remove(path)
+
+    def run(self):
+        """
+        :returns: False if any chunk failed after all retries.
+        """
+        pool = ThreadPool(self.__workers)
+        try:
+            succeeded = pool.map(self.__renderChunk, range(len(self.__chunks)))
+        finally:
+            pool.close()
+            pool.join()
+        failed = [chunk for chunk, ok in zip(self.__chunks, succeeded) if not ok]
+        if failed:
+            print('Failed to render frames %s.' % ', '.join('%s-%s' % (first, last - 1) for first, last in failed))
+            return False
+        if self.__isVideo:
+            self.__mux()
+        return True
+
+
+def _parser():
+    parser = argparse.ArgumentParser(description='Render a range of a SqrMelon project to disk without the editor.')
+    parser.add_argument('project', help='Project file (%s).' % PROJ_EXT)
+    parser.add_argument('--start', type=float, help='Start of the range in beats, defaults to the start of the timeline.')
+    parser.add_argument('--end', type=float, help='End of the range in beats, defaults to the end of the timeline.')
+    parser.add_argument('--seconds', action='store_true', help='Interpret --start and --end as seconds instead of beats.')
+    parser.add_argument('--frames', help='FIRST:LAST frame indices to render, LAST is excluded. Overrides --start and --end.')
+    parser.add_argument('--height', type=int, default=720, help='Vertical resolution.')
+    parser.add_argument('--width', type=int, help='Horizontal resolution, defaults to 16:9.')
+    parser.add_argument('--fps', type=int, default=60)
+    parser.add_argument('--output', help='File pattern for numbered images such as capture/frame_%%05d.png, or a video file (%s) '
+                                         'encoded with ffmpeg. Relative paths are relative to the project folder. '
+                                         'Defaults to capture/dump_<fps>_%%05d.jpg.' % ', '.join(VIDEO_EXTENSIONS))
+    parser.add_argument('--ffmpeg', default='ffmpeg', help='ffmpeg executable, used for video output.')
+    parser.add_argument('--audio', help='Soundtrack to add to video output.')
+    parser.add_argument('--encoders', type=int, default=4, help='Number of threads encoding images.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes rendering in parallel.')
+    parser.add_argument('--texture-timeout', type=float, default=60.0, help='Seconds to wait for file textures to load before rendering a frame without them.')
+    parser.add_argument('--retries', type=int, default=2, help='How often a failed chunk of frames is rendered again when using multiple workers.')
+    return parser
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+
+    overrideCurrentProjectFilePath(os.path.abspath(args.project))
+    height = args.height
+    width = args.width or (height * 16) // 9
+    output = args.output or 'capture/dump_%s_%%05d.jpg' % args.fps
+    if not os.path.isabs(output):
+        output = currentProjectDirectory().join(output)
+    output = FilePath(output).abs()
+    output.parent().ensureExists(isFolder=True)
+
+    if args.frames:
+        first, last = args.frames.split(':')
+        frames = range(int(first), int(last))
+    else:
+        bps, minTime, maxTime = projectTiming()
+        start = minTime if args.start is None else args.start
+        end = maxTime if args.end is None else args.end
+        if not args.seconds:
+            start /= bps
+            end /= bps
+        frames = range(int(start * args.fps), int(end * args.fps))
+
+    if args.workers > 1:
+        return 0 if ParallelRender(args, width, height, output, frames, args.workers, args.retries).run() else 1
+
+    if sys.platform.startswith('linux') and not os.environ.get('DISPLAY') and not os.environ.get('WAYLAND_DISPLAY'):
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    app = QApplication(sys.argv[:1])
+
+    renderer = HeadlessRenderer(width, height, args.texture_timeout)
+    audioOffset = -frames[0] / float(args.fps) if len(frames) else 0.0
+    sink = createSink(width, height, args.fps, output, args.ffmpeg, args.audio, audioOffset, args.encoders)
+
+    def report(done):
+        print('Rendered %s/%s frames' % (done, len(frames)))
+        sys.stdout.flush()
+
+    render(renderer, frames, args.fps, sink, report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,3 +1,4 @@
+import os
 import re
 import time
 import sys
@@ -7,59 +8,21 @@ if sys.version_info.major == 3:
 from collections import OrderedDict
 from fileutil import FileSystemWatcher, FilePath
 from profileui import Profiler
+from gputimer import GPUTimer, noSection
+from glstate import gGLState
 from multiplatformutil import canValidateShaders
 
 from OpenGL.GL import shaders
 from OpenGL.GL.EXT import texture_filter_anisotropic
 
-from heightfield import loadHeightfield
+import staticcache
+from texturepool import TexturePool
 from buffers import *
 from qtutil import *
-from util import currentProjectFilePath, parseXMLWithIncludes, currentProjectDirectory, templatePathFromScenePath
+from util import currentProjectFilePath, parseXMLWithIncludes, currentProjectDirectory, templatePathFromScenePath, gSettings
 from gl_shaders import compileProgram
 
 
-class TexturePool(object):
-    """
-    Utility to fetch & bind textures by file path, loaded only once.
-    File paths are treated slash and case insensitive.
-    """
-    __cache = {}
-
-    @staticmethod
-    def fetchAndUse(fileName):
-        assert not '\\' in fileName
-
-        key = fileName.lower().replace('//', '/')
-        if key in TexturePool.__cache:
-            glBindTexture(GL_TEXTURE_2D, TexturePool.__cache[key])
-            return TexturePool.__cache[key]
-        parentPath = currentProjectDirectory()
-        fullName = parentPath.join(fileName)
-
-        # texture is a single channel raw32 heightmap
-        if fileName.endswith('.r32'):
-            tex = loadHeightfield(fullName)
-            TexturePool.__cache[key] = tex.id()
-            return tex.id()
-
-        # read file into openGL texture
-        img = QImage(fullName)
-        if img.isNull():
-            print('Warning, could not load texture %s.' % fullName)
-            TexturePool.__cache[key] = 0  # no texture
-            return 0
-        img = QGLWidget.convertToGLFormat(img)
-        tex = glGenTextures(1)
-        glBindTexture(GL_TEXTURE_2D, tex)
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, img.width(), img.height(), 0, GL_RGBA, GL_UNSIGNED_BYTE,
-                     ctypes.c_void_p(int(img.bits())))
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
-        TexturePool.__cache[key] = tex
-        return tex
-
-
 class PassData(object):
     def __init__(self,
                  vertStitches,
@@ -87,6 +50,8 @@ class PassData(object):
         self.downSampleFactor = downSampleFactor
         self.numOutputBuffers = numOutputBuffers
         self.drawCommand = drawCommand
+        # compiled once, the template is parsed again when it changes
+        self.drawCode = None if drawCommand is None else compile(drawCommand, '<drawcommand %s>' % name, 'exec')
         if is3d:
             assert not realtime, '3D textures can not be updated in real time.'
             assert not drawCommand, '3D textures can not be rendered using  custom drawing code.'
@@ -268,8 +233,26 @@ class FullScreenRectSingleton(object):
         return cls._instance
 
 
+def _enableMipMapFiltering(buffer):
+    mode = GL_TEXTURE_3D if isinstance(buffer, Texture3D) else GL_TEXTURE_2D
+    glTexParameteri(mode,
+                    GL_TEXTURE_MIN_FILTER,
+                    GL_LINEAR_MIPMAP_LINEAR)
+    glTexParameteri(mode,
+                    GL_TEXTURE_MAG_FILTER,
+                    GL_LINEAR)
+
+    # requires openGL 4.6?
+    glTexParameterf(mode, texture_filter_anisotropic.GL_TEXTURE_MAX_ANISOTROPY_EXT, 16.0)
+    return mode
+
+
 class Scene(object):
+    # every scene that was ever loaded, scenes keep their passes & programs even when their GL buffers are released
     cache = {}
+    # scenes that currently own GL buffers, least recently drawn first
+    resident = OrderedDict()
+    DEFAULT_BUDGET_MB = 2048
     passThroughProgram = None
     STATIC_VERT = '#version 410\nout vec2 vUV;void main(){gl_Position=vec4(step(1,gl_VertexID)*step(-2,-gl_VertexID)*2-1,gl_VertexID-gl_VertexID%2-1,0,1);vUV=gl_Position.xy*.5+.5;}'
     PASS_THROUGH_FRAG = '#version 410\nin vec2 vUV;uniform vec4 uColor;uniform sampler2D uImages[1];out vec4 outColor0;void main(){outColor0=uColor*texture(uImages[0], vUV);}'
@@ -279,17 +262,17 @@ class Scene(object):
         FrameBuffer.clear()
 
         passThrough = Scene.usePassThroughProgram(color)
-        glActiveTexture(GL_TEXTURE0)
+        gGLState.activeTexture(GL_TEXTURE0)
 
         colorBuffer.use()
 
         glUniform1i(glGetUniformLocation(passThrough, 'uImages[0]'), 0)
-        glViewport(*viewport)
+        gGLState.viewport(*viewport)
 
         FullScreenRectSingleton.instance().draw()
 
-        glActiveTexture(GL_TEXTURE0)
-        glBindTexture(GL_TEXTURE_2D, 0)
+        gGLState.activeTexture(GL_TEXTURE0)
+        gGLState.bindTexture(GL_TEXTURE_2D, 0)
 
     @classmethod
     def getPassThroughProgram(cls):
@@ -301,7 +284,7 @@ class Scene(object):
     @classmethod
     def usePassThroughProgram(cls, color=(1.0, 1.0, 1.0, 1.0)):
         passThrough = cls.getPassThroughProgram()
-        glUseProgram(passThrough)
+        gGLState.useProgram(passThrough)
         glUniform4f(glGetUniformLocation(passThrough, 'uColor'), *color)
         return passThrough
 
@@ -313,6 +296,29 @@ class Scene(object):
             return cls.cache[sceneFile]
         return cls(sceneFile)
 
+    @classmethod
+    def budgetBytes(cls):
+        return int(gSettings.value('SceneCacheBudgetMB', cls.DEFAULT_BUDGET_MB)) * 1024 * 1024
+
+    @classmethod
+    def residentBytes(cls):
+        return sum(scene.gpuMemoryEstimate() for scene in cls.resident.values())
+
+    @classmethod
+    def releaseLeastRecentlyUsed(cls, keep=None):
+        """
+        If the resident scenes exceed the budget, release the GL buffers of the least recently drawn scene.
+        Only one scene is released per call so the cost is spread out over multiple frames.
+        The scene given as keep (the one on screen) is never released.
+        """
+        if cls.residentBytes() <= cls.budgetBytes():
+            return False
+        for scene in cls.resident.values():
+            if scene is not keep:
+                scene.releaseGLResources()
+                return True
+        return False
+
     def __init__(self, sceneFile):
         assert isinstance(sceneFile, FilePath)
         Scene.cache[sceneFile] = self
@@ -326,16 +332,37 @@ class Scene(object):
         self.shaders = []
         self.frameBuffers = []
         self.colorBuffers = []
+        self.__programSources = {}
+        self.__staticKeys = {}
+        self.__volumes = {}
+        self.__volumePixelBuffer = None
+        self.__volumePixelBufferSize = 0
+        self.__incompleteVolumes = set()
+        self.__inputsLoading = False
+        self.__gpuBytes = 0
+        self.__gpuTimer = None
         self.profileLog = []
+        self.profileFrameId = 0
+        self.glStateCounters = gGLState.counters()
         self.profileInfoChanged = Signal()
 
         self.__filePath = sceneFile
+        TexturePool.notifier().changed.connect(self._onTextureChanged)
         self.fileSystemWatcher_scene = FileSystemWatcher()
         self.fileSystemWatcher_scene.fileChanged.connect(self._reload)
         templatePath = templatePathFromScenePath(sceneFile)
         self.fileSystemWatcher_scene.addPath(templatePath)
 
-        self.__errorDialog = QDialog()  # error log
+        # error log, created when there is something to show
+        self.__errorDialog = None
+        self.__errorDialogText = None
+
+        self._reload(None)
+
+    def _errorDialog(self):
+        if self.__errorDialog is not None:
+            return self.__errorDialog
+        self.__errorDialog = QDialog()
         self.__errorDialog.setWindowTitle('Compile log')
         self.__errorDialog.setLayout(vlayout())
         self.__errorDialogText = QTextEdit()
@@ -346,8 +373,7 @@ class Scene(object):
         btn = QPushButton('Close')
         hbar.addWidget(btn)
         btn.clicked.connect(self.__errorDialog.accept)
-
-        self._reload(None)
+        return self.__errorDialog
 
     def setDebugPass(self, nameOrId=None, colorBuffer=0):
         self._debugPassId = None
@@ -376,9 +402,29 @@ class Scene(object):
                 self.fileSystemWatcher.addPaths(list(newStitches))
                 watched |= newStitches
 
+        if self.frameBuffers:
+            self._referenceTextures()
         self._rebuild(None)
         self.__cameraData = None
 
+    def _referenceTextures(self):
+        TexturePool.setReferences(self, [inpt for passData in self.passes for inpt in passData.inputBufferIds if isinstance(inpt, str)])
+
+    def _onTextureChanged(self, fileName):
+        # texture files are compared case & slash insensitive
+        fileName = fileName.lower().replace('//', '/')
+        if not any(isinstance(inpt, str) and inpt.lower().replace('//', '/') == fileName for passData in self.passes for inpt in passData.inputBufferIds):
+            return
+        # passes further down may depend on the result, so render everything again
+        for i, passData in enumerate(self.passes):
+            if passData.is3d and self.colorBuffers:
+                buffers = self.colorBuffers[passData.targetBufferId]
+                for j, buffer in enumerate(buffers):
+                    if isinstance(buffer, Texture3D):
+                        buffers[j] = buffer.original
+        self.__passDirtyState = [True] * len(self.passes)
+        self.__staticKeys = {}
+
     def _rebuild(self, path, index=None):
         if path:
             path = FilePath(path)
@@ -467,24 +513,29 @@ class Scene(object):
                     log.append('<p><font color="red">%s</font><br/>%s<br/><font color="#081">%s</font><br/>%s</p>' % (
                         error, '<br/>'.join(code[lineNumber - 5:lineNumber]), code[lineNumber],
                         '<br/>'.join(code[lineNumber + 1:lineNumber + 5])))
+                errorDialog = self._errorDialog()
                 self.__errorDialogText.setHtml('<pre>' + '\n'.join(log) + '</pre>')
-                self.__errorDialog.setGeometry(100, 100, 800, 600)
-                self.__errorDialog.exec_()
+                errorDialog.setGeometry(100, 100, 800, 600)
+                errorDialog.exec_()
                 return
 
             while len(self.shaders) <= i:
                 self.shaders.append(0)
             self.shaders[i] = program
+            self.__programSources[i] = vertCode + '\n' + fragCode
 
             # 3D texture dirties, let's reset it's buffers too
             if self.passes[i].is3d and self.colorBuffers:
-                for j, buffer in enumerate(self.colorBuffers[i]):
+                buffers = self.colorBuffers[passData.targetBufferId]
+                for j, buffer in enumerate(buffers):
                     if isinstance(buffer, Texture3D):
-                        self.colorBuffers[i][j] = buffer.original
+                        buffers[j] = buffer.original
                         self.__passDirtyState[i] = True
 
         self.__passDirtyState = [True] * len(self.passes)
-        self.__errorDialog.close()
+        self.__staticKeys = {}
+        if self.__errorDialog is not None:
+            self.__errorDialog.close()
 
     def setCameraData(self, data):
         self.__cameraData = data
@@ -510,6 +561,7 @@ class Scene(object):
     def setSize(self, w, h):
         if w == self.__w and h == self.__h:
             return
+        self.releaseGLResources()
         self.__w = w
         self.__h = h
 
@@ -543,9 +595,13 @@ class Scene(object):
         numBuffers += 2
         bufferData[numBuffers - 1] = 1, 1, None, False
 
+        # static buffers get mip maps, which adds a third to their size
+        staticBufferIds = set(passData.targetBufferId for passData in self.passes if not passData.realtime)
+
         self.frameBuffers = []
         self.colorBuffers = []
-        for value in bufferData.values():
+        self.__gpuBytes = 0
+        for bufferId, value in bufferData.items():
             if value[2] is not None:
                 w, h = value[2]
             elif value[1] is not None:
@@ -560,7 +616,163 @@ class Scene(object):
                 self.colorBuffers[-1].append(Texture(Texture.RGBA32F, w, h, tile=value[3]))
                 self.frameBuffers[-1].addTexture(self.colorBuffers[-1][-1])
 
+            # 32 bit float depth + RGBA32F color buffers
+            colorBytes = w * h * 16 * value[0]
+            if bufferId in staticBufferIds:
+                colorBytes = colorBytes * 4 // 3
+            self.__gpuBytes += w * h * 4 + colorBytes
+
+        self.__passDirtyState = [True] * len(self.passes)
+        self.__staticKeys = {}
+        self._referenceTextures()
+        self._touch()
+
+    def _touch(self):
+        # mark as most recently used
+        Scene.resident.pop(self.__filePath, None)
+        Scene.resident[self.__filePath] = self
+
+    def profileResultsSince(self, frameId):
+        """
+        Profile logs of every frame resolved since profileFrameId was frameId, see GPUTimer.resultsSince().
+        """
+        if self.__gpuTimer is None:
+            return []
+        return self.__gpuTimer.resultsSince(frameId)
+
+    def gpuMemoryEstimate(self):
+        """
+        Estimated bytes of GPU memory used by the frame buffers and volumes of this scene.
+        """
+        return self.__gpuBytes + sum(volume.width() * volume.height() * volume.depth() * 16 for volume in self.__volumes.values()) + self.__volumePixelBufferSize
+
+    def releaseGLResources(self):
+        """
+        Free all frame buffers, color buffers and volumes.
+        Passes and compiled programs are kept, so calling setSize() again is enough to draw this scene.
+        """
+        Scene.resident.pop(self.__filePath, None)
+        TexturePool.setReferences(self, ())
+        for buffers in self.colorBuffers:
+            for buffer in buffers:
+                if isinstance(buffer, Texture3D):
+                    buffer = buffer.original
+                buffer.delete()
+        for frameBuffer in self.frameBuffers:
+            frameBuffer.depth().delete()
+            frameBuffer.delete()
+        for volume in self.__volumes.values():
+            volume.delete()
+        if self.__volumePixelBuffer is not None:
+            glDeleteBuffers(1, [self.__volumePixelBuffer])
+        self.frameBuffers = []
+        self.colorBuffers = []
+        self.__volumes = {}
+        self.__volumePixelBuffer = None
+        self.__volumePixelBufferSize = 0
+        self.__incompleteVolumes = set()
+        self.__gpuBytes = 0
+        self.__w = 0
+        self.__h = 0
         self.__passDirtyState = [True] * len(self.passes)
+        self.__staticKeys = {}
+
+    def _staticCacheKey(self, passId):
+        """
+        Key describing everything that determines the output of a static pass.
+        Returns None if the result can not be cached, e.g. because it reads from a realtime buffer.
+        """
+        if passId in self.__staticKeys:
+            return self.__staticKeys[passId]
+        # guard against passes that (indirectly) read their own buffer
+        self.__staticKeys[passId] = None
+
+        passData = self.passes[passId]
+        if passData.realtime or passData.is3d or passId not in self.__programSources:
+            return None
+        if self._externalUniforms(passId):
+            # the result depends on the shot
+            return None
+
+        inputKeys = []
+        for inpt in passData.inputBufferIds:
+            if isinstance(inpt, str):
+                # input is texture file name
+                fullName = currentProjectDirectory().join(inpt)
+                if not fullName.exists():
+                    return None
+                inputKeys.append('%s@%s' % (inpt.lower(), os.path.getmtime(fullName)))
+                continue
+
+            # input is the result of the last pass that wrote to this buffer before us
+            frameBufferId, colorBufferId = inpt
+            for j in range(passId - 1, -1, -1):
+                if self.passes[j].targetBufferId == frameBufferId:
+                    break
+            else:
+                return None
+            upstreamKey = self._staticCacheKey(j)
+            if upstreamKey is None:
+                return None
+            inputKeys.append('%s.%s' % (upstreamKey, colorBufferId))
+
+        frameBuffer = self.frameBuffers[passData.targetBufferId]
+        key = staticcache.passKey(self.__programSources[passId], passData.uniforms, inputKeys,
+                                  frameBuffer.width(), frameBuffer.height(), len(self.colorBuffers[passData.targetBufferId]))
+        self.__staticKeys[passId] = key
+        return key
+
+    def _externalUniforms(self, passId):
+        """
+        Active uniforms of a pass that are not set by the scene itself,
+        such as animated uniforms, time, shot textures and textures of the view.
+        """
+        if passId >= len(self.shaders) or not self.shaders[passId]:
+            return {None}
+        program = self.shaders[passId]
+        names = set()
+        for index in range(glGetProgramiv(program, GL_ACTIVE_UNIFORMS)):
+            name = glGetActiveUniform(program, index)[0]
+            if isinstance(name, bytes):
+                name = name.decode('utf8')
+            name = name.split('[')[0]
+            if name not in ('uResolution', 'uImages', 'uImages3D') and name not in self.passes[passId].uniforms:
+                names.add(name)
+        return names
+
+    def _assembleVolume(self, frameBufferId, colorBufferId, buffer):
+        """
+        Copy a 2D slice atlas into a 3D texture without leaving the GPU.
+
+        Each row of the atlas holds one flattened slice, so the atlas memory layout already matches
+        the 3D texture layout. We read it into a pixel buffer object and unpack that buffer into the volume,
+        the volume itself is allocated once per size and reused on every rebuild.
+        """
+        resolution = buffer.height()
+        key = frameBufferId, colorBufferId, resolution
+        volume = self.__volumes.get(key, None)
+        if volume is None:
+            volume = Texture3D(Texture.RGBA32F, resolution, True)
+            self.__volumes[key] = volume
+        volume.original = buffer
+
+        numBytes = resolution * resolution * resolution * 16
+        if self.__volumePixelBuffer is None:
+            self.__volumePixelBuffer = glGenBuffers(1)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.__volumePixelBuffer)
+        if self.__volumePixelBufferSize < numBytes:
+            glBufferData(GL_PIXEL_PACK_BUFFER, numBytes, None, GL_STREAM_COPY)
+            self.__volumePixelBufferSize = numBytes
+
+        buffer.use()
+        glGetTexImage(GL_TEXTURE_2D, 0, GL_RGBA, GL_FLOAT, ctypes.c_void_p(0))
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, self.__volumePixelBuffer)
+        volume.use()
+        glTexSubImage3D(GL_TEXTURE_3D, 0, 0, 0, 0, resolution, resolution, resolution, GL_RGBA, GL_FLOAT, ctypes.c_void_p(0))
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        return volume
 
     def _bindInputs(self, passId, additionalTextureUniforms=None):
         j2d = 0
@@ -568,22 +780,16 @@ class Scene(object):
 
         j = 0
 
-        # pull all textures in advance to avoid custom mip map shaders overriding the currently set up inputs
-        program = glGetIntegerv(GL_CURRENT_PROGRAM)
-        for j, inpt in enumerate(self.passes[passId].inputBufferIds):
-            if isinstance(inpt, str):
-                TexturePool.fetchAndUse(inpt)
-        if additionalTextureUniforms:
-            for name in additionalTextureUniforms:
-                TexturePool.fetchAndUse(additionalTextureUniforms[name])
-        glUseProgram(program)  # restore program
+        # file textures load in the background, a pass using a placeholder must be rendered again later
+        self.__inputsLoading = False
 
         for j, inpt in enumerate(self.passes[passId].inputBufferIds):
-            glActiveTexture(GL_TEXTURE0 + j)
+            gGLState.activeTexture(GL_TEXTURE0 + j)
 
             if isinstance(inpt, str):
                 # input is texture file name
-                TexturePool.fetchAndUse(inpt)
+                if TexturePool.fetchAndUse(inpt) == TexturePool.placeholder():
+                    self.__inputsLoading = True
                 glUniform1i(glGetUniformLocation(self.shaders[passId], 'uImages[%s]' % j2d), j)
                 j2d += 1
                 continue
@@ -604,24 +810,20 @@ class Scene(object):
         if additionalTextureUniforms:
             for name in additionalTextureUniforms:
                 j += 1
-                glActiveTexture(GL_TEXTURE0 + j)
-                TexturePool.fetchAndUse(additionalTextureUniforms[name])
+                gGLState.activeTexture(GL_TEXTURE0 + j)
+                if TexturePool.fetchAndUse(additionalTextureUniforms[name]) == TexturePool.placeholder():
+                    self.__inputsLoading = True
                 glUniform1i(glGetUniformLocation(self.shaders[passId], name), j)
 
         return j + 1
 
     def _unbindInputs(self, maxActiveInputs):
         for j in range(maxActiveInputs):
-            glActiveTexture(GL_TEXTURE0 + j)
-            glBindTexture(GL_TEXTURE_2D, 0)
-
-    def drawToScreen(self, seconds, beats, uniforms, viewport, additionalTextureUniforms=None):
-        if not self.shaders:
-            # compiler errors
-            return
+            gGLState.activeTexture(GL_TEXTURE0 + j)
+            gGLState.bindTexture(GL_TEXTURE_2D, 0)
 
+    def _clearDirtyDepth(self):
         # clear all frame buffers from Z before draw
-        glEnable(GL_DEPTH_TEST)
         toClear = []
         for i, passData in enumerate(self.passes):
             if not self.__passDirtyState[i]:
@@ -631,6 +833,36 @@ class Scene(object):
             self.frameBuffers[i].use()
             glClear(GL_DEPTH_BUFFER_BIT)
 
+    def warmUp(self, seconds, beats, uniforms, additionalTextureUniforms=None):
+        """
+        Render all passes once without presenting the result.
+        This bakes the static passes and makes the driver finish compiling the programs,
+        so the first real frame of this scene does not hitch.
+        """
+        if not self.shaders or not self.frameBuffers:
+            return
+        gGLState.beginFrame()
+        glEnable(GL_DEPTH_TEST)
+        self._clearDirtyDepth()
+        maxActiveInputs = max(1, self.draw(seconds, beats, uniforms, additionalTextureUniforms=additionalTextureUniforms))
+        self._unbindInputs(maxActiveInputs)
+        gGLState.useProgram(0)
+        FrameBuffer.clear()
+
+    def drawToScreen(self, seconds, beats, uniforms, viewport, additionalTextureUniforms=None):
+        if not self.shaders:
+            # compiler errors
+            return
+        if not self.frameBuffers:
+            # released, setSize() was not called since
+            return
+        self._touch()
+
+        # Qt may have touched the GL state since the last frame
+        gGLState.beginFrame()
+        glEnable(GL_DEPTH_TEST)
+        self._clearDirtyDepth()
+
         maxActiveInputs = max(1, self.draw(seconds, beats, uniforms, additionalTextureUniforms=additionalTextureUniforms))
         self._unbindInputs(maxActiveInputs)
 
@@ -642,6 +874,10 @@ class Scene(object):
             Scene.drawColorBufferToScreen(a[max(0, min(self._debugPassId[1], len(a) - 1))], viewport)
         glEnable(GL_DEPTH_TEST)
 
+        # free up memory after presenting, so it never delays the frame on screen
+        Scene.releaseLeastRecentlyUsed(keep=self)
+        TexturePool.collect()
+
     def draw(self, seconds, beats, uniforms, additionalTextureUniforms=None):
         if not self.shaders:
             # compiler errors
@@ -649,20 +885,29 @@ class Scene(object):
 
         isProfiling = Profiler.instance and Profiler.instance.isVisible() and Profiler.instance.isProfiling() and self._debugPassId is None
         if isProfiling:
-            self.profileLog = []
-            glFinish()
-            startT = time.clock()
-        else:
-            startT = time.clock()
+            # timer queries are read back a few frames later, so we never wait for the GPU here
+            if self.__gpuTimer is None:
+                self.__gpuTimer = GPUTimer()
+            self.__gpuTimer.beginFrame()
+        startT = time.clock()
 
         maxActiveInputs = 0
+        # set once a pass read a texture that is still loading, static passes from there on must be rendered again
+        incomplete = False
         for i, passData in enumerate(self.passes):
             if not self.__passDirtyState[i]:
                 continue
 
             if self.passes[i].is3d:
+                buffers = self.colorBuffers[passData.targetBufferId]
+                if i in self.__incompleteVolumes:
+                    # rendered with placeholder inputs, bake it again
+                    self.__incompleteVolumes.discard(i)
+                    for j, buffer in enumerate(buffers):
+                        if isinstance(buffer, Texture3D):
+                            buffers[j] = buffer.original
                 bail = False
-                for buffer in self.colorBuffers[passData.targetBufferId]:
+                for buffer in buffers:
                     if isinstance(buffer, Texture3D):
                         # can't rebake
                         bail = True
@@ -680,98 +925,106 @@ class Scene(object):
             if i >= len(self.shaders) or self.shaders[i] == 0:
                 self._rebuild(None, index=i)
 
-            # make sure we don't take into account previous GL calls when measuring time
-            if isProfiling:
-                glFinish()
-                beforeT = time.clock()
-
-            self.frameBuffers[passData.targetBufferId].use()
-
-            glUseProgram(self.shaders[i])
-
-            activeInputs = self._bindInputs(i, additionalTextureUniforms)
-
-            fn = (glUniform1f, glUniform2f, glUniform3f, glUniform4f)
-            for name in uniforms:
-                if isinstance(uniforms[name], (int, long)):
-                    glActiveTexture(GL_TEXTURE0 + activeInputs)
-                    glBindTexture(GL_TEXTURE_2D, uniforms[name])
-                    glUniform1i(glGetUniformLocation(self.shaders[i], name), activeInputs)
-                    activeInputs += 1
-                elif isinstance(uniforms[name], float):
-                    fn[0](glGetUniformLocation(self.shaders[i], name), uniforms[name])
-                elif len(uniforms[name]) == 9:
-                    glUniformMatrix3fv(glGetUniformLocation(self.shaders[i], name), 1, False,
-                                       (ctypes.c_float * 9)(*uniforms[name]))
-                elif len(uniforms[name]) == 16:
-                    glUniformMatrix4fv(glGetUniformLocation(self.shaders[i], name), 1, False,
-                                       (ctypes.c_float * 16)(*uniforms[name]))
-                elif len(uniforms[name]) in (1, 2, 3, 4):
-                    fn[len(uniforms[name]) - 1](glGetUniformLocation(self.shaders[i], name), *uniforms[name])
-                else:
-                    # has to be a c-type array
-                    typeName = type(uniforms[name]).__name__
-                    if typeName.startswith('c_float') or typeName.startswith('c_double'):
-                        glUniform1fv(glGetUniformLocation(self.shaders[i], name), len(uniforms[name]), uniforms[name])
-                    elif typeName.startswith('c_u'):
-                        glUniform1uiv(glGetUniformLocation(self.shaders[i], name), len(uniforms[name]), uniforms[name])
-                    else:
-                        glUniform1iv(glGetUniformLocation(self.shaders[i], name), len(uniforms[name]), uniforms[name])
-
-            for name in passData.uniforms:
-                if isinstance(passData.uniforms[name], float):
-                    fn[0](glGetUniformLocation(self.shaders[i], name), passData.uniforms[name])
-                else:
-                    fn[len(passData.uniforms[name]) - 1](glGetUniformLocation(self.shaders[i], name),
-                                                         *passData.uniforms[name])
+            section = self.__gpuTimer.section(passData.name or str(i)) if isProfiling else noSection()
+            with section:
+                # static passes that were rendered before can be uploaded from disk
+                cacheKey = None
+                if not passData.realtime:
+                    cacheKey = self._staticCacheKey(i)
+                    if cacheKey is not None and staticcache.load(cacheKey, self.colorBuffers[passData.targetBufferId]):
+                        for buffer in self.colorBuffers[passData.targetBufferId]:
+                            buffer.use()
+                            _enableMipMapFiltering(buffer)
+                        if self._debugPassId is not None and i == self._debugPassId[0]:
+                            break
+                        continue
 
-            maxActiveInputs = max(maxActiveInputs, activeInputs)
+                if cacheKey is not None:
+                    # only results that take longer to render than to load are stored, measure without earlier passes
+                    glFinish()
+                    renderStart = time.time()
+
+                self.frameBuffers[passData.targetBufferId].use()
+
+                gGLState.useProgram(self.shaders[i])
+
+                activeInputs = self._bindInputs(i, additionalTextureUniforms)
+                incomplete = incomplete or self.__inputsLoading
+
+                fn = (glUniform1f, glUniform2f, glUniform3f, glUniform4f)
+                for name in uniforms:
+                    if isinstance(uniforms[name], (int, long)):
+                        gGLState.activeTexture(GL_TEXTURE0 + activeInputs)
+                        gGLState.bindTexture(GL_TEXTURE_2D, uniforms[name])
+                        glUniform1i(glGetUniformLocation(self.shaders[i], name), activeInputs)
+                        activeInputs += 1
+                    elif isinstance(uniforms[name], float):
+                        fn[0](glGetUniformLocation(self.shaders[i], name), uniforms[name])
+                    elif len(uniforms[name]) == 9:
+                        glUniformMatrix3fv(glGetUniformLocation(self.shaders[i], name), 1, False,
+                                           (ctypes.c_float * 9)(*uniforms[name]))
+                    elif len(uniforms[name]) == 16:
+                        glUniformMatrix4fv(glGetUniformLocation(self.shaders[i], name), 1, False,
+                                           (ctypes.c_float * 16)(*uniforms[name]))
+                    elif len(uniforms[name]) in (1, 2, 3, 4):
+                        fn[len(uniforms[name]) - 1](glGetUniformLocation(self.shaders[i], name), *uniforms[name])
+                    else:
+                        # has to be a c-type array
+                        typeName = type(uniforms[name]).__name__
+                        if typeName.startswith('c_float') or typeName.startswith('c_double'):
+                            glUniform1fv(glGetUniformLocation(self.shaders[i], name), len(uniforms[name]), uniforms[name])
+                        elif typeName.startswith('c_u'):
+                            glUniform1uiv(glGetUniformLocation(self.shaders[i], name), len(uniforms[name]), uniforms[name])
+                        else:
+                            glUniform1iv(glGetUniformLocation(self.shaders[i], name), len(uniforms[name]), uniforms[name])
+
+                for name in passData.uniforms:
+                    if isinstance(passData.uniforms[name], float):
+                        fn[0](glGetUniformLocation(self.shaders[i], name), passData.uniforms[name])
+                    else:
+                        fn[len(passData.uniforms[name]) - 1](glGetUniformLocation(self.shaders[i], name),
+                                                             *passData.uniforms[name])
 
-            if self.passes[i].drawCommand is not None:
-                exec(self.passes[i].drawCommand)
-            else:
-                FullScreenRectSingleton.instance().draw()
+                maxActiveInputs = max(maxActiveInputs, activeInputs)
 
-            # duct tape the 2D color buffer(s) into 3D color buffer(s)
-            if self.passes[i].is3d:
-                buffers = self.colorBuffers[passData.targetBufferId]
-                for j, buffer in enumerate(buffers):
-                    buffer.use()
-                    data = glGetTexImage(GL_TEXTURE_2D, 0, GL_RGBA, GL_FLOAT)
-                    FrameBuffer.clear()
-                    buffers[j] = Texture3D(Texture.RGBA32F, buffer.height(), True, data)
-                    buffers[j].original = buffer
-
-            # enable mip mapping on static textures
-            if not self.passes[i].realtime:
-                # after rendering grab all render targets & enable mip maps, then generate them
-                for buffer in self.colorBuffers[passData.targetBufferId]:
-                    buffer.use()
-                    mode = GL_TEXTURE_3D if isinstance(buffer, Texture3D) else GL_TEXTURE_2D
-                    glTexParameteri(mode,
-                                    GL_TEXTURE_MIN_FILTER,
-                                    GL_LINEAR_MIPMAP_LINEAR)
-                    glTexParameteri(mode,
-                                    GL_TEXTURE_MAG_FILTER,
-                                    GL_LINEAR)
-
-                    # requires openGL 4.6?
-                    glTexParameterf(mode, texture_filter_anisotropic.GL_TEXTURE_MAX_ANISOTROPY_EXT, 16.0)
-
-                    glGenerateMipmap(mode)
-
-            # make sure all graphics calls are finished processing in GL land before we measure time
-            if isProfiling:
-                glFinish()
-                afterT = time.clock()
-                self.profileLog.append((passData.name or str(i), afterT - beforeT))
+                if self.passes[i].drawCode is not None:
+                    exec(self.passes[i].drawCode)
+                    # custom draw commands may change GL state directly
+                    gGLState.invalidate()
+                else:
+                    FullScreenRectSingleton.instance().draw()
+
+                # duct tape the 2D color buffer(s) into 3D color buffer(s)
+                if self.passes[i].is3d:
+                    buffers = self.colorBuffers[passData.targetBufferId]
+                    for j, buffer in enumerate(buffers):
+                        buffers[j] = self._assembleVolume(passData.targetBufferId, j, buffer)
+
+                # enable mip mapping on static textures
+                if not self.passes[i].realtime:
+                    # after rendering grab all render targets & enable mip maps, then generate them
+                    for buffer in self.colorBuffers[passData.targetBufferId]:
+                        buffer.use()
+                        mode = _enableMipMapFiltering(buffer)
+                        glGenerateMipmap(mode)
+
+                    if incomplete:
+                        self.__passDirtyState[i] = True
+                        if self.passes[i].is3d:
+                            self.__incompleteVolumes.add(i)
+                    elif cacheKey is not None:
+                        glFinish()
+                        staticcache.save(cacheKey, self.colorBuffers[passData.targetBufferId], time.time() - renderStart)
 
             if self._debugPassId is not None and i == self._debugPassId[0]:
                 # debug mode, we want to view this pass on the screen, avoid overwriting it's buffers with future passes
                 break
 
         if isProfiling:
-            glFinish()
+            self.__gpuTimer.endFrame()
+            self.profileLog = self.__gpuTimer.results()
+            self.profileFrameId = self.__gpuTimer.resolvedFrames()
+        self.glStateCounters = gGLState.counters()
         # inform the profiler a new result is ready
         endT = time.clock()
         self.profileInfoChanged.emit(endT - startT)
@@ -3,13 +3,32 @@ from fileutil import FilePath
 from qtutil import *
 import time
 from overlays import loadImage
-from util import gSettings, currentProjectDirectory
+from util import gSettings
 from scene import Scene
+from buffers import Texture3D, saveTextures
+from texturepool import TexturePool
+from glstate import gGLState
+from projectscript import projectScript
 from OpenGL.GL import *
 
 _noSignalImage = None
 
 
+def loadToolTextures():
+    """
+    Load the images in SqrMelon/Textures, these are available to every scene as uniforms named after the file.
+    Requires the GL context to be current.
+    """
+    IMAGE_EXTENSIONS = '.png', '.bmp', '.tga'
+    textures = {}
+    textureFolder = FilePath(__file__).join('..', 'Textures').abs()
+    if textureFolder.exists():
+        for texture in textureFolder.iter():
+            if texture.ext() in IMAGE_EXTENSIONS:
+                textures[texture.name()] = loadImage(textureFolder.join(texture))
+    return textures
+
+
 class SceneView(QGLWidget):
     """
     OpenGL 3D viewport.
@@ -50,16 +69,41 @@ class SceneView(QGLWidget):
         self.setFocusPolicy(Qt.StrongFocus)
         self._textures = {}
         self._prevTime = time.time()
+        # show textures as soon as they are decoded
+        TexturePool.notifier().loaded.connect(self.repaint)
 
     def saveStaticTextures(self):
         exportDir = QFileDialog.getExistingDirectory(None, 'Choose destination folder to save static textures as .png files.', '.')
         if not exportDir:
             return
+        self.makeCurrent()
+        textures = []
         for passData in self._scene.passes:
             if passData.realtime:
                 continue
             for index, cbo in enumerate(self._scene.colorBuffers[passData.targetBufferId]):
-                cbo.save(FilePath(os.path.join(exportDir, '{}{}.png'.format(passData.name, index))))
+                if isinstance(cbo, Texture3D):
+                    # save the slice atlas
+                    cbo = cbo.original
+                textures.append((cbo, FilePath(os.path.join(exportDir, '{}{}.png'.format(passData.name, index))), None))
+        saveTextures(textures)
+
+    def allocateScene(self, scene):
+        """
+        Create the buffers of a scene that is not on screen yet at the current view size.
+        """
+        self.makeCurrent()
+        scene.setSize(*self._size)
+
+    def warmScene(self, scene, shot):
+        """
+        Render a scene that is not on screen yet once, with the animation at the start of the given shot.
+        """
+        self.makeCurrent()
+        uniforms = shot.evaluate(shot.start)
+        for name in self._textures:
+            uniforms[name] = self._textures[name]._id
+        scene.warmUp(self._timer.beatsToSeconds(shot.start), shot.start, uniforms, additionalTextureUniforms=shot.textures)
 
     def setPreviewRes(self, widthOverride, heightOverride, scale):
         if widthOverride is not None:
@@ -129,12 +173,7 @@ class SceneView(QGLWidget):
         glDepthFunc(GL_LEQUAL)
         # glDepthMask(GL_TRUE)
 
-        IMAGE_EXTENSIONS = '.png', '.bmp', '.tga'
-        textureFolder = FilePath(__file__).join('..', 'Textures').abs()
-        if textureFolder.exists():
-            for texture in textureFolder.iter():
-                if texture.ext() in IMAGE_EXTENSIONS:
-                    self._textures[texture.name()] = loadImage(textureFolder.join(texture))
+        self._textures.update(loadToolTextures())
 
         self._prevTime = time.time()
         self._timer.kick()
@@ -165,6 +204,9 @@ class SceneView(QGLWidget):
 
         self._prevTime = newTime
 
+        # Qt may have touched the GL state since the last frame
+        gGLState.invalidate()
+
         width, height = self.calculateAspect(self.width(), self.height())
         viewport = (int((self.width() - width) * 0.5),
                     int((self.height() - height) * 0.5),
@@ -177,10 +219,8 @@ class SceneView(QGLWidget):
 
             cameraData = self._cameraData
             scene = self._scene
-            modifier = currentProjectDirectory().join('animationprocessor.py')
-            if modifier.exists():
-                beats = self._timer.time
-                execfile(modifier, globals(), locals())
+            beats = self._timer.time
+            projectScript('animationprocessor.py').run(globals(), locals())
 
             for name in self._textures:
                 uniforms[name] = self._textures[name]._id
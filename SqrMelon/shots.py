@@ -5,6 +5,7 @@ from textures import TextureManager
 from animationgraph.curvedata import Curve, Key
 from collections import OrderedDict
 from scene import Scene
+from texturepool import TexturePool
 from xml.etree import cElementTree
 from util import randomColor, parseXMLWithIncludes, toPrettyXml, SCENE_EXT, currentProjectFilePath, \
     currentScenesDirectory, currentTemplatesDirectory, iterSceneNames
@@ -52,6 +53,7 @@ class Shot(object):
         self.curves = curves or OrderedDict()
         assert isinstance(self.curves, OrderedDict)
         self.textures = textures or OrderedDict()
+        TexturePool.setReferences(self, self.textures.values())
         self.color = QColor.fromRgb(*randomColor())
         self.items[0].setData(self, Qt.UserRole + 1)
         self._enabled = True
@@ -329,6 +331,32 @@ def _saveSceneShots(sceneName, shots):
         fh.write(toPrettyXml(xScene))
 
 
+def iterAllShots():
+    """
+    Load the shots of all scenes in the current project.
+    """
+    for sceneName in iterSceneNames():
+        for shot in _deserializeSceneShots(sceneName):
+            yield shot
+
+
+def shotAtTime(shots, time):
+    """
+    The enabled shot to show at the given time, a pinned shot wins regardless of time.
+    When shots overlap the one that starts last wins, or the last one in shots if they start together,
+    so the result does not depend on how shots are sorted.
+    """
+    candidate = None
+    for shot in shots:
+        if not shot.enabled:
+            continue
+        if shot.pinned:
+            return shot
+        if shot.start <= time < shot.end and (candidate is None or shot.start >= candidate.start):
+            candidate = shot
+    return candidate
+
+
 class ShotView(QTableView):
     viewShotAction = pyqtSignal(float, float, object)
     pinShotAction = pyqtSignal(Shot)
@@ -498,16 +526,7 @@ class ShotManager(QWidget):
         return self.__model.itemChanged
 
     def shotAtTime(self, time):
-        candidate = None
-        for row in range(self.__model.rowCount()):
-            shot = self.__model.item(row).data(Qt.UserRole + 1)
-            if not shot.enabled:
-                continue
-            if shot.pinned:
-                return shot
-            if shot.start <= time < shot.end:
-                candidate = shot
-        return candidate
+        return shotAtTime(self.shots(), time)
 
     def additionalTextures(self, time):
         shot = self.shotAtTime(time)
@@ -529,12 +548,13 @@ class ShotManager(QWidget):
             self.setEnabled(False)
             return
         self.setEnabled(True)
+        for shot in self.shots():
+            TexturePool.setReferences(shot, ())
         self.__model.clear()
         # model.clear() removes the header labels
         self.__model.setHorizontalHeaderLabels(['Name', 'Scene', 'Start', 'End', 'Duration', 'Speed', 'Preroll'])
-        for sceneName in iterSceneNames():
-            for shot in _deserializeSceneShots(sceneName):
-                self.__model.appendRow(shot.items)
+        for shot in iterAllShots():
+            self.__model.appendRow(shot.items)
 
         self.__table.sortByColumn(2, Qt.AscendingOrder)
 
@@ -657,6 +677,7 @@ class ShotManager(QWidget):
         rows = list(set(rows))
         rows.sort(key=lambda x: -x)
         for row in rows:
+            TexturePool.setReferences(self.__model.item(row).data(Qt.UserRole + 1), ())
             self.__model.removeRow(row)
 
     def __deleteSelectedShots(self):
@@ -0,0 +1,202 @@
+"""
+Disk cache for the color buffers of static (precalc) passes.
+
+A static pass only depends on its shader source, constant uniforms, inputs and resolution.
+The rendered result, mip maps included, is stored per color buffer so later sessions can
+upload it directly instead of running the (potentially very slow) texture generator again.
+
+Passes that read anything the scene does not set itself, such as animation or shot textures, are not cached.
+Results are only stored when rendering took longer than loading them is expected to take.
+Every change to a static pass stores a new result, so after saving the least recently used
+results are removed while the cache exceeds the StaticCacheBudgetMB setting.
+"""
+from pycompat import *
+import os
+import ctypes
+import time
+import struct
+import hashlib
+from OpenGL.GL import *
+from util import currentProjectDirectory, gSettings
+
+_MAGIC = b'SMSC'
+_VERSION = 1
+_HEADER = '<4sIIII'  # magic, version, width, height, mip levels
+DEFAULT_BUDGET_MB = 4096
+# until a load was measured
+_loadBytesPerSecond = 500.0 * 1024 * 1024
+
+
+def cacheDirectory():
+    # AttributeError if no current project
+    return currentProjectDirectory().join('cache', 'static')
+
+
+def passKey(programSource, uniforms, inputKeys, width, height, numOutputs):
+    """
+    Hash everything that determines the output of a static pass.
+
+    :param str programSource: Vertex and fragment code the pass was compiled from.
+    :param dict uniforms: Constant uniforms of the pass, name to list of floats.
+    :param list inputKeys: One string per input describing its content (e.g. the key of the static pass that produced it).
+    :rtype: str
+    """
+    h = hashlib.sha1()
+    h.update(programSource.encode('utf8'))
+    for name in sorted(uniforms):
+        h.update(('%s=%r;' % (name, uniforms[name])).encode('utf8'))
+    for inputKey in inputKeys:
+        h.update(('<%s>' % inputKey).encode('utf8'))
+    h.update(('%sx%sx%s' % (width, height, numOutputs)).encode('utf8'))
+    return h.hexdigest()
+
+
+def _mipSizes(width, height):
+    sizes = [(width, height)]
+    while width > 1 or height > 1:
+        width = max(1, width // 2)
+        height = max(1, height // 2)
+        sizes.append((width, height))
+    return sizes
+
+
+def fileBytes(textures):
+    """
+    Bytes stored for the given textures, all mip levels of RGBA32F.
+    """
+    return sum(struct.calcsize(_HEADER) + sum(w * h * 16 for w, h in _mipSizes(texture.width(), texture.height())) for texture in textures)
+
+
+def _filePath(key, index):
+    return cacheDirectory().join('%s_%s.bin' % (key, index))
+
+
+def budgetBytes():
+    return int(gSettings.value('StaticCacheBudgetMB', DEFAULT_BUDGET_MB)) * 1024 * 1024
+
+
+def prune(keep=None):
+    """
+    Remove the least recently used results until the cache fits the budget.
+    Loading a result marks it as used by updating the modification time of its files.
+    :param str keep: Key that is never removed, e.g. the one that was just saved.
+    """
+    directory = cacheDirectory()
+    if not directory.exists():
+        return
+    # all buffers of a pass are removed together, files of other processes that are still being written are skipped
+    entries = {}
+    for name in directory.iter():
+        if not name.hasExt('bin'):
+            continue
+        path = directory.join(name)
+        try:
+            info = os.stat(path)
+        except OSError:
+            continue
+        key = name.rsplit('_', 1)[0]
+        paths, size, used = entries.get(key, ([], 0, 0.0))
+        entries[key] = paths + [path], size + info.st_size, max(used, info.st_mtime)
+    total = sum(size for paths, size, used in entries.values())
+    budget = budgetBytes()
+    for key, (paths, size, used) in sorted(entries.items(), key=lambda item: item[1][2]):
+        if total <= budget:
+            break
+        if key == keep:
+            continue
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                # removed by another process
+                pass
+        total -= size
+
+
+def save(key, textures, renderSeconds):
+    """
+    Read back all mip levels of the given RGBA32F textures and store them under key.
+    Expects the mip maps to be generated already.
+    :param float renderSeconds: Time it took to render, nothing is stored if loading would take longer.
+    """
+    if renderSeconds <= fileBytes(textures) / _loadBytesPerSecond:
+        return
+    cacheDirectory().ensureExists(isFolder=True)
+    for index, texture in enumerate(textures):
+        sizes = _mipSizes(texture.width(), texture.height())
+        texture.use()
+        dst = _filePath(key, index)
+        # unique per process, offline renders may bake the same pass in several processes at once
+        tmp = dst + '.%s.tmp' % os.getpid()
+        with tmp.edit('wb') as fh:
+            fh.write(struct.pack(_HEADER, _MAGIC, _VERSION, texture.width(), texture.height(), len(sizes)))
+            for level, (w, h) in enumerate(sizes):
+                buffer = (ctypes.c_float * (w * h * 4))()
+                glGetTexImage(GL_TEXTURE_2D, level, GL_RGBA, GL_FLOAT, buffer)
+                fh.write(ctypes.string_at(buffer, ctypes.sizeof(buffer)))
+        # only expose complete files under the final name
+        try:
+            if dst.exists():
+                os.remove(dst)
+            os.rename(tmp, dst)
+        except OSError:
+            # another process stored the same result first
+            os.remove(tmp)
+    prune(key)
+
+
+def _read(key, index, texture):
+    path = _filePath(key, index)
+    if not path.exists():
+        return None
+    with path.open('rb') as fh:
+        data = fh.read()
+    headerSize = struct.calcsize(_HEADER)
+    if len(data) < headerSize:
+        return None
+    magic, version, width, height, numLevels = struct.unpack(_HEADER, data[:headerSize])
+    sizes = _mipSizes(texture.width(), texture.height())
+    if magic != _MAGIC or version != _VERSION or (width, height, numLevels) != (texture.width(), texture.height(), len(sizes)):
+        return None
+    levels = []
+    cursor = headerSize
+    for w, h in sizes:
+        end = cursor + w * h * 16
+        if end > len(data):
+            # truncated file
+            return None
+        levels.append(data[cursor:end])
+        cursor = end
+    return levels
+
+
+def load(key, textures):
+    """
+    Upload the cached results for key into the given textures, mip maps included.
+    Returns False and leaves the textures untouched if any of them is not cached.
+    """
+    global _loadBytesPerSecond
+    start = time.time()
+    allLevels = []
+    for index, texture in enumerate(textures):
+        levels = _read(key, index, texture)
+        if levels is None:
+            return False
+        allLevels.append(levels)
+
+    for index in range(len(textures)):
+        try:
+            # mark as recently used for prune()
+            os.utime(_filePath(key, index), None)
+        except OSError:
+            pass
+
+    for texture, levels in zip(textures, allLevels):
+        texture.use()
+        for level, ((w, h), data) in enumerate(zip(_mipSizes(texture.width(), texture.height()), levels)):
+            glTexImage2D(GL_TEXTURE_2D, level, GL_RGBA32F, w, h, 0, GL_RGBA, GL_FLOAT, data)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, len(levels) - 1)
+    seconds = time.time() - start
+    if seconds > 0.0:
+        _loadBytesPerSecond = fileBytes(textures) / seconds
+    return True
@@ -0,0 +1,290 @@
+"""
+Textures loaded from files in the project, shared by all scenes.
+"""
+from pycompat import *
+import os
+import sys
+import time
+import ctypes
+from multiprocessing.pool import ThreadPool
+from OpenGL.GL import *
+from glstate import gGLState
+from heightfield import loadHeightfield, heightfieldLayout, EXTENSIONS as HEIGHTFIELD_EXTENSIONS, FORMATS as HEIGHTFIELD_FORMATS
+from qtutil import *
+from fileutil import FileSystemWatcher
+from util import currentProjectDirectory, gSettings
+
+
+def _decodeImage(fullName):
+    """
+    Runs on a worker thread, QImage is safe to use outside the GUI thread.
+    """
+    img = QImage(fullName)
+    if img.isNull():
+        return None
+    return QGLWidget.convertToGLFormat(img)
+
+
+def _imageBits(img):
+    if sys.version_info.major == 3:
+        return img.bits()
+    return ctypes.c_void_p(int(img.bits()))
+
+
+class _TextureLoadNotifier(QObject):
+    # Qt signals may be emitted from worker threads, the slots run on the GUI thread
+    loaded = pyqtSignal()
+    # a texture file changed on disk, receives the file name as used in fetchAndUse
+    changed = pyqtSignal(str)
+
+
+class _Entry(object):
+    def __init__(self, fileName, fullName, textureId, numBytes):
+        self.fileName = fileName
+        self.fullName = fullName
+        self.id = textureId
+        self.numBytes = numBytes
+        self.mtime = os.path.getmtime(fullName) if os.path.exists(fullName) else None
+        self.lastUsed = 0
+
+
+class TexturePool(object):
+    """
+    Utility to fetch & bind textures by file path, loaded only once.
+    File paths are treated slash and case insensitive.
+
+    Images are decoded on worker threads. Until the pixels are ready a 1x1 placeholder
+    is bound, the upload happens on the GL thread the next time the texture is fetched.
+    Connect to notifier().loaded to repaint when that is the case.
+
+    Passes and shots register the files they use with setReferences(). Textures nobody refers to
+    are kept around until the pool exceeds its budget (QSettings key TexturePoolBudgetMB),
+    collect() then deletes them least recently used first.
+    Files are watched and reloaded when their modification time changes.
+    """
+    WORKERS = 2
+    DEFAULT_BUDGET_MB = 512
+    __cache = {}
+    __pending = {}
+    __owners = {}
+    __refCounts = {}
+    __stale = set()
+    __clock = 0
+    __watcher = None
+    __workers = None
+    __notifier = None
+    __placeholder = None
+
+    @staticmethod
+    def notifier():
+        if TexturePool.__notifier is None:
+            TexturePool.__notifier = _TextureLoadNotifier()
+        return TexturePool.__notifier
+
+    @staticmethod
+    def placeholder():
+        if TexturePool.__placeholder is None:
+            TexturePool.__placeholder = glGenTextures(1)
+            gGLState.bindTexture(GL_TEXTURE_2D, TexturePool.__placeholder)
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, 1, 1, 0, GL_RGBA, GL_UNSIGNED_BYTE, (ctypes.c_ubyte * 4)(0, 0, 0, 255))
+        return TexturePool.__placeholder
+
+    @staticmethod
+    def isLoading(fileName):
+        return TexturePool.__key(fileName) in TexturePool.__pending
+
+    @staticmethod
+    def waitForPending(timeout=None):
+        """
+        Block until all images are decoded, the next fetch then uploads them.
+        Used when rendering offline, where a frame must never show a placeholder.
+        :param float timeout: Seconds to wait at most for all images together.
+        :returns: Files that are still being decoded.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for fileName, fullName, result in list(TexturePool.__pending.values()):
+            result.wait(None if deadline is None else max(0.0, deadline - time.time()))
+        return [fullName for fileName, fullName, result in TexturePool.__pending.values() if not result.ready()]
+
+    @staticmethod
+    def pendingFiles():
+        """
+        Files that were requested but are not uploaded yet.
+        """
+        return [fullName for fileName, fullName, result in TexturePool.__pending.values()]
+
+    @staticmethod
+    def __key(fileName):
+        return fileName.lower().replace('//', '/')
+
+    @staticmethod
+    def setReferences(owner, fileNames):
+        """
+        Replace the set of files the owner (a scene, shot, ...) uses, pass an empty list to release all of them.
+        """
+        keys = set(TexturePool.__key(fileName) for fileName in fileNames)
+        previous = TexturePool.__owners.pop(owner, set())
+        for key in previous - keys:
+            TexturePool.__refCounts[key] -= 1
+            if not TexturePool.__refCounts[key]:
+                del TexturePool.__refCounts[key]
+        for key in keys - previous:
+            TexturePool.__refCounts[key] = TexturePool.__refCounts.get(key, 0) + 1
+        if keys:
+            TexturePool.__owners[owner] = keys
+
+    @staticmethod
+    def budgetBytes():
+        return int(gSettings.value('TexturePoolBudgetMB', TexturePool.DEFAULT_BUDGET_MB)) * 1024 * 1024
+
+    @staticmethod
+    def usage():
+        """
+        :returns: Number of textures, their size in bytes, number of referenced textures and number of textures still decoding.
+        :rtype: (int, int, int, int)
+        """
+        numBytes = sum(entry.numBytes for entry in TexturePool.__cache.values())
+        referenced = sum(1 for key in TexturePool.__cache if key in TexturePool.__refCounts)
+        return len(TexturePool.__cache), numBytes, referenced, len(TexturePool.__pending)
+
+    @staticmethod
+    def __delete(key):
+        entry = TexturePool.__cache.pop(key)
+        if entry.id:
+            glDeleteTextures([entry.id])
+            gGLState.forgetTexture(entry.id)
+        if TexturePool.__watcher is not None and entry.mtime is not None:
+            TexturePool.__watcher.removePath(entry.fullName)
+
+    @staticmethod
+    def collect():
+        """
+        Delete stale textures and, when over budget, the least recently used textures nobody refers to.
+        Requires the GL context to be current.
+        """
+        for key in list(TexturePool.__stale):
+            if key in TexturePool.__cache:
+                TexturePool.__delete(key)
+        TexturePool.__stale.clear()
+
+        numBytes = sum(entry.numBytes for entry in TexturePool.__cache.values())
+        budget = TexturePool.budgetBytes()
+        if numBytes <= budget:
+            return
+        candidates = [key for key in TexturePool.__cache if key not in TexturePool.__refCounts]
+        candidates.sort(key=lambda key: TexturePool.__cache[key].lastUsed)
+        for key in candidates:
+            numBytes -= TexturePool.__cache[key].numBytes
+            TexturePool.__delete(key)
+            if numBytes <= budget:
+                return
+
+    @staticmethod
+    def __watch(entry):
+        if entry.mtime is None:
+            return
+        if TexturePool.__watcher is None:
+            TexturePool.__watcher = FileSystemWatcher()
+            TexturePool.__watcher.fileChanged.connect(TexturePool.__onFileChanged)
+        TexturePool.__watcher.addPath(entry.fullName)
+
+    @staticmethod
+    def __onFileChanged(fullName):
+        for key, entry in TexturePool.__cache.items():
+            if entry.fullName != fullName:
+                continue
+            if not os.path.exists(fullName):
+                # removed, or replaced by an editor saving the file, keep what we have until it shows up again
+                continue
+            # editors often replace the file on save, which removes it from the watcher
+            TexturePool.__watcher.addPath(fullName)
+            if os.path.getmtime(fullName) != entry.mtime:
+                # GL context may not be current here, delete on the next fetch or collect
+                TexturePool.__stale.add(key)
+                TexturePool.notifier().changed.emit(entry.fileName)
+
+    @staticmethod
+    def __upload(img):
+        tex = glGenTextures(1)
+        gGLState.bindTexture(GL_TEXTURE_2D, tex)
+        size = img.width() * img.height() * 4
+        if gSettings.value('TexturePoolPBOUpload', 'false') == 'true':
+            # copy into driver owned memory, the transfer to the texture can then happen asynchronously
+            pixelBuffer = glGenBuffers(1)
+            glBindBuffer(GL_PIXEL_UNPACK_BUFFER, pixelBuffer)
+            glBufferData(GL_PIXEL_UNPACK_BUFFER, size, None, GL_STREAM_DRAW)
+            ptr = glMapBufferRange(GL_PIXEL_UNPACK_BUFFER, 0, size, GL_MAP_WRITE_BIT | GL_MAP_INVALIDATE_BUFFER_BIT)
+            ctypes.memmove(ptr, _imageBits(img), size)
+            glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER)
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, img.width(), img.height(), 0, GL_RGBA, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+            glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+            # deleting is deferred by the driver until the upload is done
+            glDeleteBuffers(1, [pixelBuffer])
+        else:
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, img.width(), img.height(), 0, GL_RGBA, GL_UNSIGNED_BYTE, _imageBits(img))
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        return tex
+
+    @staticmethod
+    def __store(key, fileName, fullName, textureId, numBytes):
+        entry = _Entry(fileName, fullName, textureId, numBytes)
+        TexturePool.__cache[key] = entry
+        TexturePool.__watch(entry)
+        return entry
+
+    @staticmethod
+    def __finish(key):
+        fileName, fullName, result = TexturePool.__pending.pop(key)
+        img = result.get()
+        if img is None:
+            print('Warning, could not load texture %s.' % fullName)
+            TexturePool.__store(key, fileName, fullName, 0, 0)  # no texture
+        else:
+            TexturePool.__store(key, fileName, fullName, TexturePool.__upload(img), img.width() * img.height() * 4)
+
+    @staticmethod
+    def fetchAndUse(fileName):
+        """
+        Bind the texture for the given file to the active texture unit.
+        Returns the texture id, or the placeholder while the file is being decoded.
+        """
+        assert not '\\' in fileName
+
+        key = TexturePool.__key(fileName)
+        if key in TexturePool.__pending:
+            if not TexturePool.__pending[key][2].ready():
+                gGLState.bindTexture(GL_TEXTURE_2D, TexturePool.placeholder())
+                return TexturePool.placeholder()
+            TexturePool.__finish(key)
+
+        if key in TexturePool.__stale:
+            TexturePool.__stale.discard(key)
+            if key in TexturePool.__cache:
+                TexturePool.__delete(key)
+
+        TexturePool.__clock += 1
+        entry = TexturePool.__cache.get(key, None)
+        if entry is not None:
+            entry.lastUsed = TexturePool.__clock
+            gGLState.bindTexture(GL_TEXTURE_2D, entry.id)
+            return entry.id
+        parentPath = currentProjectDirectory()
+        fullName = parentPath.join(fileName)
+
+        # texture is a single channel raw heightmap
+        if key.endswith(HEIGHTFIELD_EXTENSIONS):
+            tex = loadHeightfield(fullName)
+            bytesPerPixel = HEIGHTFIELD_FORMATS[heightfieldLayout(fullName)[2]][1]
+            entry = TexturePool.__store(key, fileName, fullName, tex.id(), tex.width() * tex.height() * bytesPerPixel)
+            entry.lastUsed = TexturePool.__clock
+            return tex.id()
+
+        # decode image file in the background
+        if TexturePool.__workers is None:
+            TexturePool.__workers = ThreadPool(TexturePool.WORKERS)
+        notifier = TexturePool.notifier()
+        result = TexturePool.__workers.apply_async(_decodeImage, (fullName,), callback=lambda img: notifier.loaded.emit())
+        TexturePool.__pending[key] = fileName, fullName, result
+        gGLState.bindTexture(GL_TEXTURE_2D, TexturePool.placeholder())
+        return TexturePool.placeholder()
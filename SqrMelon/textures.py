@@ -2,6 +2,7 @@ from util import currentProjectDirectory
 from qtutil import *
 import icons
 from fileutil import FileDialog
+from texturepool import TexturePool
 
 
 class TextureManager(QDialog):
@@ -60,10 +61,11 @@ class TextureManager(QDialog):
             return
         uniformName = uniformName[0]
 
-        imagePath = FileDialog.getOpenFileName(self, currentProjectDirectory(), '', 'Image files (*.png;*.bmp;*.jpg;*.jpeg;*.tiff);;Raw Gray F32 map (*.r32)')
+        imagePath = FileDialog.getOpenFileName(self, currentProjectDirectory(), '', 'Image files (*.png;*.bmp;*.jpg;*.jpeg;*.tiff);;Raw gray heightfield (*.r32;*.r16)')
         if imagePath and imagePath.exists():
             relPath = imagePath.relativeTo(currentProjectDirectory())
             self.__target.textures[uniformName] = relPath
+            TexturePool.setReferences(self.__target, self.__target.textures.values())
 
             nameItem = QStandardItem(uniformName)
             nameItem.setIcon(QIcon(imagePath))
@@ -83,3 +85,4 @@ class TextureManager(QDialog):
                 continue
             del self.__target.textures[str(name.text())]
             self.__model.takeRow(row)
+        TexturePool.setReferences(self.__target, self.__target.textures.values())
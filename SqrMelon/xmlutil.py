@@ -17,7 +17,10 @@ def xmlFixSlashesRecursively(xElement):
         xmlFixSlashesRecursively(xChild)
 
 
-def parseXMLWithIncludes(xmlFilePath):
+def expandXMLIncludes(xmlFilePath):
+    """
+    Returns the text of the file with <!-- #include path --> comments replaced by the content of that file.
+    """
     assert isinstance(xmlFilePath, FilePath)
     text = xmlFilePath.content()
 
@@ -29,7 +32,14 @@ def parseXMLWithIncludes(xmlFilePath):
 
     for start, end, repl in reversed(subs):
         text = '{}{}{}'.format(text[:start], repl, text[end:])
+    return text
+
+
+def parseXMLWithIncludes(xmlFilePath):
+    return parseXMLText(expandXMLIncludes(xmlFilePath))
+
 
+def parseXMLText(text):
     xRoot = cElementTree.fromstring(text)
     xmlFixSlashesRecursively(xRoot)
     return xRoot